@@ -51,6 +51,9 @@ if (!initialConversations) {
 
 
 
+// Stored messages use the roles of the OpenAI API, the chat shows them as Me / AI
+const ROLE_LABELS = { user: 'Me', assistant: 'AI' };
+
 const ChatWindow = ({accountAddress, accountName, onRefresh}) => {
   const [currentConversationId, setCurrentConversationId] = useState(null);
   const [messages, setMessages] = useState([]);
@@ -293,19 +296,29 @@ const ChatWindow = ({accountAddress, accountName, onRefresh}) => {
     try {
       // Add necessary formData entries here
       const userId = address ? address : "addressUnknown";
-      const payload = {userId: userId};
       // Include the Authorization header with the Bearer token
       const config = {
         headers: { Authorization: `Bearer ${accessToken}` }
       };
-        
-      const response = await axios.post('http://127.0.0.1:5002/api/retrieveAll', payload, config);
-  
-      if (!response.data.response) {
-        throw new Error(`HTTP error! Status: ${response.status}`);
-      }
-  
-      return await response.data.response; // Assuming the response is in JSON format
+
+      // Metadata only, newest first, page by page. Messages are loaded when a conversation is opened.
+      // Unchanged pages are revalidated by the browser cache with their ETag.
+      const conversations = [];
+      let cursor = null;
+      do {
+        const response = await axios.get('http://127.0.0.1:5002/api/retrieveAll', {
+          ...config,
+          params: cursor ? { userId: userId, cursor: cursor } : { userId: userId },
+        });
+
+        if (!response.data.response) {
+          throw new Error(`HTTP error! Status: ${response.status}`);
+        }
+        conversations.push(...response.data.response);
+        cursor = response.data.nextCursor;
+      } while (cursor);
+
+      return conversations;
     } catch (error) {
       console.error("Failed to fetch conversations:", error);
       return []; // Return an empty array in case of an error
@@ -320,7 +333,7 @@ const ChatWindow = ({accountAddress, accountName, onRefresh}) => {
     if (currentConversationId && messages.length > 0) {
         const updatedConversations = savedConversations.map(conv => {
             if (conv.id === currentConversationId) {
-                if (conv.messages.length !== messages.length) {
+                if (!conv.messages || conv.messages.length !== messages.length) {
                     console.log("Updated previous conversation");
                 }
                 return { ...conv, messages: messages };
@@ -375,12 +388,30 @@ const startNewConversation = async () => {
   
 
 
-  // Function to handle loading a conversation
-  const loadConversation = (conversationId) => {
+  // Function to handle loading a conversation, its messages are fetched the first time it is opened
+  const loadConversation = async (conversationId) => {
     const conversationToLoad = savedConversations.find(conv => conv.id === conversationId);
-    if (conversationToLoad) {
+    if (!conversationToLoad) return;
+    setCurrentConversationId(conversationToLoad.id);
+    if (conversationToLoad.messages) {
       setMessages(conversationToLoad.messages);
-      setCurrentConversationId(conversationToLoad.id);
+      return;
+    }
+
+    setMessages([]);
+    try {
+      const userId = address ? address : "addressUnknown";
+      const response = await axios.get('http://127.0.0.1:5002/api/conversation', {
+        headers: { Authorization: `Bearer ${accessToken}` },
+        params: { userId: userId, conversationId: conversationId },
+      });
+      const loadedMessages = response.data.response.messages;
+      setMessages(loadedMessages);
+      setSavedConversations(conversations => conversations.map(conv =>
+        conv.id === conversationId ? { ...conv, messages: loadedMessages } : conv
+      ));
+    } catch (error) {
+      console.error("Failed to load conversation:", error);
     }
   };
 
@@ -789,8 +820,8 @@ const renderMessage = (msg, index) => {
 
   return (
     <React.Fragment key={index}>
-      <div className={`message message-${msg.role}`}>
-        <strong>{msg.role}</strong>
+      <div className={`message message-${ROLE_LABELS[msg.role] || msg.role}`}>
+        <strong>{ROLE_LABELS[msg.role] || msg.role}</strong>
         {match ? (
           <pre>
             <code
@@ -138,7 +138,16 @@ export const fetchConversationSummary = async (conversationId, userId, config) =
   try {
 
     const response = await axios.post('http://127.0.0.1:5002/api/conv-summary', {conversationId: conversationId, userId: userId }, config);
-    return response.data.response; // Assuming the response contains a 'summary' field .slice(0, 45)
+    // The summary is generated in the background, poll the job until it is done
+    const jobId = response.data.jobId;
+    for (let attempt = 0; attempt < 60; attempt++) {
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const result = await axios.get(`http://127.0.0.1:5002/api/conv-summary/${jobId}`, config);
+      if (result.status === 200) {
+        return result.data.response; // Assuming the response contains a 'summary' field .slice(0, 45)
+      }
+    }
+    return null;
   } catch (error) {
     console.error('Error fetching conversation summary:', error);
     return null;
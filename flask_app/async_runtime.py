@@ -0,0 +1,50 @@
+"""
+Per-process asyncio event loop for the I/O bound part of the requests.
+
+Flask views stay synchronous and hand their pipeline to run_async(), which
+schedules it on a single event loop running in a background thread. The
+request thread only waits on the result, so with threaded workers
+(gunicorn -k gthread --threads N) many concurrent turns share one loop and
+the connection pools of the async OpenAI and HTTP clients.
+
+The loop is created lazily and re-created after a fork, so it is safe to
+import this module in a gunicorn master started with --preload.
+"""
+import asyncio
+import os
+import threading
+
+_loop = None
+_loop_pid = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    """Return the event loop of this process, starting it on first use."""
+    global _loop, _loop_pid
+    with _lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="async-runtime", daemon=True).start()
+        return _loop
+
+def run_async(coro, timeout=None):
+    """Run a coroutine on the shared loop and block the calling thread until it is done."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+def loop_local(factory):
+    """
+    Wrap a client factory so the client is created once per event loop.
+    Async clients keep connections bound to the loop they were first used on.
+    """
+    clients = {}
+
+    def get_client():
+        loop = asyncio.get_running_loop()
+        client = clients.get(loop)
+        if client is None:
+            client = clients[loop] = factory()
+        return client
+
+    return get_client
@@ -0,0 +1,122 @@
+"""
+Per-account cache of token balances in front of get_balance.
+
+Balances are kept for a short TTL and concurrent requests for the same
+account share a single RPC call. Entries are invalidated as soon as a
+transfer or a swap of the account succeeds. Swaps run by the UI are only
+announced by the swap_function intents, so those put the account on hold:
+its balance is not cached until the hold expires.
+
+Configuration:
+    BALANCE_CACHE_TTL     seconds a balance stays valid (default 10, 0 disables the cache)
+    BALANCE_CACHE_HOLD    seconds balances are not cached after a swap is announced (default 120)
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from quote_cache import quote_cache
+from tracing import span
+
+
+class BalanceCache:
+
+    def __init__(self, ttl=10, hold=120, max_entries=4096):
+        self.ttl = ttl
+        self.hold = hold
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._inflight = {}
+        # Hold expiry by account, in expiry order
+        self._held_until = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "invalidations": 0,
+            "rpc_calls": 0,
+        }
+
+    async def get(self, accountAddress, fetch):
+        """Balance of an account, fetch() is awaited on a miss."""
+        key = (accountAddress or '').lower()
+        now = time.monotonic()
+        with self._lock:
+            held = self._held_until.get(key, 0) > now
+            entry = self._entries.get(key)
+            if entry is not None and not held and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry[0]
+            inflight = self._inflight.get(key)
+            if inflight is not None:
+                self._stats["coalesced"] += 1
+            else:
+                self._stats["misses"] += 1
+                self._stats["rpc_calls"] += 1
+                inflight = self._inflight[key] = asyncio.ensure_future(fetch())
+                inflight.add_done_callback(lambda future: self._store(key, held, future))
+        # Shielded so a cancelled prefetch does not cancel the fetch shared with other callers
+        return await asyncio.shield(inflight)
+
+    def invalidate(self, accountAddress, hold=False):
+        """Drop the cached balance, and stop caching it for a while if hold is set."""
+        key = (accountAddress or '').lower()
+        now = time.monotonic()
+        with self._lock:
+            self._entries.pop(key, None)
+            # A fetch started before the change is not shared with later callers, nor cached
+            self._inflight.pop(key, None)
+            if hold:
+                self._held_until[key] = now + self.hold
+                self._held_until.move_to_end(key)
+            while self._held_until and next(iter(self._held_until.values())) <= now:
+                self._held_until.popitem(last=False)
+            self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["rpc_calls_avoided"] = stats["hits"] + stats["coalesced"]
+        return stats
+
+    def _store(self, key, held, future):
+        with self._lock:
+            # Skip results that raced with an invalidation, which detached them
+            if self._inflight.get(key) is not future:
+                return
+            del self._inflight[key]
+            # And failed fetches
+            if future.cancelled() or future.exception() is not None or held or not self.ttl:
+                return
+            self._entries[key] = (future.result(), time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._held_until.pop(key, None)
+
+
+balance_cache = BalanceCache(
+    ttl=float(os.environ.get("BALANCE_CACHE_TTL", 10)),
+    hold=float(os.environ.get("BALANCE_CACHE_HOLD", 120)),
+)
+
+async def fetch_balance(accountAddress):
+    """get_balance through the balance cache."""
+    return await balance_cache.get(accountAddress, lambda: asyncio.to_thread(traced_get_balance, accountAddress))
+
+def traced_get_balance(accountAddress):
+    # Imported on first use, see main.preload_dependencies
+    from token_balance import get_balance
+    with span("balance", "get_balance"):
+        return get_balance(accountAddress)
+
+def invalidate_account(accountAddress, hold=False):
+    """The account's balances changed: drop its cached balance and quotes."""
+    balance_cache.invalidate(accountAddress, hold)
+    quote_cache.invalidate_wallet(accountAddress)
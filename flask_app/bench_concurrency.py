@@ -0,0 +1,101 @@
+"""
+Throughput of /api/send-message under concurrent users.
+
+Runs against a server that is already started, so the same script measures
+the sync baseline and the async pipeline, e.g.:
+
+    gunicorn -w 1 -k gthread --threads 64 -b 127.0.0.1:5002 main:app
+    python bench_concurrency.py --url http://127.0.0.1:5002 --concurrency 32 --requests 256
+
+Tokens are signed locally with JWT_SECRET_KEY, one per simulated user, so the
+per-user rate limit does not skew the results. Point OPENAI_BASE_URL of the
+server at a fake upstream to benchmark without calling OpenAI.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import statistics
+import time
+import uuid
+
+import httpx
+import jwt
+
+
+def make_token(userId, secret):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return jwt.encode({
+        "sub": userId,
+        "type": "access",
+        "fresh": False,
+        "jti": str(uuid.uuid4()),
+        "iat": now,
+        "nbf": now,
+    }, secret, algorithm="HS256")
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run_user(client, url, token, userId, n_requests, message, latencies, errors):
+    headers = {"Authorization": f"Bearer {token}"}
+    conversationId = f"bench-{uuid.uuid4()}"
+    for _ in range(n_requests):
+        payload = {
+            "userId": userId,
+            "accountAddress": userId,
+            "accountName": "bench",
+            "conversationId": conversationId,
+            "user_message": message,
+            "timestamp": datetime.datetime.now().isoformat(),
+            "name": "Bench chat",
+            "isNFT": False,
+            "shelved": False,
+            "tokenURI": "tokenURI",
+            "type": "chat",
+        }
+        start = time.perf_counter()
+        try:
+            response = await client.post(f"{url}/api/send-message", json=payload, headers=headers)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError as e:
+            errors.append(str(e))
+
+
+async def main(args):
+    secret = os.environ.get("JWT_SECRET_KEY", "dev_key_please_change_in_production")
+    per_user = max(1, args.requests // args.concurrency)
+    latencies, errors = [], []
+
+    async with httpx.AsyncClient(timeout=args.timeout, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            run_user(client, args.url, make_token(f"bench-user-{i}", secret), f"bench-user-{i}", per_user, args.message, latencies, errors)
+            for i in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+
+    print(f"concurrency:  {args.concurrency}")
+    print(f"completed:    {len(latencies)}  errors: {len(errors)}")
+    print(f"elapsed:      {elapsed:.2f} s")
+    print(f"throughput:   {len(latencies) / elapsed:.2f} turns/s")
+    if latencies:
+        print(f"latency p50:  {statistics.median(latencies):.3f} s")
+        print(f"latency p95:  {percentile(latencies, 0.95):.3f} s")
+        print(f"latency p99:  {percentile(latencies, 0.99):.3f} s")
+    if errors:
+        print(f"first error:  {errors[0]}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5002")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=128)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--message", default="What is WMATIC?")
+    main_args = parser.parse_args()
+    asyncio.run(main(main_args))
@@ -0,0 +1,125 @@
+"""
+Startup time and memory of the API server.
+
+Every measure runs in a fresh interpreter. The import mode reports the time
+to import main and create the app, and the resident memory once done, with
+the dependencies loaded on first use and preloaded (PRELOAD_DEPENDENCIES=1):
+
+    python bench_startup.py import --runs 5
+
+The gunicorn mode starts gunicorn with and without --preload and reports
+the memory of each worker once it answers: RSS, and PSS, which splits the
+pages shared copy-on-write between the processes sharing them. Without
+preloading, workers load the dependencies on their first turn, so their
+memory is measured before it:
+
+    python bench_startup.py gunicorn --workers 4
+
+Run it at an earlier commit for the numbers before the app factory, where
+importing main creates the app.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+IMPORT_SNIPPET = """
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app() if hasattr(main, "create_app") else main.app
+created = time.perf_counter()
+with open("/proc/self/status") as status:
+    rss = next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+print(json.dumps({"import": imported - start, "create": created - imported, "rss_kb": rss}))
+"""
+
+
+def memory_kb(pid):
+    """(RSS, PSS) of a process in kB."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as rollup:
+        for line in rollup:
+            field, _, rest = line.partition(":")
+            if field in ("Rss", "Pss"):
+                values[field] = int(rest.split()[0])
+    return values.get("Rss", 0), values.get("Pss", 0)
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as file:
+        return [int(child) for child in file.read().split()]
+
+def wait_until_up(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def bench_import(args):
+    print(f"{'mode':<10} {'import s':>10} {'create s':>10} {'total s':>10} {'RSS MB':>10}")
+    for mode, preload in (("lazy", "0"), ("preload", "1")):
+        env = dict(os.environ, PRELOAD_DEPENDENCIES=preload)
+        runs = []
+        for _ in range(args.runs):
+            result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], env=env, capture_output=True, text=True)
+            if result.returncode:
+                sys.exit(result.stderr)
+            runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+        imported = statistics.median(run["import"] for run in runs)
+        created = statistics.median(run["create"] for run in runs)
+        rss = statistics.median(run["rss_kb"] for run in runs) / 1024
+        print(f"{mode:<10} {imported:>10.3f} {created:>10.3f} {imported + created:>10.3f} {rss:>10.1f}")
+
+def bench_gunicorn(args):
+    print(f"{'mode':<22} {'ready s':>8} {'worker RSS MB':>14} {'worker PSS MB':>14} {'total PSS MB':>13}")
+    modes = (
+        ("lazy", [], "0"),
+        ("--preload", ["--preload"], "0"),
+        ("--preload, preloaded", ["--preload"], "1"),
+    )
+    for mode, flags, preload in modes:
+        command = ["gunicorn", "-w", str(args.workers), "-k", "gthread", "--threads", "8", "-b", args.bind] + flags + ["main:app"]
+        env = dict(os.environ, PRELOAD_DEPENDENCIES=preload)
+        start = time.monotonic()
+        server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not wait_until_up(f"http://{args.bind}/", args.timeout):
+                print(f"{mode:<22} did not start")
+                continue
+            ready = time.monotonic() - start
+            # Let every worker boot
+            time.sleep(args.settle)
+            workers = [memory_kb(pid) for pid in children(server.pid)]
+            master = memory_kb(server.pid)
+            rss = statistics.mean(worker[0] for worker in workers) / 1024
+            pss = statistics.mean(worker[1] for worker in workers) / 1024
+            total = (master[1] + sum(worker[1] for worker in workers)) / 1024
+            print(f"{mode:<22} {ready:>8.2f} {rss:>14.1f} {pss:>14.1f} {total:>13.1f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=["import", "gunicorn"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--bind", default="127.0.0.1:5012")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--settle", type=float, default=2)
+    main_args = parser.parse_args()
+    if main_args.mode == "import":
+        bench_import(main_args)
+    else:
+        bench_gunicorn(main_args)
@@ -0,0 +1,128 @@
+"""
+Encode/decode time and stored size of conversations per storage format.
+
+Conversations are generated with the shape of real ones: user messages of a
+sentence, assistant answers of a few paragraphs, JSON quotes and swap
+confirmations among them. Each format is compared to the legacy one, plain
+json.dumps text:
+
+    python bench_storage.py --messages 10 100 1000 --rounds 50
+"""
+import argparse
+import json
+import random
+import statistics
+import time
+
+import storage_format
+from storage_format import StorageFormat
+
+USER_MESSAGES = [
+    "What is WMATIC?",
+    "Swap {amount} USDC for WMATIC",
+    "How much WETH do I have?",
+    "Send {amount} USDT to {address}",
+    "Quote {amount} WETH to USDC and {amount} USDC to DAI",
+    "Explain how the gas adjusted quote works, and why it differs from the estimated output.",
+]
+ASSISTANT_PARAGRAPHS = [
+    "WMATIC is the wrapped version of MATIC, the native token of the Polygon network. Wrapping makes it an ERC-20 token so it can be traded on decentralized exchanges like Uniswap.",
+    "The quote includes the gas cost of the swap converted to the output token, which is why the gas adjusted quote is lower than the estimated output.",
+    "Your balance is shown in the sidebar and refreshed after every swap or transfer. Balances are read from the Polygon network.",
+    "Please confirm the swap below. The amounts are estimates and the final amount depends on the price at execution time.",
+]
+
+
+def address(rng):
+    return "0x" + "".join(rng.choice("0123456789abcdef") for _ in range(40))
+
+def user_message(rng):
+    return rng.choice(USER_MESSAGES).format(amount=round(rng.uniform(0.1, 500), 2), address=address(rng))
+
+def assistant_message(rng):
+    if rng.random() < 0.3:
+        return json.dumps({
+            "intent": "swap_function",
+            "response": {
+                "tokenIn": rng.choice(["USDC", "WMATIC", "WETH"]),
+                "tokenOut": rng.choice(["DAI", "USDT", "WBTC"]),
+                "amount": round(rng.uniform(0.1, 500), 4),
+                "estimatedOutput": round(rng.uniform(0.1, 500), 6),
+                "gasUsedUSD": round(rng.uniform(0.001, 0.05), 4),
+                "walletAddress": address(rng),
+            },
+        })
+    text = "\n\n".join(rng.sample(ASSISTANT_PARAGRAPHS, rng.randint(1, 3)))
+    return f"{text}\n\nTransaction {address(rng)}{address(rng)[2:26]}, {round(rng.uniform(0.1, 500), 6)} received."
+
+def make_conversation(n_messages, seed=0):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(n_messages):
+        if i % 2 == 0:
+            messages.append({"role": "user", "content": user_message(rng)})
+        else:
+            messages.append({"role": "assistant", "content": assistant_message(rng)})
+    return {
+        "id": "0e6c4f3e-8b5d-4c1a-9f2e-7d3b6a1c5e90",
+        "name": "Swaps on Polygon",
+        "isNFT": False,
+        "shelved": False,
+        "tokenURI": "tokenURI",
+        "timestamp": "2024-05-01T12:00:00",
+        "type": "chat",
+        "summary": "Swapping stablecoins on Polygon",
+        "messages": messages,
+    }
+
+
+class LegacyFormat:
+    """Plain json.dumps text, as stored before the versioned format."""
+
+    def encode(self, data):
+        return json.dumps(data).encode("utf-8")
+
+    def decode(self, stored):
+        return json.loads(stored)
+
+
+def formats():
+    yield "legacy json", LegacyFormat()
+    yield "none", StorageFormat("none")
+    yield "gzip", StorageFormat("gzip")
+    if storage_format.zstandard is not None:
+        yield "zstd", StorageFormat("zstd")
+
+def timed(function, argument, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function(argument)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(args):
+    codec = "orjson" if storage_format.orjson is not None else "json"
+    print(f"JSON codec of the versioned format: {codec}")
+    if storage_format.zstandard is None:
+        print("zstandard is not installed, zstd is skipped")
+    print()
+    print(f"{'messages':>8}  {'format':<12} {'bytes':>10} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}")
+    for n_messages in args.messages:
+        conversation = make_conversation(n_messages)
+        baseline = None
+        for name, fmt in formats():
+            stored = fmt.encode(conversation)
+            assert fmt.decode(stored) == conversation
+            baseline = baseline or len(stored)
+            encode = timed(fmt.encode, conversation, args.rounds)
+            decode = timed(fmt.decode, stored, args.rounds)
+            print(f"{n_messages:>8}  {name:<12} {len(stored):>10} {len(stored) / baseline:>6.2f} {encode * 1000:>10.3f} {decode * 1000:>10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=50)
+    main(parser.parse_args())
@@ -0,0 +1,60 @@
+"""
+Assembly of the messages sent to the chat model.
+
+Stored messages already use the roles of the OpenAI API ("user",
+"assistant"), so the history is sent as it is. A ChatRequest is a view made
+of the system prompt, context messages such as the history summary, a slice
+of the stored history and trailing stage messages. Requests are never
+modified: changing the system prompt or adding a stage prompt returns a new
+request sharing the same history list, and nothing is copied until the
+request is sent.
+"""
+
+
+class ChatRequest:
+
+    __slots__ = ("system", "context", "history", "start", "stop", "extra")
+
+    def __init__(self, system=None, context=(), history=(), start=0, stop=None, extra=()):
+        self.system = system
+        self.context = tuple(context)
+        self.history = history
+        self.start = start
+        self.stop = len(history) if stop is None else stop
+        self.extra = tuple(extra)
+
+    def _replace(self, **fields):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(fields)
+        return ChatRequest(**values)
+
+    def with_system(self, content):
+        """Same request with another system prompt, None to send none."""
+        return self._replace(system=content)
+
+    def append(self, *messages):
+        """Same request followed by messages, e.g. a stage prompt."""
+        return self._replace(extra=self.extra + messages)
+
+    def last(self):
+        if self.extra:
+            return self.extra[-1]
+        return self.history[self.stop - 1]
+
+    def with_last_content(self, content):
+        """Same request with the content of its last message replaced, the stored message is left alone."""
+        message = {"role": self.last()["role"], "content": content}
+        if self.extra:
+            return self._replace(extra=self.extra[:-1] + (message,))
+        return self._replace(stop=self.stop - 1, extra=(message,))
+
+    def __iter__(self):
+        if self.system is not None:
+            yield {"role": "system", "content": self.system}
+        yield from self.context
+        for index in range(self.start, self.stop):
+            yield self.history[index]
+        yield from self.extra
+
+    def __len__(self):
+        return (self.system is not None) + len(self.context) + (self.stop - self.start) + len(self.extra)
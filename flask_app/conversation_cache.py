@@ -0,0 +1,159 @@
+"""
+In-process LRU cache sitting in front of the Google Cloud Storage helpers.
+
+Blobs are cached as the raw bytes stored on the bucket, compressed, with
+their generation, so callers always get a fresh object to mutate. Every
+worker process has its own cache, so before a cached entry is used its
+generation is checked against the bucket with a metadata-only request: a
+turn landing on another worker than the previous one reads the history
+that worker wrote, and only the download of unchanged blobs is saved.
+
+Writes are compare-and-swap: update() uploads with the generation it read
+as a precondition, and when another writer (a thread, another worker) got
+there first the entry is dropped and the update is applied again on the
+latest content. The read of an update is therefore not revalidated, a stale
+one costs a retry, never a lost update, and no lock is held across the
+read-modify-write.
+"""
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from conversation_store import ConflictError
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class CacheEntry:
+    __slots__ = ("data", "generation", "loaded_at")
+
+    def __init__(self, data, generation, loaded_at):
+        self.data = data
+        self.generation = generation
+        self.loaded_at = loaded_at
+
+
+class ConversationCache:
+    """
+    LRU cache of blob contents bounded by max_entries, entries expire after ttl seconds.
+    download(name) must return (content, generation), (None, 0) if the blob does not exist.
+    upload(name, data, generation) must write only if the blob is still at that
+    generation, 0 meaning it does not exist, and return the new generation, or
+    None when the precondition failed.
+    generation(name), when given, must return the current generation of the
+    blob without its content, 0 if it does not exist; cached entries are
+    revalidated with it before they are read.
+    """
+
+    def __init__(self, download, upload, generation=None, max_entries=1024, ttl=300, max_attempts=8):
+        self.download = download
+        self.upload = upload
+        self.generation = generation
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "revalidations": 0,
+            "stale": 0,
+            "evictions": 0,
+            "writes": 0,
+            "conflicts": 0,
+            "gcs_reads": 0,
+            "gcs_writes": 0,
+        }
+
+    def get(self, name, revalidate=True):
+        """
+        Return (content, generation) of the blob, (None, 0) if it does not exist.
+        A cached entry is used once the bucket confirmed it is still at its
+        generation, or as it is without revalidate.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and now - entry.loaded_at >= self.ttl:
+                entry = None
+
+        if entry is not None and revalidate and self.generation is not None:
+            current = self.generation(name)
+            with self._lock:
+                self._stats["revalidations"] += 1
+                if current != entry.generation:
+                    self._stats["stale"] += 1
+                    entry = None
+
+        with self._lock:
+            if entry is not None:
+                if name in self._entries:
+                    self._entries.move_to_end(name)
+                self._stats["hits"] += 1
+                return entry.data, entry.generation
+            self._stats["misses"] += 1
+
+        data, generation = self.download(name)
+        with self._lock:
+            self._stats["gcs_reads"] += 1
+            self._store(name, CacheEntry(data, generation, time.monotonic()))
+        return data, generation
+
+    def update(self, name, mutate):
+        """
+        Read-modify-write of a blob. mutate(content) gets the current content,
+        None if the blob does not exist, and returns the new content or None to
+        leave the blob as it is. It is called again on the latest content after
+        every conflict, so it must only apply its own change.
+        Returns the written content, or the current one when unchanged.
+        Raises ConflictError once max_attempts writes lost the race.
+        """
+        for attempt in range(self.max_attempts):
+            data, generation = self.get(name, revalidate=False)
+            new_data = mutate(data)
+            if new_data is None:
+                return data
+
+            new_generation = self.upload(name, new_data, generation)
+            with self._lock:
+                if new_generation is not None:
+                    self._stats["writes"] += 1
+                    self._stats["gcs_writes"] += 1
+                    self._store(name, CacheEntry(new_data, new_generation, time.monotonic()))
+                    return new_data
+                self._stats["conflicts"] += 1
+                # Someone else wrote the blob, read it again from the bucket
+                self._entries.pop(name, None)
+            log.debug("Conflicting write of %s, attempt %d", name, attempt + 1)
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+        raise ConflictError(f"Too many concurrent writes of {name}")
+
+    def invalidate(self, name):
+        """Drop an entry so the next read goes to the bucket."""
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        # Every hit is a download we did not make, revalidated hits still cost a metadata request
+        stats["gcs_downloads_saved"] = stats["hits"]
+        return stats
+
+    def _store(self, name, entry):
+        """Insert an entry and evict the least recently used ones. Caller holds the lock."""
+        current = self._entries.get(name)
+        # Keep the newest generation when a slow download races with a write
+        if current is not None and current.generation > entry.generation:
+            return
+        self._entries[name] = entry
+        self._entries.move_to_end(name)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
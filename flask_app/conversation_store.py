@@ -0,0 +1,210 @@
+"""
+Conversation storage interface.
+
+The endpoints in main.py only use the functions below, which delegate to the
+backend selected with the CONVERSATION_BACKEND environment variable:
+
+    gcs     Google Cloud Storage, one object per conversation (default)
+    sqlite  Local SQLite database at SQLITE_PATH, for local deployments and tests
+    memory  The GCS backend on an in-memory bucket with the same generation
+            semantics, for tests and benchmarks
+
+A conversation is a dict with the metadata in INDEX_FIELDS plus its
+"messages" list, the index is a dict of conversation metadata keyed by
+conversation id in creation order. Message roles are the ones of the OpenAI
+API, "user" and "assistant"; records written with the legacy "Me" and "AI"
+roles are migrated by the backends when they are read.
+
+Several requests of the same user may write a conversation at once (two
+tabs, a metadata update during a chat). Writes therefore carry only their
+own change, appended messages or metadata fields, and the backends apply
+it atomically: a transaction for SQLite, a compare-and-swap on the object
+generation for GCS, retried on the latest content when it lost the race.
+
+The sidebar only needs the index: conversation_page() lists it newest
+first, a page at a time, and index_version() changes whenever it does, so
+unchanged listings can be answered without reading or serializing them.
+"""
+import base64
+import hashlib
+import json
+import os
+
+from tracing import span
+
+# Metadata kept in the per-user index
+INDEX_FIELDS = ("id", "name", "isNFT", "shelved", "tokenURI", "timestamp", "type", "summary")
+
+# Roles written by earlier versions, and their API form
+LEGACY_ROLES = {"Me": "user", "AI": "assistant"}
+
+
+class ConflictError(Exception):
+    """A write kept losing the race against concurrent writes of the same conversation."""
+
+
+def conversation_metadata(conversation):
+    """Extract the index entry of a conversation (everything but the messages)."""
+    return {field: conversation[field] for field in INDEX_FIELDS if field in conversation}
+
+
+def encode_cursor(metadata, conversationId):
+    """Opaque cursor of a listing page, the position of its last conversation."""
+    position = [str(metadata.get('timestamp') or ''), conversationId]
+    return base64.urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """Position encoded by encode_cursor, raises ValueError if the cursor is malformed."""
+    try:
+        timestamp, conversationId = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    return str(timestamp), str(conversationId)
+
+
+def migrate_roles(messages):
+    """Rewrite legacy roles in place, returns True if a message changed."""
+    changed = False
+    for message in messages:
+        role = LEGACY_ROLES.get(message['role'])
+        if role is not None:
+            message['role'] = role
+            changed = True
+    return changed
+
+
+class ConversationBackend:
+    """Interface implemented by the storage backends."""
+
+    def load_index(self, userId):
+        """Return the user's conversation metadata keyed by conversation id."""
+        raise NotImplementedError
+
+    def load_conversation(self, userId, conversationId):
+        """Return a single conversation, or None if it does not exist."""
+        raise NotImplementedError
+
+    def save_conversation(self, userId, conversation, update_index=False):
+        """
+        Write a whole conversation, replacing whatever is stored. update_index
+        must be set when the conversation is new or its metadata changed.
+        """
+        raise NotImplementedError
+
+    def create_conversation(self, userId, conversation):
+        """Write a new conversation. Returns False, writing nothing, if it already exists."""
+        raise NotImplementedError
+
+    def append_messages(self, userId, conversationId, messages):
+        """Append messages to an existing conversation. Returns False if it does not exist."""
+        raise NotImplementedError
+
+    def update_metadata(self, userId, conversationId, fields):
+        """Update metadata fields of a conversation, returns it or None if it does not exist."""
+        conversation = self.load_conversation(userId, conversationId)
+        if conversation is None:
+            return None
+        conversation.update(fields)
+        self.save_conversation(userId, conversation, update_index=True)
+        return conversation
+
+    def index_version(self, userId):
+        """Opaque value changing whenever the user's index does."""
+        index = self.load_index(userId)
+        return hashlib.sha1(json.dumps(index, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def load_messages(self, userId, conversationId, start=0, stop=None):
+        """Return (messages[start:stop], total number of messages), None if the conversation does not exist."""
+        conversation = self.load_conversation(userId, conversationId)
+        if conversation is None:
+            return None
+        messages = conversation['messages']
+        return messages[start:stop], len(messages)
+
+    def stats(self):
+        """Backend specific counters."""
+        return {}
+
+
+_backend = None
+
+def create_backend(name=None):
+    """Instantiate a backend by name, importing only the client library it needs."""
+    name = name or os.environ.get("CONVERSATION_BACKEND", "gcs")
+    if name == "gcs":
+        from gcs_store import GCSConversationBackend
+        return GCSConversationBackend(os.environ.get("GCS_BUCKET", "feelan_storage"))
+    if name == "memory":
+        from gcs_store import GCSConversationBackend
+        from memory_bucket import MemoryBucket
+        return GCSConversationBackend(bucket=MemoryBucket())
+    if name == "sqlite":
+        from sqlite_store import SQLiteConversationBackend
+        return SQLiteConversationBackend(os.environ.get("SQLITE_PATH", "conversations.db"))
+    raise ValueError(f"Unknown conversation backend: {name}")
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
+
+def set_backend(backend):
+    """Replace the active backend, e.g. with a SQLite one in tests."""
+    global _backend
+    _backend = backend
+
+
+def load_index(userId):
+    with span("storage", "load_index"):
+        return get_backend().load_index(userId)
+
+def load_conversation(userId, conversationId):
+    with span("storage", "load_conversation"):
+        return get_backend().load_conversation(userId, conversationId)
+
+def save_conversation(userId, conversation, update_index=False):
+    with span("storage", "save_conversation"):
+        return get_backend().save_conversation(userId, conversation, update_index)
+
+def create_conversation(userId, conversation):
+    with span("storage", "create_conversation"):
+        return get_backend().create_conversation(userId, conversation)
+
+def append_messages(userId, conversationId, messages):
+    with span("storage", "append_messages"):
+        return get_backend().append_messages(userId, conversationId, messages)
+
+def update_metadata(userId, conversationId, fields):
+    with span("storage", "update_metadata"):
+        return get_backend().update_metadata(userId, conversationId, fields)
+
+def conversation_page(userId, cursor=None, limit=50):
+    """
+    Metadata of the user's conversations, newest first, limit at a time.
+    Returns (page, cursor of the next page or None). Raises ValueError for a malformed cursor.
+    """
+    with span("storage", "load_index"):
+        index = get_backend().load_index(userId)
+    ordered = sorted(
+        (((str(metadata.get('timestamp') or ''), conversationId), metadata) for conversationId, metadata in index.items()),
+        key=lambda entry: entry[0],
+        reverse=True,
+    )
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        ordered = [entry for entry in ordered if entry[0] < position]
+    page = [dict(metadata, id=conversationId) for (_, conversationId), metadata in ordered[:limit]]
+    next_cursor = encode_cursor(page[-1], page[-1]['id']) if len(ordered) > limit else None
+    return page, next_cursor
+
+def index_version(userId):
+    with span("storage", "index_version"):
+        return get_backend().index_version(userId)
+
+def load_messages(userId, conversationId, start=0, stop=None):
+    with span("storage", "load_messages"):
+        return get_backend().load_messages(userId, conversationId, start, stop)
+
+def storage_stats():
+    return get_backend().stats()
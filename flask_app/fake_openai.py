@@ -0,0 +1,163 @@
+"""
+Fake OpenAI chat completions server, to reproduce slow and failing upstreams.
+
+Point the API server at it and load it with bench_concurrency.py:
+
+    python fake_openai.py --port 8089 --latency 0.5 --slow-rate 0.05 --slow-latency 20 --error-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 gunicorn -w 1 -k gthread --threads 64 -b 127.0.0.1:5002 main:app
+    python bench_concurrency.py --url http://127.0.0.1:5002 --concurrency 32 --requests 256
+
+Every completion answers a user-assistance intent, streamed or not. A
+fraction of the requests is slow, fails with --error-status, or is rate
+limited with a Retry-After header. The tests start it on a free port with
+start_server().
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = json.dumps({"intent": "user-assistance", "response": "This is a canned answer of the fake OpenAI server."})
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = None
+    counters = {"requests": 0, "slow": 0, "errors": 0, "rate_limited": 0}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+            return self.counters[key]
+
+    def do_GET(self):
+        if self.path.rstrip('/') == "/stats":
+            with self.lock:
+                self.send_json(200, dict(self.counters))
+        else:
+            self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            return self.send_json(404, {"error": {"message": "Not found"}})
+        number = self.count("requests")
+        options = self.options
+
+        draw = random.random()
+        if draw < options.rate_limit_rate:
+            self.count("rate_limited")
+            return self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                  {"Retry-After": str(options.retry_after)})
+        if draw < options.rate_limit_rate + options.error_rate:
+            self.count("errors")
+            return self.send_json(options.error_status, {"error": {"message": "The server had an error", "type": "server_error"}})
+
+        latency = options.latency
+        if number <= options.slow_first or random.random() < options.slow_rate:
+            self.count("slow")
+            latency = options.slow_latency
+        time.sleep(latency)
+
+        model = body.get("model", "gpt-4-turbo")
+        usage = {"prompt_tokens": sum(len(m.get("content") or "") // 4 for m in body.get("messages", [])),
+                 "completion_tokens": len(ANSWER) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if body.get("stream"):
+            self.send_stream(model, usage, body.get("stream_options") or {})
+        else:
+            self.send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, model, usage, stream_options):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        def chunk(choices, usage=None):
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": choices, "usage": usage}
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        for i in range(0, len(ANSWER), 16):
+            chunk([{"index": 0, "delta": {"content": ANSWER[i:i + 16]}, "finish_reason": None}])
+            time.sleep(self.options.token_delay)
+        chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if stream_options.get("include_usage"):
+            chunk([], usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before answering")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of slow requests")
+    parser.add_argument("--slow-latency", type=float, default=20.0, help="seconds before answering a slow request")
+    parser.add_argument("--slow-first", type=int, default=0, help="number of first requests that are slow")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failed requests")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument("--retry-after", type=int, default=5, help="Retry-After of the 429 responses")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed chunks")
+    return parser
+
+def start_server(**options):
+    """
+    Serve in a background thread with the default options overridden by
+    options, on a free port unless one is given. Returns the server, its
+    handler class has the options and counters of this server.
+    """
+    args = build_parser().parse_args([])
+    args.port = 0
+    vars(args).update(options)
+    handler = type("FakeOpenAIHandler", (FakeOpenAIHandler,), {
+        "options": args,
+        "counters": dict.fromkeys(FakeOpenAIHandler.counters, 0),
+        "lock": threading.Lock(),
+    })
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    args = build_parser().parse_args()
+
+    FakeOpenAIHandler.options = args
+    server = ThreadingHTTPServer((args.host, args.port), FakeOpenAIHandler)
+    print(f"Fake OpenAI server on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Google Cloud Storage conversation backend.
+
+Every conversation is stored as its own object and each user has a small
+index holding only the metadata needed by the sidebar:
+
+    data/users/conversations/{userId}/index.json
+    data/users/conversations/{userId}/{conversationId}.json
+
+so a chat turn only reads and writes the conversation it touches.
+
+Every write is a compare-and-swap: the object is uploaded with the
+generation it was read at as a precondition (if_generation_match), and a
+write that lost the race is applied again on the latest content. Appends
+and metadata updates only carry their own change, so concurrent turns of
+the same user never overwrite each other and no lock is needed.
+
+Objects are stored in the versioned, compressed format of storage_format;
+the .json names are kept, and objects written as plain JSON are still read.
+
+Users still on the old layout, a single
+data/users/conversations/{userId}_conversations.json blob with every
+conversation and message, are migrated the first time their index is loaded.
+"""
+import os
+
+try:
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+except ImportError:
+    # Only the in-memory bucket can be used without the Cloud Storage SDK
+    from memory_bucket import NotFound, PreconditionFailed
+
+from conversation_cache import ConversationCache
+from conversation_store import ConversationBackend, conversation_metadata, migrate_roles
+from logs import get_logger
+from storage_format import storage_format
+from tracing import span
+
+log = get_logger(__name__)
+
+
+# Blob layout
+def legacy_blob_path(userId):
+    return f"data/users/conversations/{userId}_conversations.json"
+
+def index_blob_path(userId):
+    return f"data/users/conversations/{userId}/index.json"
+
+def conversation_blob_path(userId, conversationId):
+    return f"data/users/conversations/{userId}/{conversationId}.json"
+
+
+class GCSConversationBackend(ConversationBackend):
+
+    def __init__(self, bucket_name=None, bucket=None):
+        if bucket is None:
+            # Configure Google Cloud Storage
+            from google.cloud import storage
+            self.storage_client = storage.Client()
+            bucket = self.storage_client.bucket(bucket_name)
+        self.bucket = bucket
+
+        # Cache in front of the bucket, writes go through it with their generation precondition
+        self.cache = ConversationCache(
+            download=self.download_blob_or_none,
+            upload=self.upload_string_as_blob,
+            generation=self.blob_generation if os.environ.get("CONVERSATION_CACHE_REVALIDATE", "1") == "1" else None,
+            max_entries=int(os.environ.get("CONVERSATION_CACHE_SIZE", 1024)),
+            ttl=float(os.environ.get("CONVERSATION_CACHE_TTL", 300)),
+            max_attempts=int(os.environ.get("CONVERSATION_WRITE_ATTEMPTS", 8)),
+        )
+
+    # Google Cloud Storage helper functions
+    def download_blob_as_string(self, source_blob_name):
+        """Downloads a blob from the bucket as a string, returns (content, generation)."""
+        blob = self.bucket.blob(source_blob_name)
+        with span("gcs", "download"):
+            data = blob.download_as_bytes()
+        # The generation comes with the response headers of the download
+        return data, blob.generation
+
+    def upload_string_as_blob(self, destination_blob_name, data_string, generation):
+        """
+        Uploads a string to a blob if it is still at generation, 0 meaning it must not exist.
+        Returns the new generation, None if the blob changed in the meantime.
+        """
+        blob = self.bucket.blob(destination_blob_name)
+        try:
+            with span("gcs", "upload"):
+                blob.upload_from_string(data_string, content_type="application/octet-stream", if_generation_match=generation)
+        except PreconditionFailed:
+            return None
+        return blob.generation
+
+    def blob_generation(self, blob_name):
+        """Current generation of a blob from its metadata, 0 if it does not exist."""
+        with span("gcs", "metadata"):
+            blob = self.bucket.get_blob(blob_name)
+        return blob.generation if blob is not None else 0
+
+    def blob_exists(self, blob_name):
+        """Check if a blob exists in the given bucket."""
+        blob = self.bucket.blob(blob_name)
+        return blob.exists()
+
+    def download_blob_or_none(self, source_blob_name):
+        """Downloads a blob as (content, generation), (None, 0) if it does not exist."""
+        try:
+            return self.download_blob_as_string(source_blob_name)
+        except NotFound:
+            return None, 0
+
+    def read_json_blob(self, blob_name, default=None):
+        """
+        Download and parse a JSON blob through the cache.
+        Returns default when the blob does not exist or is empty.
+        """
+        stored, _ = self.cache.get(blob_name)
+        if not stored:
+            return default
+        with span("json", "decode"):
+            return storage_format.decode(stored)
+
+    def update_json_blob(self, blob_name, mutate):
+        """
+        Compare-and-swap update of a JSON blob. mutate(data) gets the parsed
+        content, None if the blob does not exist, and returns the new content
+        or None to leave it unchanged. It is applied again on the latest
+        content when another writer got there first.
+        Returns the content after the update.
+        """
+        result = []
+
+        def apply(stored):
+            with span("json", "decode"):
+                data = storage_format.decode(stored) if stored else None
+            updated = mutate(data)
+            result[:] = [data if updated is None else updated]
+            if updated is None:
+                return None
+            with span("json", "encode"):
+                return storage_format.encode(updated)
+
+        self.cache.update(blob_name, apply)
+        return result[0]
+
+    def write_json_blob(self, blob_name, data):
+        """Replace the content of a JSON blob, whatever its generation."""
+        self.update_json_blob(blob_name, lambda current: data)
+
+    def migrate_legacy_conversations(self, userId):
+        """
+        Split the old {userId}_conversations.json blob into one object per
+        conversation and write the index. The legacy blob is left untouched.
+        Returns the new index, empty if the user has no legacy data.
+        """
+        conversations = self.read_json_blob(legacy_blob_path(userId), default=[])
+        index = {}
+        for conv in conversations:
+            migrate_roles(conv['messages'])
+            # A concurrent migration, or a turn that already wrote the new object, wins
+            self.update_json_blob(conversation_blob_path(userId, conv['id']), lambda current, conv=conv: conv if current is None else None)
+            index[conv['id']] = conversation_metadata(conv)
+
+        if index:
+            index = self.update_json_blob(index_blob_path(userId), lambda current: index if current is None else None)
+            log.info("Migrated %d conversations of %s to the per-conversation layout", len(index), userId)
+        return index
+
+    def load_index(self, userId):
+        """Load the user's index, migrating the legacy blob on first access."""
+        index = self.read_json_blob(index_blob_path(userId))
+        if index is None:
+            index = self.migrate_legacy_conversations(userId)
+        return index
+
+    def save_index_entry(self, userId, conversation):
+        """Insert or refresh the index entry of a conversation, writing only if it changed."""
+        metadata = conversation_metadata(conversation)
+        if self.load_index(userId).get(conversation['id']) == metadata:
+            return
+
+        def set_entry(index):
+            index = index or {}
+            if index.get(conversation['id']) == metadata:
+                return None
+            index[conversation['id']] = metadata
+            return index
+
+        self.update_json_blob(index_blob_path(userId), set_entry)
+
+    def load_conversation(self, userId, conversationId):
+        conversation = self.read_json_blob(conversation_blob_path(userId, conversationId))
+        if conversation is None and self.load_index(userId).get(conversationId):
+            # Index was just migrated from the legacy blob, read the new object
+            conversation = self.read_json_blob(conversation_blob_path(userId, conversationId))
+        # Legacy roles are rewritten on the bucket with the next write of the conversation
+        if conversation is not None:
+            migrate_roles(conversation['messages'])
+        return conversation
+
+    def save_conversation(self, userId, conversation, update_index=False):
+        self.write_json_blob(conversation_blob_path(userId, conversation['id']), conversation)
+        if update_index:
+            self.save_index_entry(userId, conversation)
+
+    def create_conversation(self, userId, conversation):
+        # Legacy conversations must be migrated before we can tell whether it exists
+        self.load_index(userId)
+        created = self.update_json_blob(
+            conversation_blob_path(userId, conversation['id']),
+            lambda current: conversation if current is None else None,
+        ) is conversation
+        if created:
+            self.save_index_entry(userId, conversation)
+        return created
+
+    def append_messages(self, userId, conversationId, messages):
+        # Objects are immutable on the bucket, the read is usually served by the cache
+        if self.load_conversation(userId, conversationId) is None:
+            return False
+
+        def append(conversation):
+            if conversation is None:
+                return None
+            migrate_roles(conversation['messages'])
+            conversation['messages'].extend(messages)
+            return conversation
+
+        return self.update_json_blob(conversation_blob_path(userId, conversationId), append) is not None
+
+    def update_metadata(self, userId, conversationId, fields):
+        if self.load_conversation(userId, conversationId) is None:
+            return None
+
+        def update(conversation):
+            if conversation is None:
+                return None
+            migrate_roles(conversation['messages'])
+            conversation.update(fields)
+            return conversation
+
+        conversation = self.update_json_blob(conversation_blob_path(userId, conversationId), update)
+        if conversation is not None:
+            self.save_index_entry(userId, conversation)
+        return conversation
+
+    def index_version(self, userId):
+        # The index object gets a new generation whenever it is written, read from
+        # the bucket since other workers write it too
+        generation = self.blob_generation(index_blob_path(userId))
+        if not generation:
+            self.load_index(userId)
+            generation = self.blob_generation(index_blob_path(userId))
+        return str(generation)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,81 @@
+"""
+Sliding-window compaction of the conversation history sent to the model.
+
+The last HISTORY_KEEP_TURNS turns are sent verbatim and older messages are
+replaced by a rolling summary, kept in the conversation's "history" field:
+    {"summary": text, "summarized": number of leading messages it covers}
+The summary is extended after a turn once HISTORY_SUMMARY_BATCH messages
+have left the window, so it may lag behind: messages it does not cover yet
+are still sent verbatim.
+
+A swap or transfer the model asked the user to confirm is kept verbatim
+for the next turn, which executes, replaces, declines or abandons it. The
+index of the turn that asked for it is kept in the conversation's
+"pendingConfirmation" field, and cleared by any turn not asking for another
+confirmation, so a declined quote does not pin the history.
+
+Configuration:
+    HISTORY_KEEP_TURNS      turns sent verbatim (default 6, 0 disables compaction)
+    HISTORY_SUMMARY_BATCH   messages leaving the window before the summary is extended (default 4)
+"""
+import os
+
+KEEP_TURNS = int(os.environ.get("HISTORY_KEEP_TURNS", 6))
+SUMMARY_BATCH = int(os.environ.get("HISTORY_SUMMARY_BATCH", 4))
+
+# Intents answered with a swap or transfer to confirm
+CONFIRMATION_INTENTS = ("swap_intent", "multiswap_intent", "transfer_token")
+
+SUMMARY_INSTRUCTION = (
+    "Update the summary of the earlier conversation with the messages above. Answer with the summary only, "
+    "in a few sentences, keeping the tokens, amounts, accounts and decisions of the user."
+)
+
+
+def history_state(conversation):
+    """Rolling summary of a conversation, conversation may be None."""
+    history = (conversation or {}).get('history') or {}
+    return {"summary": history.get('summary', ''), "summarized": history.get('summarized', 0)}
+
+def summary_message(summary):
+    """System message carrying the summary of the messages that are not sent."""
+    return {"role": "system", "content": "Summary of the earlier conversation: " + summary}
+
+def window_start(messages, keep_turns=KEEP_TURNS):
+    """Index of the first message of the last keep_turns turns, a turn starts with a user message."""
+    if not keep_turns:
+        return 0
+    turns = 0
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index]['role'] == "user":
+            turns += 1
+            if turns == keep_turns:
+                return index
+    return 0
+
+def compact_history(messages, conversation):
+    """
+    Split the messages of a conversation for the model call.
+    Returns (summary message or None, index of the first message to send verbatim).
+    """
+    state = history_state(conversation)
+    start = min(window_start(messages), state['summarized'])
+    pending = (conversation or {}).get('pendingConfirmation')
+    if pending is not None:
+        start = min(start, pending)
+    if not start:
+        return None, 0
+    return summary_message(state['summary']), start
+
+def track_confirmation(intent, turn_start):
+    """Index of the pending confirmation once a turn starting at turn_start is handled, None if there is none."""
+    if intent in CONFIRMATION_INTENTS:
+        return turn_start
+    return None
+
+def summary_end(messages, conversation):
+    """End of the messages the summary should cover, None if it does not need to be extended yet."""
+    end = window_start(messages)
+    if end - history_state(conversation)['summarized'] < max(SUMMARY_BATCH, 1):
+        return None
+    return end
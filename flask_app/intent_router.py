@@ -0,0 +1,253 @@
+"""
+Local intent router, answering obvious intents without the first model call.
+
+Rules cover balance questions, queries of a single name of a process and
+short confirmations of the swap quoted in the previous turn. A small naive
+Bayes classifier, trained on the turns logged with the intent the model gave
+them, covers the other intents whose handler needs nothing from the model.
+Predictions below INTENT_ROUTER_THRESHOLD fall back to the model.
+
+When the model is called, the router's prediction is compared with the
+model's intent to report per-intent precision and recall. In "on" mode a
+fraction of the confident predictions still goes to the model for that.
+
+Configuration:
+    INTENT_ROUTER               on (default), shadow to only measure, or off
+    INTENT_ROUTER_THRESHOLD     confidence needed to skip the model (default 0.9)
+    INTENT_ROUTER_SAMPLE_RATE   fraction of routed turns also sent to the model (default 0.05)
+    INTENT_MODEL_PATH           classifier trained with `python intent_router.py train`
+    INTENT_LOG_PATH             JSON lines file where the model-labelled turns are logged
+
+Training:
+    python intent_router.py train --log intent_log.jsonl --out intent_model.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+from collections import Counter
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+# Intents the classifier may dispatch, their handler does not use the model's response
+CLASSIFIER_INTENTS = ("account_balance",)
+
+TRADE_WORDS = re.compile(r"\b(swap|buy|sell|exchange|send|transfer|trade|convert)\b", re.IGNORECASE)
+BALANCE_QUESTION = re.compile(
+    r"^(?:what(?:'s| is) )?(?:my |the )?(?:account |wallet |token )?balances?\??$"
+    r"|\b(?:show|check|what(?:'s| is| are)) (?:me )?(?:my|the account'?s?) (?:token )?balances?\b"
+    r"|\bhow much \w+ (?:do i have|have i got|is in my (?:account|wallet))\b",
+    re.IGNORECASE,
+)
+CONFIRMATION = re.compile(
+    r"^(?:yes|yep|yeah|sure|ok|okay|confirm(?:ed)?|go ahead|do it|proceed|let'?s do it|swap it)(?: please)?[.! ]*$",
+    re.IGNORECASE,
+)
+# A single name or field, free-form queries go to the model which extracts the name from them
+PROCESS_QUERY = re.compile(r"^query (?P<query>#?[A-Za-z_]\w*(?:\.\w+)*)\s*[?.!]?$", re.IGNORECASE)
+
+WORD = re.compile(r"[a-z0-9.]+")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+class IntentClassifier:
+    """Multinomial naive Bayes over the words of the user message."""
+
+    def __init__(self, priors=None, word_counts=None, totals=None, vocabulary=None):
+        self.priors = priors or {}
+        self.word_counts = word_counts or {}
+        self.totals = totals or {}
+        self.vocabulary = vocabulary or 0
+
+    @classmethod
+    def fit(cls, samples):
+        """Train on (message, intent) pairs."""
+        intents = Counter(intent for _, intent in samples)
+        word_counts = {intent: Counter() for intent in intents}
+        for message, intent in samples:
+            word_counts[intent].update(tokenize(message))
+        vocabulary = len(set().union(*word_counts.values())) if word_counts else 0
+        return cls(
+            priors={intent: count / len(samples) for intent, count in intents.items()},
+            word_counts={intent: dict(counts) for intent, counts in word_counts.items()},
+            totals={intent: sum(counts.values()) for intent, counts in word_counts.items()},
+            vocabulary=vocabulary,
+        )
+
+    def predict(self, message):
+        """Return (intent, probability), or None if the classifier is empty."""
+        if not self.priors:
+            return None
+        words = tokenize(message)
+        scores = {}
+        for intent, prior in self.priors.items():
+            counts, denominator = self.word_counts[intent], self.totals[intent] + self.vocabulary + 1
+            scores[intent] = math.log(prior) + sum(math.log((counts.get(word, 0) + 1) / denominator) for word in words)
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / total
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.__dict__, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls(**json.load(file))
+
+
+class Prediction:
+
+    def __init__(self, intent, response, confidence, source):
+        self.intent = intent
+        self.response = response
+        self.confidence = confidence
+        self.source = source
+
+    def ai_response(self):
+        """The prediction in the form of a parsed model answer."""
+        return {"intent": self.intent, "response": self.response}
+
+
+class IntentRouter:
+
+    def __init__(self, mode="on", threshold=0.9, sample_rate=0.05, model_path=None, log_path=None):
+        self.mode = mode
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.model_path = model_path
+        self.log_path = log_path
+
+        self._classifier = None
+        self._lock = threading.Lock()
+        self._stats = {"routed": 0, "sampled": 0, "model_calls": 0, "rule": 0, "classifier": 0}
+        # intent -> [true positives, false positives, false negatives], against the model's intents
+        self._evaluation = {}
+
+    def classifier(self):
+        if self._classifier is None:
+            classifier = IntentClassifier()
+            if self.model_path and os.path.exists(self.model_path):
+                classifier = IntentClassifier.load(self.model_path)
+                log.info("Intent classifier loaded from %s", self.model_path)
+            self._classifier = classifier
+        return self._classifier
+
+    def predict(self, message, last_quote_request=None):
+        """Best local guess of the intent of a message, None when there is none."""
+        if self.mode == "off":
+            return None
+        text = message.strip()
+        if last_quote_request is not None and CONFIRMATION.match(text):
+            return Prediction("swap_function", dict(last_quote_request), 1.0, "rule")
+        query = PROCESS_QUERY.match(text)
+        if query:
+            return Prediction("query-process", {"query": query.group('query')}, 1.0, "rule")
+        if TRADE_WORDS.search(text):
+            return None
+        if BALANCE_QUESTION.search(text):
+            return Prediction("account_balance", "", 1.0, "rule")
+
+        guess = self.classifier().predict(text)
+        if guess is None:
+            return None
+        intent, probability = guess
+        return Prediction(intent, "", probability, "classifier")
+
+    def confident(self, prediction):
+        if prediction is None or prediction.confidence < self.threshold:
+            return False
+        return prediction.source == "rule" or prediction.intent in CLASSIFIER_INTENTS
+
+    def dispatch(self, prediction):
+        """Whether the turn goes straight to the handler of the predicted intent."""
+        if self.mode != "on" or not self.confident(prediction):
+            return False
+        if random.random() < self.sample_rate:
+            self._count("sampled")
+            return False
+        self._count("routed")
+        self._count(prediction.source)
+        return True
+
+    def observe(self, message, prediction, model_intent):
+        """Record the model's intent for a turn the router did not dispatch."""
+        self._count("model_calls")
+        if model_intent is None:
+            return
+        predicted = prediction.intent if self.confident(prediction) else None
+        with self._lock:
+            if predicted is not None:
+                counts = self._evaluation.setdefault(predicted, [0, 0, 0])
+                counts[0 if predicted == model_intent else 1] += 1
+            if predicted != model_intent:
+                self._evaluation.setdefault(model_intent, [0, 0, 0])[2] += 1
+        if self.log_path:
+            with self._lock, open(self.log_path, 'a') as file:
+                file.write(json.dumps({"message": message, "intent": model_intent}) + "\n")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            evaluation = {intent: list(counts) for intent, counts in self._evaluation.items()}
+        stats["intents"] = {
+            intent: {
+                "precision": round(tp / (tp + fp), 3) if tp + fp else None,
+                "recall": round(tp / (tp + fn), 3) if tp + fn else None,
+                "support": tp + fn,
+            }
+            for intent, (tp, fp, fn) in evaluation.items()
+        }
+        return stats
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+
+intent_router = IntentRouter(
+    mode=os.environ.get("INTENT_ROUTER", "on"),
+    threshold=float(os.environ.get("INTENT_ROUTER_THRESHOLD", 0.9)),
+    sample_rate=float(os.environ.get("INTENT_ROUTER_SAMPLE_RATE", 0.05)),
+    model_path=os.environ.get("INTENT_MODEL_PATH"),
+    log_path=os.environ.get("INTENT_LOG_PATH"),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the intent classifier on the logged turns.")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--log", default=os.environ.get("INTENT_LOG_PATH", "intent_log.jsonl"))
+    parser.add_argument("--out", default=os.environ.get("INTENT_MODEL_PATH", "intent_model.json"))
+    args = parser.parse_args()
+
+    with open(args.log) as file:
+        samples = [(turn["message"], turn["intent"]) for turn in map(json.loads, file) if turn.get("intent")]
+    if not samples:
+        raise SystemExit(f"No labelled turns in {args.log}")
+
+    # Hold out every fifth turn to report the accuracy of the confident predictions
+    train = [sample for i, sample in enumerate(samples) if i % 5]
+    test = [sample for i, sample in enumerate(samples) if not i % 5]
+    router = IntentRouter(threshold=intent_router.threshold)
+    router._classifier = IntentClassifier.fit(train)
+    for message, intent in test:
+        prediction = router.predict(message)
+        router.observe(message, prediction, intent)
+    print(json.dumps(router.stats()["intents"], indent=2))
+
+    IntentClassifier.fit(samples).save(args.out)
+    print(f"Trained on {len(samples)} turns, saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+Persistent queue of background jobs, for the model work no request waits on:
+conversation titles and the rolling history summary.
+
+Jobs are rows of a local SQLite database, shared by the worker processes of
+the server, so they survive a restart. Each process runs a pool of worker
+threads, started on first use, that claim the pending jobs of a kind in
+batches of up to the batch size of the kind and hand them to its handler in
+one call, so the titles of several conversations are asked in one model call.
+
+A job has a key, e.g. the conversation it works on: enqueueing a job whose
+key is already pending returns the pending job, and a job is not claimed
+while another one with the same key is running. A claimed job is leased:
+when its worker dies, it is claimed again once the lease expired. A batch
+whose handler failed is retried with a backoff, up to JOB_MAX_ATTEMPTS.
+
+Finished jobs keep their result for JOB_RETENTION_SECONDS so clients can
+poll it.
+
+Configuration:
+    JOB_QUEUE_PATH          SQLite database of the queue (default jobs.db)
+    JOB_WORKERS             worker threads per process (default 2)
+    JOB_POLL_SECONDS        interval of the workers looking for jobs enqueued by other processes (default 1)
+    JOB_LEASE_SECONDS       time a claimed job is reserved for its worker (default 300)
+    JOB_MAX_ATTEMPTS        attempts of a job before it fails (default 3)
+    JOB_RETENTION_SECONDS   time finished jobs are kept (default 3600)
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+from logs import get_logger
+from sqlite_store import Transaction
+from tracing import finish_trace, set_status, start_trace
+
+log = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, kind, run_at);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (kind, key, status);
+"""
+
+# Status of a job; run_at is when a pending job may run, and when the lease of a running one expires
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+
+class Job:
+    __slots__ = ("id", "kind", "key", "payload", "status", "result", "error", "attempts")
+
+    def __init__(self, id, kind, key, payload, status, result, error, attempts):
+        self.id = id
+        self.kind = kind
+        self.key = key
+        self.payload = json.loads(payload)
+        self.status = status
+        self.result = json.loads(result) if result is not None else None
+        self.error = error
+        self.attempts = attempts
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+
+JOB_COLUMNS = "id, kind, key, payload, status, result, error, attempts"
+
+
+class JobQueue:
+
+    def __init__(self, path, workers=2, poll_interval=1.0, lease=300, max_attempts=3, retention=3600):
+        self.path = path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retention = retention
+
+        self._handlers = {}
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stats = {
+            "enqueued": 0,
+            "deduplicated": 0,
+            "batches": 0,
+            "completed": 0,
+            "retried": 0,
+            "failed": 0,
+        }
+
+    @property
+    def conn(self):
+        """One connection per thread and process, sqlite3 connections are not thread safe."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def register(self, kind, handler, batch_size=1, delay=0):
+        """
+        Run the jobs of a kind with handler(jobs), given up to batch_size claimed
+        jobs at once. It returns a dict of the JSON result of each job by job id;
+        jobs missing from it are retried, and so are all of them when it raises.
+        Jobs wait delay seconds once enqueued, so the ones enqueued together are batched.
+        """
+        self._handlers[kind] = (handler, batch_size, delay)
+
+    def enqueue(self, kind, key, payload):
+        """Add a job, or return the id of the pending job with the same key."""
+        self.start()
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND key = ? AND status = ?", (kind, key, PENDING)
+            ).fetchone()
+            if row is not None:
+                self._count("deduplicated")
+                return row[0]
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, key, payload, status, run_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, key, json.dumps(payload), PENDING, now + self._handlers[kind][2], now),
+            )
+        self._count("enqueued")
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """The job with this id, None if it does not exist or expired."""
+        row = self.conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(*row) if row is not None else None
+
+    def start(self):
+        """Start the worker threads of this process, once. Safe to call after a fork."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True).start()
+
+    def transaction(self):
+        return Transaction(self.conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        # Jobs in the queue by status, of every process
+        stats["queue"] = {status: 0 for status in (PENDING, RUNNING, DONE, FAILED)}
+        stats["queue"].update(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return stats
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _work(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed = self._claim()
+            except sqlite3.Error as e:
+                log.warning("Could not claim jobs: %s", e)
+                claimed = None
+            if claimed is None:
+                self._wakeup.wait(self.poll_interval)
+                continue
+            self._run(*claimed)
+
+    def _claim(self):
+        """Lease a batch of ready jobs of one kind, returns (kind, jobs) or None."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (DONE, FAILED, now - self.retention)
+            )
+            for kind, (handler, batch_size, delay) in self._handlers.items():
+                # Jobs of a dead worker are claimed again once their lease expired
+                rows = conn.execute(
+                    f"""SELECT {JOB_COLUMNS} FROM jobs
+                    WHERE kind = ? AND ((status = ? AND run_at <= ?) OR (status = ? AND run_at < ?))
+                    AND key NOT IN (SELECT key FROM jobs WHERE kind = ? AND status = ? AND run_at >= ?)
+                    ORDER BY run_at LIMIT ?""",
+                    (kind, PENDING, now, RUNNING, now, kind, RUNNING, now, batch_size),
+                ).fetchall()
+                if not rows:
+                    continue
+                conn.executemany(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, run_at = ?, updated_at = ? WHERE id = ?",
+                    [(RUNNING, now + self.lease, now, row[0]) for row in rows],
+                )
+                return kind, [Job(*row) for row in rows]
+        return None
+
+    def _run(self, kind, jobs):
+        handler = self._handlers[kind][0]
+        start_trace(f"job:{kind}")
+        try:
+            results = handler(jobs)
+        except Exception as e:
+            log.exception("%d %s jobs failed: %s", len(jobs), kind, e)
+            set_status(FAILED)
+            results, error = {}, str(e)
+        else:
+            set_status(DONE)
+            error = "No result"
+        finally:
+            finish_trace()
+        self._count("batches")
+
+        now = time.time()
+        with self.transaction() as conn:
+            for job in jobs:
+                if job.id in results:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, result = ?, error = NULL, updated_at = ? WHERE id = ?",
+                        (DONE, json.dumps(results[job.id]), now, job.id),
+                    )
+                    self._count("completed")
+                elif job.attempts + 1 >= self.max_attempts:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?", (FAILED, error, now, job.id)
+                    )
+                    self._count("failed")
+                else:
+                    delay = random.uniform(1, 2) * 2 ** job.attempts
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, run_at = ?, updated_at = ? WHERE id = ?",
+                        (PENDING, error, now + delay, now, job.id),
+                    )
+                    self._count("retried")
+
+
+job_queue = JobQueue(
+    os.environ.get("JOB_QUEUE_PATH", "jobs.db"),
+    workers=int(os.environ.get("JOB_WORKERS", 2)),
+    poll_interval=float(os.environ.get("JOB_POLL_SECONDS", 1)),
+    lease=float(os.environ.get("JOB_LEASE_SECONDS", 300)),
+    max_attempts=int(os.environ.get("JOB_MAX_ATTEMPTS", 3)),
+    retention=float(os.environ.get("JOB_RETENTION_SECONDS", 3600)),
+)
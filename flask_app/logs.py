@@ -0,0 +1,78 @@
+"""
+Leveled logging of the API server.
+
+Records are handed to a queue and written by a background thread, so the
+request threads and the event loop never wait on the log output. Payload
+dumps (model answers, quotes, balances) are logged at debug level with
+extra=SAMPLED and only a fraction of them is kept, arguments of dropped or
+disabled records are never formatted.
+
+Configuration:
+    LOG_LEVEL           DEBUG, INFO (default), WARNING or ERROR
+    LOG_SAMPLE_RATE     fraction of the SAMPLED records that are logged (default 0.01)
+"""
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+
+# Pass as extra= to log a record only for a sample of the calls
+SAMPLED = {"sampled": True}
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_lock = threading.Lock()
+_configured = False
+
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, "sampled", False) or random.random() < self.rate
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Queue handler whose listener thread is started lazily, so it runs in the forked worker."""
+
+    def __init__(self, handler):
+        super().__init__(queue.SimpleQueue())
+        self.handler = handler
+        self._pid = None
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            with _lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.SimpleQueue()
+                    logging.handlers.QueueListener(self.queue, self.handler).start()
+                    self._pid = os.getpid()
+        self.queue.put_nowait(record)
+
+
+def configure():
+    """Install the background handler on the "feelan" logger, once."""
+    global _configured
+    with _lock:
+        if _configured:
+            return
+        stream = logging.StreamHandler()
+        stream.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler = BackgroundHandler(stream)
+        handler.addFilter(SamplingFilter(float(os.environ.get("LOG_SAMPLE_RATE", 0.01))))
+
+        logger = logging.getLogger("feelan")
+        logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        logger.addHandler(handler)
+        logger.propagate = False
+        _configured = True
+
+def get_logger(name):
+    """Logger of a module, e.g. get_logger(__name__)."""
+    configure()
+    return logging.getLogger(f"feelan.{name}")
@@ -1,42 +1,100 @@
-from flask import Flask, request, jsonify
-import requests
-import urllib.request
-import json, copy, time
+"""
+Flask API server of the chat, built by create_app().
+
+Importing this module is cheap: it defines the routes on a blueprint and
+the clients of the services, all created on first use in each process, so
+it can be imported in tests without credentials or network. The heavy
+dependencies (OpenAI SDK, eth_account, the balance and token libraries) are
+imported on first use as well, or up front by preload_dependencies() when
+PRELOAD_DEPENDENCIES is set. With gunicorn --preload they are then loaded
+once in the master and shared copy-on-write by the workers:
+
+    PRELOAD_DEPENDENCIES=1 gunicorn --preload -w 4 -k gthread --threads 64 -b 0.0.0.0:5002 main:app
+
+The module's app attribute is created by create_app() on first access, so
+"main:app" keeps working for gunicorn.
+
+Configuration:
+    PRELOAD_DEPENDENCIES    1 to import the heavy dependencies when the app is created (default 0)
+    FLASK_DEBUG             1 for the debugger and reloader of python main.py (default 0)
+"""
+from flask import Blueprint, Flask, Response, request, jsonify, stream_with_context
+import httpx
+import json, time
+import hashlib
+import importlib
+import asyncio
 import os
 import ssl
 from flask_cors import CORS
-from transformers import  AutoTokenizer
-from google.cloud import storage
 from flask_jwt_extended import JWTManager
 from flask_jwt_extended import create_access_token
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from eth_account.messages import encode_defunct
-from eth_account import Account
 
-from prompts import firstPrompt, secondPrompt, thirdPrompt, fourthPrompt, fifthPrompt
-from utils import fetchQuote, multiQuote, performSwap, transferERC20
-from token_balance import get_account_balance, get_balance
-
-from openai import OpenAI
+from stream_parser import IntentStreamParser, STREAMED_INTENTS
+from prompts import first_prompt, secondPrompt, thirdPrompt, fourthPrompt, fifthPrompt
+from utils import multiQuote, performSwap, transferERC20
+from node_client import node_client
+from quote_cache import quote_cache
+from balance_cache import balance_cache, invalidate_account
+from token_registry import TokenNotFoundError
+from model_tiers import stage_tier, tier_metrics
+from model_resilience import ModelUnavailable, model_caller
+from metrics import Histogram
+from token_counter import ContextBudgetExceeded, enforce_context_budget, token_counter
+from chat_messages import ChatRequest
+from structured_output import InvalidModelAnswer, count as count_response, is_valid_response, parse_response, response_format, response_stats
+from async_runtime import run_async, loop_local
+from history import SUMMARY_INSTRUCTION, compact_history, history_state, summary_message, summary_end, track_confirmation
+from prefetch import TurnPrefetch, prefetch_stats
+from intent_router import intent_router
+from response_cache import response_cache
+from jobs import job_queue
+from shared_state import shared_state
+import rate_limits
+from conversation_store import ConflictError, load_conversation, create_conversation, append_messages, update_metadata, conversation_page, index_version, load_messages, storage_stats
+from logs import SAMPLED, get_logger
+from tracing import finish_trace, prometheus_metrics, set_intent, set_status, span, start_trace
 
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
-import datetime
-
-os.environ['FLASK_ENV'] = 'development'
-
-app = Flask(__name__)
-app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev_key_please_change_in_production')
-jwt = JWTManager(app)
-
-# Initialize OpenAI client with API key from environment variable
-client = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY", ""),
+log = get_logger(__name__)
+
+api = Blueprint("api", __name__)
+jwt = JWTManager()
+
+def openai_options():
+    # SDK retries are kept low, deadlines, hedging and the circuit breaker are in model_resilience
+    return {
+        "api_key": os.environ.get("OPENAI_API_KEY", ""),
+        "max_retries": int(os.environ.get("OPENAI_MAX_RETRIES", 1)),
+    }
+
+def create_async_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(**openai_options())
+
+# Async client used by the send-message pipeline, bound to the shared event loop
+get_async_client = loop_local(create_async_openai_client)
+
+# Latency of whole send-message turns, until the response or the "done" event
+turn_latency = Histogram()
+
+# Titles asked in one model call, and the time a title job waits for others to batch with
+TITLE_BATCH_SIZE = int(os.environ.get("TITLE_BATCH_SIZE", 8))
+TITLE_BATCH_DELAY = float(os.environ.get("TITLE_BATCH_DELAY", 0.5))
+# Last messages of a conversation, and characters of each, the model sees to make its title
+TITLE_EXCERPT_MESSAGES = 12
+TITLE_EXCERPT_CHARS = 500
+TITLE_INSTRUCTION = (
+    "Make a five words short summary fitting in a title of each conversation below. Answer with a JSON "
+    'object mapping the number of each conversation to its title, e.g. {"1": "Swapping USDC for WMATIC"}.'
 )
 
-# Configure CORS to allow cross-origin requests with authorization headers
-CORS(app, supports_credentials=True, resources={r"/*": {"origins": "*", "allow_headers": ["Authorization", "Content-Type"]}})
+# Conversations listed per /api/retrieveAll page, and the most a client may ask for
+LIST_PAGE_SIZE = int(os.environ.get("LIST_PAGE_SIZE", 50))
+MAX_PAGE_SIZE = 200
 
 def get_user_id_key():
     """
@@ -57,25 +115,99 @@ def custom_rate_limit_exceeded(error):
     return response
 
 # Initialize rate limiter to prevent abuse
+# Counters are kept in the shared state, so limits hold across workers, with a sliding window
 limiter = Limiter(
     get_user_id_key,
-    app=app,
+    storage_uri=rate_limits.STORAGE_URI,
+    strategy=rate_limits.STRATEGY,
     on_breach=custom_rate_limit_exceeded
 )
 
-# Initialize tokenizer for input length checking
-tokenizer = AutoTokenizer.from_pretrained("HuggingFaceH4/zephyr-7b-beta")
+def preload_dependencies():
+    """
+    Import the dependencies loaded on first use, and the tokenizer of the
+    models. Nothing that holds a connection or a thread is created, so it
+    is safe in a gunicorn master before the workers are forked.
+    """
+    modules = ["openai", "eth_account", "eth_account.messages", "token_balance"]
+    if os.environ.get("CONVERSATION_BACKEND", "gcs") == "gcs":
+        modules.append("google.cloud.storage")
+    for module in modules:
+        importlib.import_module(module)
+    for tier in {stage_tier(stage) for stage in ("classify", "title", "summary")}:
+        token_counter.encoding(tier.model)
+
+def create_app(config=None):
+    """
+    The Flask app, config overrides the settings read from the environment.
+    Clients, connections and worker threads are created on first use in the
+    process serving the requests, never here.
+    """
+    app = Flask(__name__)
+    app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'dev_key_please_change_in_production')
+    app.config['PRELOAD_DEPENDENCIES'] = os.environ.get('PRELOAD_DEPENDENCIES', '0') == '1'
+    app.config.update(config or {})
+
+    jwt.init_app(app)
+    limiter.init_app(app)
+    # Configure CORS to allow cross-origin requests with authorization headers
+    CORS(app, supports_credentials=True, resources={r"/*": {"origins": "*", "allow_headers": ["Authorization", "Content-Type"], "expose_headers": ["ETag"]}})
+    app.register_blueprint(api)
+    # Handlers of the background jobs, their worker threads start with the first request
+    job_queue.register("title", run_title_jobs, batch_size=TITLE_BATCH_SIZE, delay=TITLE_BATCH_DELAY)
+    job_queue.register("history", run_history_jobs)
+
+    if app.config['PRELOAD_DEPENDENCIES']:
+        start = time.perf_counter()
+        preload_dependencies()
+        log.info("Dependencies preloaded in %.2f seconds.", time.perf_counter() - start)
+    return app
+
+_app = None
+
+def __getattr__(name):
+    # "main:app" for gunicorn, created on first access only
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+@api.before_app_request
+def trace_request():
+    start_trace(request.endpoint)
+
+@api.after_app_request
+def trace_status(response):
+    set_status(response.status_code)
+    return response
+
+@api.before_app_request
+def start_job_workers():
+    # After a fork, the worker threads of the parent are gone
+    job_queue.start()
 
-# Configure Google Cloud Storage
-bucket_name = 'feelan_storage'
-storage_client = storage.Client()
-bucket = storage_client.bucket(bucket_name)
+@api.teardown_app_request
+def finish_request_trace(error):
+    # Streamed responses are torn down once the stream is done
+    finish_trace()
 
-@app.route('/')
+@api.route('/')
 def index():
     return "Flask server is running!"
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/metrics')
+def prometheus_endpoint():
+    """Latency histograms of the requests and of their steps, per intent, in the Prometheus text format."""
+    return Response(prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/cache-stats')
+def cache_stats():
+    """Counters of the storage backend, the speculative prefetch, the Node.js backend calls and the quote and balance caches, the token counts, the model answer parsing, the intent router, the model tiers, the user-assistance answer cache, the model call resilience, the background jobs, the shared state and the turn latency."""
+    return jsonify({'storage': storage_stats(), 'prefetch': prefetch_stats(), 'node_backend': node_client.stats(), 'quotes': quote_cache.stats(), 'balances': balance_cache.stats(), 'tokens': token_counter.stats(), 'responses': response_stats(), 'intent_router': intent_router.stats(), 'models': tier_metrics.stats(), 'answers': response_cache.stats(), 'model_calls': model_caller.stats(), 'jobs': job_queue.stats(), 'shared_state': shared_state.stats(), 'turns': turn_latency.snapshot()})
+
+@api.route('/api/login', methods=['POST'])
 def login():
     """
     Authenticate user with Ethereum wallet signature verification.
@@ -90,6 +222,9 @@ def login():
     if not userId:
         return jsonify({"msg": "Missing userId"}), 400
 
+    from eth_account import Account
+    from eth_account.messages import encode_defunct
+
     # Verify the signature matches the address that signed the message
     encoded_message = encode_defunct(text=message)
 
@@ -109,48 +244,33 @@ def rate_limit_exceeded(error):
         "message": "Rate limit exceeded. Please try again later."
     }), 429
 
-def check_input_length(messages):
-    """Count tokens in message to ensure it's within model limits"""
-    token_count = 0
-    for message in messages:
-        tokens = tokenizer.encode(message["content"])
-        token_count += len(tokens)
-
-    print(f"Input length: {token_count}")
-
-def role_map(messages):
-    """
-    Map frontend message roles to OpenAI API format.
-    Converts "Me" → "user" and "AI" → "assistant"
-    """
-    for message in messages:
-        if message['role'] not in ["Me", "AI", "user", "assistant"]:
-            raise ValueError(f"Invalid role: {message['role']}. Role must be either 'Me' or 'AI'.")
+@api.app_errorhandler(ModelUnavailable)
+def model_unavailable(error):
+    response = jsonify({"success": False, "message": str(error)})
+    response.status_code = 503
+    if error.retry_after:
+        response.headers['Retry-After'] = str(int(error.retry_after + 0.5))
+    return response
 
-        if message['role'] == "Me":
-            message['role'] = "user"
-        elif message['role'] == "AI":
-            message['role'] = "assistant"
+@api.app_errorhandler(ConflictError)
+def conversation_conflict(error):
+    return jsonify({"success": False, "message": "The conversation is being updated by another request, please try again."}), 409
 
-    return messages
+@api.app_errorhandler(InvalidModelAnswer)
+def invalid_model_answer(error):
+    return jsonify({"success": False, "message": str(error)}), 502
 
-# Google Cloud Storage helper functions
-def download_blob_as_string(source_blob_name):
-    """Downloads a blob from the bucket as a string."""
-    blob = bucket.blob(source_blob_name)
-    return blob.download_as_string()
+@api.app_errorhandler(ContextBudgetExceeded)
+def context_budget_exceeded(error):
+    return jsonify({"success": False, "message": str(error)}), 413
 
-def upload_string_as_blob(destination_blob_name, data_string):
-    """Uploads a string to a blob."""
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_string(data_string)
+def check_input_length(messages, stage):
+    """Count tokens in message to ensure it's within the limits of the stage's model, raises ContextBudgetExceeded otherwise"""
+    token_count = enforce_context_budget(messages, stage_tier(stage).model)
 
-def blob_exists(blob_name):
-    """Check if a blob exists in the given bucket."""
-    blob = bucket.blob(blob_name)
-    return blob.exists()
+    log.debug("Input length of %s: %d tokens", stage, token_count)
 
-@app.route('/api/meta-update', methods=['POST'])
+@api.route('/api/meta-update', methods=['POST'])
 @jwt_required()
 @limiter.limit("10 per minute", key_func=get_user_id_key)
 def meta_update():
@@ -161,120 +281,126 @@ def meta_update():
     convId = data['id']
     userId = data['userId']
 
-    bucket_file_path = f"data/users/conversations/{userId}_conversations.json"
-    # Load the existing conversations from the Cloud Storage bucket
-    if blob_exists(bucket_file_path):
-        try:
-            json_string = download_blob_as_string(bucket_file_path)
-            conversations = json.loads(json_string) if json_string else []
-        except FileNotFoundError:
-            conversations = []
-    else:
-        conversations = []
-
-    # Update the conversation in the JSON file
-    conversation_updated = False
-    for conv in conversations:
-        if conv['id'] == convId:
-            conv['name'] = data['name']
-            conv['isNFT'] = data['isNFT']
-            conv['shelved'] = data['shelved']
-            conv['tokenURI'] = data['tokenURI']
-            conversation_updated = True
-            break
-
-    # update on the bucket
-    updated_json_string = json.dumps(conversations)
-    upload_string_as_blob(bucket_file_path, updated_json_string)
-
-    print(updated_json_string)
+    # Update the conversation object and its index entry on the bucket
+    conversation = update_metadata(userId, convId, {
+        'name': data['name'],
+        'isNFT': data['isNFT'],
+        'shelved': data['shelved'],
+        'tokenURI': data['tokenURI'],
+    })
+
+    if conversation is None:
+        log.warning("Conversation %s not found, metadata not updated.", convId)
     return jsonify({'response': "updated metadata"})
 
-@app.route('/api/retrieveAll', methods=['POST'])
+@api.route('/api/retrieveAll', methods=['GET', 'POST'])
 @jwt_required()
-@limiter.limit("10 per minute", key_func=get_user_id_key)
+@limiter.limit("60 per minute", key_func=get_user_id_key)
 def retrieveAll():
     """
-    Retrieve all conversations for a user.
+    List the conversations of a user, metadata only, newest first and a page at a time.
+    nextCursor is passed back as cursor for the next page, it is None on the last one.
+    GET requests get a 304 when the page did not change since its If-None-Match ETag.
+    Messages are loaded with /api/conversation.
     """
-    data = request.json
-    userId = data['userId']
-
-    # f"data/users/security/monitor/{userId}.json"
-    bucket_file_path = f"data/users/conversations/{userId}_conversations.json"
-    # Load the existing conversations from the Cloud Storage bucket
-    if blob_exists(bucket_file_path):
-        try:
-            json_string = download_blob_as_string(bucket_file_path)
-            conversations = json.loads(json_string) if json_string else []
-        except FileNotFoundError:
-            conversations = []
+    params = request.args if request.method == 'GET' else request.json
+    userId = params['userId']
+    cursor = params.get('cursor') or None
+    try:
+        limit = page_limit(params.get('limit'), LIST_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"success": False, "message": "limit must be an integer"}), 400
+
+    # The index version changes with every metadata write, unchanged pages are not read nor serialized
+    etag = hashlib.sha1(f"{userId}:{index_version(userId)}:{cursor}:{limit}".encode("utf-8")).hexdigest()
+    if request.method == 'GET' and etag in request.if_none_match:
+        response = Response(status=304)
     else:
-        conversations = []
-
-    return jsonify({'response': conversations})
+        try:
+            conversations, next_cursor = conversation_page(userId, cursor, limit)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        with span("json", "encode"):
+            response = jsonify({'response': conversations, 'nextCursor': next_cursor})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
-@app.route('/api/conv-summary', methods=['POST'])
+@api.route('/api/conversation', methods=['GET', 'POST'])
+@jwt_required()
+@limiter.limit("120 per minute", key_func=get_user_id_key)
+def conversation_messages():
+    """
+    Messages of one conversation. start, negative to count from the end, and limit select a range of them.
+    """
+    params = request.args if request.method == 'GET' else request.json
+    userId = params['userId']
+    conversationId = params['conversationId']
+    try:
+        start = int(params.get('start', 0))
+        stop = None if params.get('limit') is None else start + page_limit(params['limit'], None)
+    except ValueError:
+        return jsonify({"success": False, "message": "start and limit must be integers"}), 400
+    if start < 0 and stop is not None and stop >= 0:
+        stop = None
+
+    result = load_messages(userId, conversationId, start, stop)
+    if result is None:
+        return jsonify({'response': None, 'error': "Conversation not found"}), 404
+    messages, total = result
+    with span("json", "encode"):
+        return jsonify({'response': {'id': conversationId, 'messages': messages, 'start': range(total)[start:stop].start, 'total': total}})
+
+def page_limit(value, default):
+    """Page size asked by a client, within 1 and MAX_PAGE_SIZE. Raises ValueError if it is not a number."""
+    limit = default if value is None else int(value)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+@api.route('/api/conv-summary', methods=['POST'])
 @jwt_required()
 @limiter.limit("10 per minute", key_func=get_user_id_key)
 def conversation_summary():
     """
     Generate a summary of the conversation using AI.
     Used for creating conversation titles/labels.
+    The title is generated in the background, batched with the titles of
+    other conversations: the response carries the id of the job, polled on
+    /api/conv-summary/<jobId>. The title is also the summary of the
+    conversation in the next /api/retrieveAll.
     """
     data = request.json
     conversationId = data['conversationId']
     userId = data['userId']
 
-    bucket_file_path = f"data/users/conversations/{userId}_conversations.json"
-    # Load the existing conversations from the Cloud Storage bucket
-    if blob_exists(bucket_file_path):
-        try:
-            json_string = download_blob_as_string(bucket_file_path)
-            conversations = json.loads(json_string) if json_string else []
-        except FileNotFoundError:
-            conversations = []
-    else:
-        conversations = []
-
-    # Check if conversationId exists in conversations
-    conversation_data = next((conv for conv in conversations if conv['id'] == conversationId), None)
+    # A title already pending for this conversation is not asked twice
+    job_id = job_queue.enqueue("title", f"{userId}/{conversationId}", {'userId': userId, 'conversationId': conversationId})
+    response = jsonify({'response': None, 'jobId': job_id, 'status': 'pending'})
+    response.headers['Location'] = f"/api/conv-summary/{job_id}"
+    return response, 202
 
-    # Prepare messages for ML model
-    if conversation_data:
-        # If conversation exists, use its data
-        messages = conversation_data['messages']
-        messages_to_call = copy.deepcopy(messages)
-        messages_to_call.append({"role": "user", "content": "Make a five words short summary of this conversation fitting in a title."})
-    else:
-        print("Error in loading the conversation.")
-
-    # Call ML model
-    messages_to_call = role_map(messages_to_call)
-    check_input_length(messages_to_call)
-    ai_response = call_ml_model(messages_to_call)[1:-2]
-    # ai_response = response.split("\n<|assistant|>\n")[-1][1:-2]
-
-    # Update the conversation in the JSON file
-    conversation_updated = False
-    for conv in conversations:
-        if conv['id'] == conversationId:
-            conv['summary'] = ai_response
-            current_conv = conv
-            conversation_updated = True
-            break
-
-    # Write the updated conversations back to the JSON file
-    with open('conversations.json', 'w') as file:
-        json.dump(conversations, file, indent=4)
-    # Write the updated conversations back to the bucket
-
-    updated_json_string = json.dumps(conversations)
-    upload_string_as_blob(bucket_file_path, updated_json_string)
-
-    return jsonify({'response': current_conv})
-
-@app.route('/api/send-message', methods=['POST'])
+@api.route('/api/conv-summary/<job_id>', methods=['GET'])
+@jwt_required()
+def conversation_summary_job(job_id):
+    """
+    Result of a conversation summary job: 202 while it is pending, the
+    conversation with its new summary once it is done.
+    """
+    job = job_queue.get(job_id)
+    if job is None or job.kind != "title":
+        return jsonify({'response': None, 'error': "Job not found"}), 404
+    if not job.finished:
+        response = jsonify({'response': None, 'jobId': job_id, 'status': job.status})
+        response.headers['Retry-After'] = "1"
+        return response, 202
+    if job.status == "failed":
+        return jsonify({'response': None, 'jobId': job_id, 'status': job.status, 'error': job.error}), 502
+
+    conversation_data = load_conversation(job.payload['userId'], job.payload['conversationId']) if job.result else None
+    if conversation_data is None:
+        return jsonify({'response': None, 'error': "Conversation not found"}), 404
+    return jsonify({'response': conversation_data, 'jobId': job_id, 'status': job.status})
+
+@api.route('/api/send-message', methods=['POST'])
 @jwt_required()
 @limiter.limit("50 per hour", key_func=get_user_id_key)
 def send_message():
@@ -288,60 +414,86 @@ def send_message():
     - Process management
     """
     data = request.json
-    userId = data['userId']
-    accountAddress = data['accountAddress']
-    accountName = data['accountName']
-    conversationId = data['conversationId']
-    timestamp = data['timestamp']
-    message = data['user_message']
-    name = data['name']
-    isNFT = data['isNFT']
-    shelved = data['shelved']
-    tokenURI = data['tokenURI']
-    type = data['type']
-    #userId = "0x39CfBFeCEBb47833393Fd4a8Ce69894D53158A05"
 
-    bucket_file_path = f"data/users/conversations/{userId}_conversations.json"
-    # Load the existing conversations from the Cloud Storage bucket
-    if blob_exists(bucket_file_path):
-        try:
-            json_string = download_blob_as_string(bucket_file_path)
-            conversations = json.loads(json_string) if json_string else []
-        except FileNotFoundError:
-            conversations = []
-    else:
-        conversations = []
+    if data.get('stream') and not is_shortcut_message(data['user_message']):
+        return Response(
+            stream_with_context(stream_turn(data)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
 
-    # Check if conversationId exists in conversations
-    conversation_data = next((conv for conv in conversations if conv['id'] == conversationId), None)
+    # The whole turn runs on the shared event loop, this thread only waits for it
+    start_time = time.time()
+    response_message = run_async(send_message_turn(data))
+    turn_latency.observe(time.time() - start_time)
+
+    return jsonify({'response': response_message})
+
+
+def is_shortcut_message(message):
+    """Messages sent by the UI itself, answered without calling the model."""
+    return "Minting NFT" in message or "New process created!!!" in message
+
+def prepare_turn(data):
+    """
+    Load the conversation and build the request of the first model call.
+    Returns (conversation_data, messages, stored_messages, messages_to_call), messages_to_call is a ChatRequest.
+    """
+    # Load only this conversation from the Cloud Storage bucket
+    conversation_data = load_conversation(data['userId'], data['conversationId'])
+    message = data['user_message']
 
     # Prepare messages for ML model
     if conversation_data:
         # If conversation exists, use its data
         messages = conversation_data['messages']
-        messages.append({"role": "Me", "content": message})
+        stored_messages = len(messages)
+        messages.append({"role": "user", "content": message})
     else:
         # If conversation does not exist, use default data
+        stored_messages = 0
         messages = [{
-                    "role": "Me",
+                    "role": "user",
                     "content": message
                     }]
 
-    system_prompt =  {
-                    "role": "system",
-                    "content": firstPrompt,
-                }
+    # Only the last turns are sent verbatim, the older ones as their rolling summary
+    summary_message, start = compact_history(messages, conversation_data)
+    context = (summary_message,) if summary_message else ()
+    messages_to_call = ChatRequest(first_prompt(), context, messages, start)
+    check_input_length(messages_to_call, "classify")
+
+    return conversation_data, messages, stored_messages, messages_to_call
 
-    messages_to_call = copy.deepcopy(messages)
-    messages_to_call = role_map(messages_to_call)
-    messages_to_call.insert(0, system_prompt)
-    check_input_length(messages_to_call)
+def add_format_reminder(messages_to_call):
+    return messages_to_call.with_last_content(messages_to_call.last()['content'] + "\nPlease in your response answer with the right format structure, therefore a string-like JSON response.")
+
+async def send_message_turn(data):
+    """A full send-message turn, every blocking step is awaited. Returns the response for the client."""
+    userId = data['userId']
+    accountAddress = data['accountAddress']
+    accountName = data['accountName']
+    conversationId = data['conversationId']
+    timestamp = data['timestamp']
+    message = data['user_message']
+    name = data['name']
+    isNFT = data['isNFT']
+    shelved = data['shelved']
+    tokenURI = data['tokenURI']
+    #userId = "0x39CfBFeCEBb47833393Fd4a8Ce69894D53158A05"
+
+    conversation_data, messages, stored_messages, messages_to_call = await asyncio.to_thread(prepare_turn, data)
+    prefetch = TurnPrefetch(accountAddress, conversation_data, messages)
 
     # Call ML model
     if "Minting NFT" in message:
-        ai_response = "NFT minted!"
+        # Sent by the UI once the NFT is minted, there is no intent to handle
+        response_message = "NFT minted!"
+        messages.append({"role": "assistant", "content": response_message})
+        await asyncio.to_thread(save_turn, data, conversation_data, messages, stored_messages)
+        return response_message
     elif "New process created!!!" in message:
-        conversations.append({
+        new_conversation = {
             "id": conversationId,
             "userId": userId,
             "timestamp": timestamp,
@@ -350,276 +502,580 @@ def send_message():
             "isNFT": isNFT,
             "tokenURI": tokenURI,
             "shelved": shelved,
-        })
-
-        # Write the updated conversations back to the bucket
-        updated_json_string = json.dumps(conversations)
-        upload_string_as_blob(bucket_file_path, updated_json_string)
+        }
+
+        # Write the conversation to the bucket, or only this message and the metadata if it exists
+        if conversation_data is None and await asyncio.to_thread(create_conversation, userId, new_conversation):
+            return "Created a new process."
+        await asyncio.to_thread(append_messages, userId, conversationId, messages[stored_messages:])
+        fields = {key: new_conversation[key] for key in ('name', 'isNFT', 'tokenURI', 'shelved')
+                  if (conversation_data or {}).get(key) != new_conversation[key]}
+        if fields:
+            await asyncio.to_thread(update_metadata, userId, conversationId, fields)
         response_message = "Created a new process."
-        return jsonify({'response': response_message})
+        return response_message
 
     else:
-        messages_to_call[-1]['content'] = messages_to_call[-1]['content'] + "\nPlease in your response answer with the right format structure, therefore a string-like JSON response."
-        raw_response = call_ml_model(messages_to_call)
-        print(raw_response)
-        ai_response = process_response(raw_response, messages_to_call)
+        messages_to_call = add_format_reminder(messages_to_call)
+        # Balance and quote are fetched while the model classifies the intent
+        prefetch.start()
+        prediction = intent_router.predict(message, prefetch.quote_request)
+        cache_key = response_cache_key(messages_to_call, conversation_data, prefetch)
+        routed = intent_router.dispatch(prediction)
+        cached = None if routed else await response_cache.aget(cache_key)
+        if routed:
+            log.debug("Intent routed locally: %s (%s)", prediction.intent, prediction.source)
+            ai_response = prediction.ai_response()
+        elif cached is not None:
+            log.debug("User-assistance answer served from the cache")
+            ai_response = cached
+        else:
+            model_start = time.time()
+            try:
+                raw_response = await call_ml_model(messages_to_call, "classify", response_format())
+                log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+                ai_response = await process_response(raw_response, messages_to_call)
+            except (ModelUnavailable, InvalidModelAnswer):
+                prefetch.finish()
+                raise
+            intent_router.observe(message, prediction, turn_intent(ai_response))
+            await response_cache.aput(cache_key, ai_response, time.time() - model_start)
         # ai_response = response.split("<|assistant|>")[-1].lstrip('\n')
 
+    try:
+        response_message = await handle_intent(ai_response, messages, messages_to_call, accountAddress, accountName, prefetch)
+    finally:
+        prefetch.finish()
+    await asyncio.to_thread(save_turn, data, conversation_data, messages, stored_messages, turn_intent(ai_response), prefetch.last_quote)
+
+    return response_message
+
+
+async def handle_intent(ai_response, messages, messages_to_call, accountAddress, accountName, prefetch):
+    """
+    Act on the intent detected by the first model call: fetch quotes, balances,
+    perform transfers or call the model again with the stage prompt.
+    Balances and quotes come from the turn's prefetch when it has them.
+    Appends the AI message to messages and returns the response for the client.
+    """
     done = False
 
     intent = ai_response["intent"]
     response = ai_response["response"]
     response_message = "No response"
-    print("Intent: ", intent)
+    set_intent(intent)
+    log.debug("Intent: %s", intent)
     accountTitle = f"On account name: {accountName}"
 
     #while !done:
 
     if intent == 'user-assistance':
         response_message = response
-        messages.append({"role": "AI", "content": response_message})
+        messages.append({"role": "assistant", "content": response_message})
         # done = True
     elif intent == 'swap_intent':
-        quote_result = fetchQuote(response, accountAddress)
-        print("Quote result", quote_result)
-        del messages_to_call[0]
+        quote_result = await prefetch.quote(response)
+        log.debug("Quote result: %s", quote_result, extra=SAMPLED)
         swap_intent_prompt = accountTitle + "\n" +  secondPrompt + quote_result
-        messages_to_call.append({'role': 'system', 'content': swap_intent_prompt})
-        print("calling with second prompt")
-        raw_response = call_ml_model(messages_to_call)
-        print(raw_response)
-        ai_response = process_response(raw_response, messages_to_call)
+        messages_to_call = messages_to_call.with_system(None).append({'role': 'system', 'content': swap_intent_prompt})
+        raw_response = await call_ml_model(messages_to_call, "explain", response_format())
+        log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+        ai_response = await process_response(raw_response, messages_to_call)
 
         response_message = ai_response['response']
-        messages.append({"role": "AI", "content": response_message})
+        messages.append({"role": "assistant", "content": response_message})
+        prefetch.remember_quote(response, ai_response)
     elif intent == 'multiswap_intent':
-        quote_response = multiQuote(response, accountAddress)
-        if quote_response.status_code != 200:
-            account_balance = get_balance(accountAddress)
-            quote_result = f"{quote_response.text}. Consider the user account balance is:\n {account_balance}"
+        try:
+            quote_response = await multiQuote(response, accountAddress)
+        except (TokenNotFoundError, httpx.HTTPError) as e:
+            account_balance = await prefetch.balance()
+            quote_result = f"{e} Consider the user account balance is:\n {account_balance}"
         else:
-            quote_result = str(quote_response.json()['results'])
-        print("Quote result", quote_result)
-        del messages_to_call[0]
+            if quote_response.status_code != 200:
+                account_balance = await prefetch.balance()
+                quote_result = f"{quote_response.text}. Consider the user account balance is:\n {account_balance}"
+            else:
+                quote_result = str(quote_response.json()['results'])
+        log.debug("Quote result: %s", quote_result, extra=SAMPLED)
         swap_intent_prompt = accountTitle + "\n" +  secondPrompt + quote_result
-        messages_to_call.append({'role': 'system', 'content': swap_intent_prompt})
-        print("calling with second prompt")
-        raw_response = call_ml_model(messages_to_call)
-        print(raw_response)
-        ai_response = process_response(raw_response, messages_to_call)
+        messages_to_call = messages_to_call.with_system(None).append({'role': 'system', 'content': swap_intent_prompt})
+        raw_response = await call_ml_model(messages_to_call, "explain", response_format())
+        log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+        ai_response = await process_response(raw_response, messages_to_call)
 
         response_message = ai_response['response']
-        messages.append({"role": "AI", "content": response_message})
+        messages.append({"role": "assistant", "content": response_message})
     elif intent == 'swap_function':
+        # The UI runs the swap, stop caching this account's balances until it settles
+        invalidate_account(accountAddress, hold=True)
 
         response_back = json.dumps({"intent": "swap_function", "response": response})
         response_message = response_back
-        messages.append({"role": "AI", "content": response_message})
+        messages.append({"role": "assistant", "content": response_message})
     elif intent == 'multiswap_function':
+        invalidate_account(accountAddress, hold=True)
         response_back = json.dumps({"intent": "multiswap_function", "response": response})
         response_message = response_back
-        messages.append({"role": "AI", "content": response_message})
-        print(response_message)
+        messages.append({"role": "assistant", "content": response_message})
+        log.debug("Multiswap: %s", response_message, extra=SAMPLED)
     elif intent == 'account_balance':
-        print('calling get_account_balance')
-        account_balance = get_balance(accountAddress)
-        print(account_balance)
-        del messages_to_call[0]
+        account_balance = await prefetch.balance()
+        log.debug("Account balance: %s", account_balance, extra=SAMPLED)
         balance_prompt = thirdPrompt +  accountTitle + "\n" + account_balance
-        messages_to_call.append({'role': 'system', 'content': balance_prompt})
-        print("calling with third prompt")
-        raw_response = call_ml_model(messages_to_call)
-        print(raw_response)
-        ai_response = process_response(raw_response, messages_to_call)
+        messages_to_call = messages_to_call.with_system(None).append({'role': 'system', 'content': balance_prompt})
+        raw_response = await call_ml_model(messages_to_call, "explain", response_format())
+        log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+        ai_response = await process_response(raw_response, messages_to_call)
 
         response_message = ai_response['response']
-        messages.append({"role": "AI", "content": response_message})
+        messages.append({"role": "assistant", "content": response_message})
     elif intent == 'transfer_token':
-        print('Transfering intent')
-        account_balance = get_balance(accountAddress)
-        print(account_balance)
+        account_balance = await prefetch.balance()
+        log.debug("Account balance: %s", account_balance, extra=SAMPLED)
         transfer_intent_prompt =  fourthPrompt + accountTitle + "\n" + account_balance
-        messages_to_call[0] = {'role': 'system', 'content': transfer_intent_prompt}
-        print("calling with forth prompt")
-        raw_response = call_ml_model(messages_to_call)
-        print(raw_response)
-        ai_response = process_response(raw_response, messages_to_call)
+        messages_to_call = messages_to_call.with_system(transfer_intent_prompt)
+        raw_response = await call_ml_model(messages_to_call, "explain", response_format())
+        log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+        ai_response = await process_response(raw_response, messages_to_call)
 
         response_message = ai_response['response']
-        messages.append({"role": "AI", "content": response_message})
+        messages.append({"role": "assistant", "content": response_message})
     elif intent == 'transfer_function':
-        print('Transfering ERC20 token')
-        transfer_result = transferERC20(response, accountAddress)
+        transfer_result = await transferERC20(response, accountAddress)
         if transfer_result["success"]:
 
             response_back = json.dumps({"intent": "transfer_function", "response": "Transfered"})
             response_message = response_back
-            messages.append({"role": "AI", "content": response_message})
+            messages.append({"role": "assistant", "content": response_message})
             # response_message = "Transfered"
         else:
             error_message = f"Error occured during transfer: {transfer_result['error']}"
-            account_balance = get_balance(accountAddress)
-            print(account_balance)
+            account_balance = await prefetch.balance()
+            log.debug("Account balance: %s", account_balance, extra=SAMPLED)
             transfer_intent_prompt =  fourthPrompt + accountTitle + "\n" + account_balance + error_message
-            del messages_to_call[0]
-            messages_to_call.append({'role': 'system', 'content': transfer_intent_prompt})
-            print("calling with forth prompt")
-            raw_response = call_ml_model(messages_to_call)
-            print(raw_response)
-            ai_response = process_response(raw_response, messages_to_call)
+            messages_to_call = messages_to_call.with_system(None).append({'role': 'system', 'content': transfer_intent_prompt})
+            raw_response = await call_ml_model(messages_to_call, "explain", response_format())
+            log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+            ai_response = await process_response(raw_response, messages_to_call)
 
             response_message = ai_response['response']
-            messages.append({"role": "AI", "content": response_message})
+            messages.append({"role": "assistant", "content": response_message})
     elif intent == 'create-process':
-        print("Creating a process")
-        print(response)
+        log.debug("Creating a process: %s", response, extra=SAMPLED)
 
         response_back = json.dumps({"intent": "create-process", "response": response})
         response_message = response_back
-        messages.append({"role": "AI", "content": "creating"})
+        messages.append({"role": "assistant", "content": "creating"})
     elif intent == 'query-process':
-        print('Query process')
-        print(response)
+        log.debug("Query process: %s", response, extra=SAMPLED)
 
         response_message = json.dumps({"intent": intent, "response": response})
-        messages.append({"role": "AI", "content": "Querying the process."})
+        messages.append({"role": "assistant", "content": "Querying the process."})
 
 
     elif intent == 'run-process':
-        print('Run process')
-        print(response)
-
-        del messages_to_call[0]
-        messages_to_call.append({'role': 'system', 'content': fifthPrompt})
-        print("calling with fifth prompt")
-        raw_response = call_ml_model(messages_to_call)
-        print("raw response", raw_response)
-        ai_response = process_response(raw_response, messages_to_call)
-        print('Running process with: ', ai_response)
-        response_message = json.dumps({"intent": ai_response["intent"], "response": ai_response["response"]})
-        messages.append({"role": "AI", "content": "running code"})
+        log.debug("Run process: %s", response, extra=SAMPLED)
 
+        messages_to_call = messages_to_call.with_system(None).append({'role': 'system', 'content': fifthPrompt})
+        raw_response = await call_ml_model(messages_to_call, "code", response_format())
+        log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+        ai_response = await process_response(raw_response, messages_to_call)
+        response_message = json.dumps({"intent": ai_response["intent"], "response": ai_response["response"]})
+        messages.append({"role": "assistant", "content": "running code"})
 
+    return response_message
 
 
+def response_cache_key(messages_to_call, conversation_data, prefetch):
+    """Key of the turn in the user-assistance answer cache, None while a quote or a confirmation is pending."""
+    if prefetch.quote_request is not None or (conversation_data or {}).get('pendingConfirmation') is not None:
+        response_cache.bypass()
+        return None
+    return response_cache.key(stage_tier("classify").model, messages_to_call)
 
+def turn_intent(ai_response):
+    return ai_response.get("intent") if isinstance(ai_response, dict) else None
 
-    # Load the existing conversations from the Cloud Storage bucket
-    if blob_exists(bucket_file_path):
-        try:
-            json_string = download_blob_as_string(bucket_file_path)
-            conversations = json.loads(json_string) if json_string else []
-        except FileNotFoundError:
-            conversations = []
-    else:
-        conversations = []
-
-    # Update the conversation in the JSON file
-    conversation_updated = False
-    for conv in conversations:
-        if conv['id'] == conversationId:
-            conv['messages'] = messages
-            conversation_updated = True
-            break
-
-    # If the conversation wasn't found, add it as a new conversation
-    if not conversation_updated:
-        conversations.append({
+def save_turn(data, conversation_data, messages, stored_messages, intent=None, last_quote=None):
+    """
+    Persist the messages of this turn, creating the conversation if needed, and
+    the quote it showed, see prefetch. The rolling summary of the history is
+    extended in the background once enough messages left the window.
+    """
+    userId = data['userId']
+    conversationId = data['conversationId']
+    state = {'pendingConfirmation': track_confirmation(intent, stored_messages), 'lastQuote': last_quote}
+    # Metadata of an existing conversation that this turn changes
+    fields = {key: value for key, value in state.items() if (conversation_data or {}).get(key) != value}
+
+    # Append this turn's messages, or add it as a new conversation if it wasn't found
+    created = False
+    if not (conversation_data and append_messages(userId, conversationId, messages[stored_messages:])):
+        new_conversation = {
             "id": conversationId,
             "userId": userId,
-            "timestamp": timestamp,
+            "timestamp": data['timestamp'],
             "messages": messages,
-            "name": name,
-            "isNFT": isNFT,
-            "tokenURI": tokenURI,
-            "shelved": shelved,
-            "type": type
-        })
+            "name": data['name'],
+            "isNFT": data['isNFT'],
+            "tokenURI": data['tokenURI'],
+            "shelved": data['shelved'],
+            "type": data['type'],
+            "pendingConfirmation": state['pendingConfirmation'],
+            "lastQuote": last_quote,
+        }
+        created = create_conversation(userId, new_conversation)
+        if not created:
+            # A concurrent request created it first, only add this turn's messages
+            append_messages(userId, conversationId, messages[stored_messages:])
+        conversation_data = conversation_data or new_conversation
+    if not created and fields:
+        update_metadata(userId, conversationId, fields)
+
+    if summary_end(messages, conversation_data) is not None:
+        job_queue.enqueue("history", f"{userId}/{conversationId}", {'userId': userId, 'conversationId': conversationId})
+
+def run_history_jobs(jobs):
+    """Handler of the "history" jobs, one conversation at a time."""
+    results = {}
+    for job in jobs:
+        run_async(refresh_history_summary(job.payload['userId'], job.payload['conversationId']))
+        results[job.id] = None
+    return results
+
+async def refresh_history_summary(userId, conversationId):
+    """Extend the rolling summary with the messages that left the verbatim window."""
+    conversation = await asyncio.to_thread(load_conversation, userId, conversationId)
+    if conversation is None:
+        return
+    end = summary_end(conversation['messages'], conversation)
+    if end is None:
+        return
+    history = history_state(conversation)
+    previous = summary_message(history['summary']) if history['summary'] else None
+    summary = await summarize(conversation['messages'], SUMMARY_INSTRUCTION, "summary", previous, history['summarized'], end)
+    if not isinstance(summary, str):
+        return
+    await asyncio.to_thread(update_metadata, userId, conversationId, {'history': {'summary': summary, 'summarized': end}})
+    log.info("History of %s summarized up to message %d.", conversationId, end)
+
+
+def stream_turn(data):
+    """
+    Events of stream_turn_events. A failed turn ends with an "error" event,
+    with the status the non-streamed endpoint would answer, and a "done" event
+    without response, so clients always see the end of the stream.
+    """
+    start_time = time.time()
+    try:
+        yield from stream_turn_events(data)
+    except Exception as e:
+        if isinstance(e, ContextBudgetExceeded):
+            status, message = 413, str(e)
+        elif isinstance(e, ModelUnavailable):
+            status, message = 503, str(e)
+        elif isinstance(e, InvalidModelAnswer):
+            status, message = 502, str(e)
+        elif isinstance(e, ConflictError):
+            status, message = 409, "The conversation is being updated by another request, please try again."
+        elif isinstance(e, TokenNotFoundError):
+            status, message = 400, str(e)
+        else:
+            log.exception("Streamed turn failed: %s", e)
+            status, message = 500, "An error occurred while answering the message."
+        set_status(status)
+        yield sse_event('error', {'success': False, 'status': status, 'message': message})
+        yield sse_event('done', {'success': False, 'response': None})
+        return
+    turn_latency.observe(time.time() - start_time)
+
+
+def stream_turn_events(data):
+    """
+    Server-sent events for a streamed send-message turn.
+
+    The first model call is streamed and its "response" text is forwarded as
+    "delta" events as soon as the intent is known to be user-assistance. Other
+    intents are handled as usual once the completion is done. Intents routed
+    locally skip the first call, their "intent" event is sent right away, and
+    cached user-assistance answers are sent as a single "delta" event. The final
+    "done" event carries the same response as the non-streamed endpoint and
+    is sent after the conversation has been persisted.
+    """
+    start_time = time.time()
+    conversation_data, messages, stored_messages, messages_to_call = prepare_turn(data)
+    messages_to_call = add_format_reminder(messages_to_call)
+    prefetch = TurnPrefetch(data['accountAddress'], conversation_data, messages)
+    run_async(start_prefetch(prefetch))
+    prediction = intent_router.predict(data['user_message'], prefetch.quote_request)
+    cache_key = response_cache_key(messages_to_call, conversation_data, prefetch)
+    routed = intent_router.dispatch(prediction)
+    cached = None if routed else response_cache.get(cache_key)
+
+    if routed:
+        log.debug("Intent routed locally: %s (%s)", prediction.intent, prediction.source)
+        ai_response = prediction.ai_response()
+        yield sse_event('intent', {'intent': prediction.intent})
+    elif cached is not None:
+        log.debug("User-assistance answer served from the cache")
+        ai_response = cached
+        yield sse_event('intent', {'intent': cached['intent']})
+        yield sse_event('delta', {'text': cached['response']})
+    else:
+        model_start = time.time()
+        parser = IntentStreamParser()
+        pending = []
 
-    # Write the updated conversations back to the bucket
+        try:
+            for delta in stream_ml_model(messages_to_call, "classify", response_format()):
+                text = parser.feed(delta)
+                if parser.intent is None:
+                    pending.append(text)
+                    continue
+                if pending is not None:
+                    yield sse_event('intent', {'intent': parser.intent})
+                    log.debug("Intent detected after %.2f seconds.", time.time() - start_time)
+                    if parser.intent in STREAMED_INTENTS:
+                        text = ''.join(pending) + text
+                    pending = None
+                if parser.intent in STREAMED_INTENTS and parser.response_is_text and text:
+                    yield sse_event('delta', {'text': text})
+
+            raw_response = parser.text
+            log.debug("Model answer: %s", raw_response, extra=SAMPLED)
+            ai_response = run_async(process_response(raw_response, messages_to_call))
+        except (ModelUnavailable, InvalidModelAnswer):
+            run_async(finish_prefetch(prefetch))
+            raise
+        intent_router.observe(data['user_message'], prediction, turn_intent(ai_response))
+        response_cache.put(cache_key, ai_response, time.time() - model_start)
 
-    updated_json_string = json.dumps(conversations)
-    upload_string_as_blob(bucket_file_path, updated_json_string)
+    try:
+        response_message = run_async(handle_intent(ai_response, messages, messages_to_call, data['accountAddress'], data['accountName'], prefetch))
+    finally:
+        run_async(finish_prefetch(prefetch))
+    save_turn(data, conversation_data, messages, stored_messages, turn_intent(ai_response), prefetch.last_quote)
 
+    yield sse_event('done', {'response': response_message})
 
-    return jsonify({'response': response_message})
 
+async def start_prefetch(prefetch):
+    prefetch.start()
+
+async def finish_prefetch(prefetch):
+    prefetch.finish()
 
-def is_valid_response(json_data):
-    """ Check if the JSON data has the required 'intent' and 'response' keys. """
-    return 'intent' in json_data and 'response' in json_data
 
-def process_response(raw_response, messages_to_call, n_trials=3):
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+
+async def process_response(raw_response, messages_to_call, n_trials=3):
     """
-    Check if the raw_response is either a valid JSON string or a dict and contains the key fields.
-    If not, modify the messages and retry with the ML model up to n_trials times.
+    Parse the raw_response, repairing it locally if needed, and check it has the shape of its intent.
+    If not, modify the messages and retry with the ML model up to n_trials times, then raise InvalidModelAnswer.
     """
     trial = 0
     while trial < n_trials:
-        print(f"trial number {trial}")
         try:
-            # Check if raw_response is already a dict, if not, parse it
-            if isinstance(raw_response, str):
-                response_data = json.loads(raw_response)
-            elif isinstance(raw_response, dict):
-                response_data = raw_response
-            else:
-                raise ValueError("Unsupported type for raw_response")
+            with span("json", "model_answer"):
+                response_data, repaired = parse_response(raw_response)
 
             # Check for required fields
             if is_valid_response(response_data):
+                count_response("repaired" if repaired else "parsed")
                 return response_data
+            log.warning("Invalid response: %s", response_data)
+            count_response("invalid")
 
-        except (json.JSONDecodeError, ValueError) as e:
-            print(f"Error parsing response: {e}")
+        except ValueError as e:
+            log.warning("Error parsing response: %s", e)
+            count_response("invalid")
+        count_response("retries")
 
-        # Update the messages with a system message to prompt for fixing the error.
-        del messages_to_call[0]
-        prompt = "This is your response: " + str(raw_response)+ "\n Following these instructions: " + firstPrompt  + " However an error was raised, as this could not be read as python dictionary. So please fix the error by including the intent and making it a string-like JSON response."
-        messages_to_call.append({'role': 'system', 'content': prompt})
+        # Retry the same request with a system message to prompt for fixing the error.
+        prompt = "This is your response: " + str(raw_response)+ "\n Following these instructions: " + first_prompt()  + " However an error was raised, as this could not be read as python dictionary. So please fix the error by including the intent and making it a string-like JSON response."
+        retry_request = messages_to_call.with_system(None).append({'role': 'system', 'content': prompt})
 
         # Ensure call_ml_model returns a string response
-        raw_response = call_ml_model(messages_to_call)
+        raw_response = await call_ml_model(retry_request, "repair", response_format())
         if isinstance(raw_response, dict):
             raw_response = json.dumps(raw_response)  # Convert dict to JSON string if necessary
 
         trial += 1
 
-    # If we exhaust n_trials without a valid response, return an error message or None.
-    return None
-
-
-def call_ml_model(message):
-
-    # "gpt-3.5-turbo" "gpt-4-turbo" "gpt-4o-2024-08-06"
+    count_response("failures")
+    raise InvalidModelAnswer("The model could not answer this message, please rephrase it and try again.")
+
+
+async def summarize(messages, instruction, stage, summary_message=None, start=0, stop=None):
+    """Ask the model to summarize messages[start:stop], for the rolling history summary."""
+    context = (summary_message,) if summary_message else ()
+    messages_to_call = ChatRequest(None, context, messages, start, stop, ({"role": "user", "content": instruction},))
+    check_input_length(messages_to_call, stage)
+    return await call_ml_model(messages_to_call, stage)
+
+
+def title_excerpt(conversation):
+    """Text of a conversation the model makes its title from: the history summary and the last messages."""
+    history = history_state(conversation)
+    lines = [f"Earlier: {history['summary']}"] if history['summary'] else []
+    for message in conversation['messages'][-TITLE_EXCERPT_MESSAGES:]:
+        lines.append(f"{message['role']}: {message['content'][:TITLE_EXCERPT_CHARS]}")
+    return "\n".join(lines)
+
+async def generate_titles(conversations):
+    """Titles of several conversations in one model call, in order, None for the ones the model left out."""
+    sections = [f"Conversation {i}:\n{title_excerpt(conversation)}" for i, conversation in enumerate(conversations, 1)]
+    messages_to_call = [{"role": "user", "content": TITLE_INSTRUCTION + "\n\n" + "\n\n".join(sections)}]
+    check_input_length(messages_to_call, "title")
+    answer = await call_ml_model(messages_to_call, "title", response_format={"type": "json_object"})
+    with span("json", "titles"):
+        return parse_titles(answer, len(conversations))
+
+def parse_titles(answer, count):
+    """Titles of count conversations in the model's answer, in order, None for the ones it left out."""
+    try:
+        titles = json.loads(answer)
+    except ValueError:
+        titles = None
+    if not isinstance(titles, dict):
+        log.warning("Titles answer is not a JSON object: %.200s", answer)
+        return [None] * count
+    return [clean_title(titles.get(str(i))) for i in range(1, count + 1)]
+
+def clean_title(title):
+    """Title without the quotes and final period models like to add, None if empty or not a string."""
+    if not isinstance(title, str):
+        return None
+    title = title.strip().strip('".').strip()
+    return title or None
+
+def run_title_jobs(jobs):
+    """
+    Handler of the "title" jobs: the titles of their conversations in one
+    model call, each written as the summary of its conversation. The result
+    of a job is its title, None when the conversation no longer exists.
+    """
+    results, pending = {}, []
+    for job in jobs:
+        conversation = load_conversation(job.payload['userId'], job.payload['conversationId'])
+        if conversation is None:
+            results[job.id] = None
+        else:
+            pending.append((job, conversation))
+    if not pending:
+        return results
+
+    titles = run_async(generate_titles([conversation for _, conversation in pending]))
+    for (job, _), title in zip(pending, titles):
+        # Only the jobs left without a title are retried, and failed after JOB_MAX_ATTEMPTS
+        if title is None:
+            continue
+        # Only the summary is written, messages appended by a concurrent turn are kept
+        updated = update_metadata(job.payload['userId'], job.payload['conversationId'], {'summary': title})
+        results[job.id] = title if updated is not None else None
+    titled = sum(1 for title in results.values() if title is not None)
+    log.info("Titled %d of %d conversations in one call.", titled, len(jobs))
+    return results
+
+
+async def call_ml_model(message, stage, response_format=None):
+    """
+    Chat completion with the model tier of the stage, see model_tiers.
+    Runs within the tier's deadline and is hedged when slow, raises
+    ModelUnavailable while the provider is failing, see model_resilience.
+    """
+    tier = stage_tier(stage)
+    messages = list(message)
 
+    def request():
+        return get_async_client().chat.completions.create(
+          messages= messages,
+          temperature = 0.7,
+          **tier.request_options(),
+          **({'response_format': response_format} if response_format else {})
 
+        )
 
     start_time = time.time()  # Start time
 
     try:
+        with span("model", tier.name, stage):
+            completion = await model_caller.call(tier, stage, request)
+    except Exception:
+        tier_metrics.observe(tier, stage, time.time() - start_time, error=True)
+        raise
 
-        completion = client.chat.completions.create(
-          model="gpt-4-turbo",
-          messages= message,
-          # max_tokens = 512,
-          temperature = 0.7
+    # ready message
+    ai_message = completion.choices[0].message.content
 
-        )
+    end_time = time.time()  # End time
+    elapsed_time = end_time - start_time
+    tier_metrics.observe(tier, stage, elapsed_time, completion.usage)
+    log.debug("AI response took %.2f seconds (%s, %s).", elapsed_time, stage, tier.model)
+
+    return ai_message
 
-        # ready message
-        ai_message = completion.choices[0].message.content
 
-        end_time = time.time()  # End time
-        elapsed_time = end_time - start_time
-        print(f"AI response took {round(elapsed_time)} seconds.")
+def stream_ml_model(message, stage, response_format=None):
+    """
+    Same as call_ml_model but yields the completion text deltas as they arrive.
+    The stream is opened through the resilient caller, so it is hedged until its
+    first chunk and must end within the tier's deadline.
+    """
+    tier = stage_tier(stage)
+    messages = list(message)
+    start_time = time.time()
+    first_token_time = None
+    usage = None
+
+    def request():
+        return get_async_client().chat.completions.create(
+          messages= messages,
+          temperature = 0.7,
+          stream = True,
+          stream_options = {"include_usage": True},
+          **tier.request_options(),
+          **({'response_format': response_format} if response_format else {})
+
+        )
 
-        return ai_message
-    except urllib.error.HTTPError as error:
-        print("The request failed with status code: " + str(error.code))
-        print(error.info())
-        print(error.read().decode("utf8", 'ignore'))
-        return {'error': 'The request to the ML model failed'}
+    # The chunks are awaited on the shared event loop, this thread only waits for them
+    chunks = model_caller.stream(tier, stage, request)
+    with span("model", tier.name, stage):
+        try:
+            while True:
+                chunk = run_async(next_chunk(chunks))
+                if chunk is None:
+                    break
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                        log.debug("AI first token took %.2f seconds.", first_token_time - start_time)
+                    yield delta
+        except Exception:
+            tier_metrics.observe(tier, stage, time.time() - start_time, error=True)
+            raise
+        finally:
+            # Closes the completion when the client went away in the middle of it
+            run_async(chunks.aclose())
+
+    tier_metrics.observe(tier, stage, time.time() - start_time, usage)
+    log.debug("AI response took %.2f seconds (%s, %s).", time.time() - start_time, stage, tier.model)
+
+async def next_chunk(chunks):
+    """Next chunk of an async iterator, None once it is exhausted."""
+    try:
+        return await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
 
 
 def allowSelfSignedHttps(allowed):
@@ -630,4 +1086,5 @@ def allowSelfSignedHttps(allowed):
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5002)) # 8080
-    app.run(debug=True, host='0.0.0.0', port=port)
+    # Debug mode only with FLASK_DEBUG=1
+    create_app().run(host='0.0.0.0', port=port)
@@ -0,0 +1,82 @@
+"""
+In-memory stand-in for a Cloud Storage bucket, with the same generation semantics.
+
+Every write of an object gives it a new generation, and uploads made with
+if_generation_match fail with PreconditionFailed when the object is not at
+that generation (0: when it exists), like on a real bucket. The GCS
+backend runs on it unchanged, so its compare-and-swap writes can be tested
+and benchmarked locally:
+
+    CONVERSATION_BACKEND=memory
+
+It needs no Cloud Storage SDK: without it, NotFound and PreconditionFailed
+are defined here and gcs_store catches these.
+"""
+import itertools
+import threading
+
+try:
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+except ImportError:
+    class NotFound(Exception):
+        """The object does not exist."""
+
+    class PreconditionFailed(Exception):
+        """The object is not at the generation of the precondition."""
+
+
+class MemoryBucket:
+
+    def __init__(self, name="memory"):
+        self.name = name
+        self._objects = {}
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def blob(self, blob_name):
+        return MemoryBlob(self, blob_name)
+
+    def get_blob(self, blob_name):
+        """The blob with its current generation, None if it does not exist."""
+        with self._lock:
+            stored = self._objects.get(blob_name)
+        if stored is None:
+            return None
+        blob = MemoryBlob(self, blob_name)
+        blob.generation = stored[1]
+        return blob
+
+
+class MemoryBlob:
+    """The subset of google.cloud.storage.Blob used by gcs_store."""
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def download_as_bytes(self, if_generation_match=None):
+        with self.bucket._lock:
+            stored = self.bucket._objects.get(self.name)
+        if stored is None:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        data, generation = stored
+        if if_generation_match is not None and if_generation_match != generation:
+            raise PreconditionFailed(f"{self.name} is at generation {generation}")
+        self.generation = generation
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.bucket._lock:
+            stored = self.bucket._objects.get(self.name)
+            current = stored[1] if stored is not None else 0
+            if if_generation_match is not None and if_generation_match != current:
+                raise PreconditionFailed(f"{self.name} is at generation {current}")
+            self.generation = next(self.bucket._generations)
+            self.bucket._objects[self.name] = (data, self.generation)
+
+    def exists(self):
+        with self.bucket._lock:
+            return self.name in self.bucket._objects
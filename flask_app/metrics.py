@@ -0,0 +1,125 @@
+"""
+Minimal in-process metrics used to see where the time of a turn goes.
+Labeled metrics can be rendered in the Prometheus text format for /metrics.
+"""
+import bisect
+import math
+import threading
+
+# Seconds, from fast local hops to slow model completions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def count(self):
+        return self._count
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile, None if empty."""
+        with self._lock:
+            counts, total = list(self._counts), self._count
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        with self._lock:
+            counts, total, value_sum = list(self._counts), self._count, self._sum
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            buckets["+Inf" if bound == math.inf else str(bound)] = cumulative
+        return {
+            "count": total,
+            "sum": round(value_sum, 6),
+            "mean": round(value_sum / total, 6) if total else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class LabeledHistogram:
+    """One histogram per label value, e.g. per endpoint."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def labels(self, label):
+        histogram = self._histograms.get(label)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(label, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, label, value):
+        self.labels(label).observe(value)
+
+    def snapshot(self):
+        return {label: histogram.snapshot() for label, histogram in list(self._histograms.items())}
+
+
+class LabeledCounter:
+    """Monotonic counters keyed by label values."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label, value=1):
+        with self._lock:
+            self._counts[label] = self._counts.get(label, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+def _label_pairs(names, values):
+    if not isinstance(values, tuple):
+        values = (values,)
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+def prometheus_histogram(name, description, histograms, label_names):
+    """Prometheus text exposition of a LabeledHistogram, its labels are tuples of label_names values."""
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+    for label, snapshot in sorted(histograms.snapshot().items()):
+        labels = _label_pairs(label_names, label)
+        for bound, count in snapshot["buckets"].items():
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {snapshot['sum']}")
+        lines.append(f"{name}_count{{{labels}}} {snapshot['count']}")
+    return lines
+
+def prometheus_counter(name, description, counter, label_names):
+    """Prometheus text exposition of a LabeledCounter."""
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+    for label, value in sorted(counter.snapshot().items()):
+        lines.append(f"{name}{{{_label_pairs(label_names, label)}}} {value}")
+    return lines
@@ -0,0 +1,238 @@
+"""
+Deadlines, hedging and a circuit breaker around the chat completion calls.
+
+Every call has a deadline, the timeout of its model tier. Once a tier has
+enough samples at a stage, a call still running after their p95 latency is
+hedged: a second identical request is sent and the first answer wins, the
+other is cancelled. Completions have no side effects, so hedging only costs
+tokens. Latencies are kept per tier and stage, since the stages of a tier
+ask for answers of very different lengths, and are the time to the answer,
+or to the first chunk of a stream, which is what a hedge races on.
+
+The circuit breaker opens after MODEL_BREAKER_FAILURES consecutive upstream
+failures (timeouts, connection errors, 5xx, 429) and fails fast with
+ModelUnavailable for MODEL_BREAKER_RESET seconds, or for the Retry-After of
+a 429. One trial call is then let through to close it again.
+
+Configuration:
+    MODEL_HEDGING               1 to hedge slow calls (default 1)
+    MODEL_HEDGE_MIN_SAMPLES     calls of a tier at a stage before their p95 is trusted (default 20)
+    MODEL_HEDGE_MIN_DELAY       minimum seconds before hedging (default 1)
+    MODEL_BREAKER_FAILURES      consecutive failures opening the breaker (default 5)
+    MODEL_BREAKER_RESET         seconds the breaker stays open (default 30)
+"""
+import asyncio
+import os
+import threading
+import time
+
+from metrics import LabeledHistogram
+
+
+class ModelUnavailable(Exception):
+    """The model provider is failing or too slow, the turn cannot be answered now."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_upstream_failure(error):
+    """Errors telling the provider is unhealthy, as opposed to a bad request."""
+    import openai
+    if isinstance(error, (openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+def retry_after(error):
+    """Seconds asked by a 429 response, None if it did not say."""
+    import openai
+    if not isinstance(error, openai.RateLimitError):
+        return None
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0, "trials": 0}
+
+    def allow(self):
+        """Raise ModelUnavailable while the breaker is open, let a single trial call through once it expires."""
+        now = time.monotonic()
+        with self._lock:
+            if self._open_until > now:
+                self._stats["rejected"] += 1
+                raise ModelUnavailable("The model provider is unavailable, please try again later.",
+                                       retry_after=max(self._open_until - now, 1))
+            if self._open_until:
+                # Half-open: this call is the trial, the others keep failing fast until it succeeds
+                self._open_until = now + self.reset_timeout
+                self._stats["trials"] += 1
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = 0.0
+
+    def record_failure(self, retry_after=None):
+        with self._lock:
+            self._failures += 1
+            if retry_after or self._failures >= self.failure_threshold:
+                if self._open_until <= time.monotonic() or retry_after:
+                    self._stats["opened"] += 1
+                self._open_until = time.monotonic() + (retry_after or self.reset_timeout)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = "open" if self._open_until > now else "half-open" if self._open_until else "closed"
+            stats["consecutive_failures"] = self._failures
+        return stats
+
+
+class ResilientCaller:
+
+    def __init__(self, breaker, hedging=True, min_samples=20, min_delay=1.0):
+        self.breaker = breaker
+        # Latency of the successful calls by (tier name, stage)
+        self.latency = LabeledHistogram()
+        self.hedging = hedging
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "deadline_exceeded": 0, "failures": 0}
+
+    def hedge_delay(self, tier, stage):
+        """Seconds before a call of the tier at a stage is hedged, None if it should not be."""
+        if not self.hedging:
+            return None
+        histogram = self.latency.labels((tier.name, stage))
+        if histogram.count < self.min_samples:
+            return None
+        p95 = histogram.quantile(0.95)
+        if p95 is None or p95 >= tier.timeout:
+            return None
+        return max(p95, self.min_delay)
+
+    async def call(self, tier, stage, request):
+        """
+        Await request() within the tier's deadline, hedging it once if it is slow.
+        Raises ModelUnavailable on upstream failures, other errors are raised as they are.
+        """
+        self.breaker.allow()
+        self._count("calls")
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + tier.timeout
+        delay = self.hedge_delay(tier, stage)
+        hedge_at = loop.time() + delay if delay is not None else None
+
+        first = asyncio.ensure_future(request())
+        pending, error = {first}, None
+        try:
+            while pending:
+                wake_at = deadline if hedge_at is None else min(deadline, hedge_at)
+                done, pending = await asyncio.wait(pending, timeout=max(wake_at - loop.time(), 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.breaker.record_success()
+                        self.latency.observe((tier.name, stage), loop.time() - start)
+                        if task is not first:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+                    if not is_upstream_failure(error):
+                        # The provider answered, the request itself is wrong
+                        self.breaker.record_success()
+                        raise error
+                if not pending:
+                    break
+                if loop.time() >= deadline:
+                    self._count("deadline_exceeded")
+                    error = asyncio.TimeoutError(f"No answer within {tier.timeout} seconds")
+                    break
+                if hedge_at is not None and loop.time() >= hedge_at:
+                    hedge_at = None
+                    self._count("hedged")
+                    pending.add(asyncio.ensure_future(request()))
+        finally:
+            for task in pending:
+                task.cancel()
+
+        self._count("failures")
+        wait = retry_after(error)
+        self.breaker.record_failure(wait)
+        raise ModelUnavailable("The model provider is unavailable, please try again later.", retry_after=wait) from error
+
+    async def stream(self, tier, stage, request):
+        """
+        Iterate the chunks of a streamed completion, request() returning the stream.
+        Opening it until its first chunk goes through call(), so it is hedged and
+        fails fast while the breaker is open, and the stream must end before the
+        tier's deadline. Raises ModelUnavailable like call().
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + tier.timeout
+
+        async def open_stream():
+            stream = await request()
+            chunks = stream.__aiter__()
+            try:
+                return stream, chunks, await chunks.__anext__()
+            except StopAsyncIteration:
+                return stream, chunks, None
+
+        stream, chunks, chunk = await self.call(tier, stage, open_stream)
+        try:
+            while chunk is not None:
+                yield chunk
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    chunk = None
+                except Exception as e:
+                    if not is_upstream_failure(e):
+                        raise
+                    if isinstance(e, asyncio.TimeoutError):
+                        self._count("deadline_exceeded")
+                    self._count("failures")
+                    wait = retry_after(e)
+                    self.breaker.record_failure(wait)
+                    raise ModelUnavailable("The model provider is unavailable, please try again later.", retry_after=wait) from e
+        finally:
+            await stream.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["breaker"] = self.breaker.stats()
+        stats["latency"] = {f"{tier}/{stage}": snapshot for (tier, stage), snapshot in self.latency.snapshot().items()}
+        return stats
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+
+model_caller = ResilientCaller(
+    CircuitBreaker(
+        failure_threshold=int(os.environ.get("MODEL_BREAKER_FAILURES", 5)),
+        reset_timeout=float(os.environ.get("MODEL_BREAKER_RESET", 30)),
+    ),
+    hedging=os.environ.get("MODEL_HEDGING", "1") == "1",
+    min_samples=int(os.environ.get("MODEL_HEDGE_MIN_SAMPLES", 20)),
+    min_delay=float(os.environ.get("MODEL_HEDGE_MIN_DELAY", 1)),
+)
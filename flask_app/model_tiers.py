@@ -0,0 +1,99 @@
+"""
+Model tiers of the chat completion calls.
+
+Every call site is a stage, and every stage uses a tier: a model with its
+own timeout and max_tokens. Latency and token usage are recorded per tier,
+so the latency/cost trade-off is tuned from the environment:
+
+    MODEL_TIER_<TIER>_MODEL         model of a tier, e.g. MODEL_TIER_SMALL_MODEL=gpt-4o-mini
+    MODEL_TIER_<TIER>_TIMEOUT       timeout in seconds
+    MODEL_TIER_<TIER>_MAX_TOKENS    completion limit, 0 for none
+    MODEL_STAGE_<STAGE>             tier of a stage, e.g. MODEL_STAGE_CODE=large
+
+The large tier defaults to OPENAI_MODEL.
+"""
+import os
+import threading
+
+from metrics import LabeledHistogram
+
+# tier: (model, timeout in seconds, max_tokens)
+TIERS = {
+    'small': ("gpt-4o-mini", 30, 1024),
+    'large': (os.environ.get("OPENAI_MODEL", "gpt-4-turbo"), 120, 0),
+}
+
+# Stage of every call site and its default tier
+STAGES = {
+    'classify': 'small',    # first call, intent and user-assistance answer
+    'repair': 'small',      # process_response retries
+    'explain': 'large',     # quotes, balances and transfers, second to fourth prompts
+    'code': 'large',        # Lua generation for run-process, fifth prompt
+    'title': 'small',       # conversation titles
+    'summary': 'small',     # rolling history summary
+}
+
+
+class ModelTier:
+
+    def __init__(self, name, model, timeout, max_tokens):
+        self.name = name
+        self.model = model
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+
+    def request_options(self):
+        """Keyword arguments of chat.completions.create for this tier."""
+        options = {'model': self.model, 'timeout': self.timeout}
+        if self.max_tokens:
+            options['max_tokens'] = self.max_tokens
+        return options
+
+
+def get_tier(name):
+    model, timeout, max_tokens = TIERS[name]
+    prefix = f"MODEL_TIER_{name.upper()}_"
+    return ModelTier(
+        name,
+        os.environ.get(prefix + "MODEL", model),
+        float(os.environ.get(prefix + "TIMEOUT", timeout)),
+        int(os.environ.get(prefix + "MAX_TOKENS", max_tokens)),
+    )
+
+def stage_tier(stage):
+    """Tier used by a call site."""
+    return get_tier(os.environ.get(f"MODEL_STAGE_{stage.upper()}", STAGES[stage]))
+
+
+class TierMetrics:
+    """Latency, errors and token usage of the calls of every tier."""
+
+    def __init__(self):
+        self.latency = LabeledHistogram()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, tier, stage, elapsed, usage=None, error=False):
+        self.latency.observe(tier.name, elapsed)
+        with self._lock:
+            counters = self._counters.setdefault(tier.name, {
+                "model": tier.model, "calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "stages": {},
+            })
+            counters["model"] = tier.model
+            counters["calls"] += 1
+            counters["errors"] += error
+            counters["stages"][stage] = counters["stages"].get(stage, 0) + 1
+            if usage is not None:
+                counters["prompt_tokens"] += usage.prompt_tokens
+                counters["completion_tokens"] += usage.completion_tokens
+
+    def stats(self):
+        with self._lock:
+            stats = {name: dict(counters, stages=dict(counters["stages"])) for name, counters in self._counters.items()}
+        latency = self.latency.snapshot()
+        for name in stats:
+            stats[name]["latency"] = latency.get(name)
+        return stats
+
+
+tier_metrics = TierMetrics()
@@ -0,0 +1,111 @@
+"""
+Shared HTTP client for the Node.js swap/quote/transfer server.
+
+Connections are pooled and kept alive, every endpoint has its own timeout,
+and idempotent calls (quotes) are retried a bounded number of times with
+exponential backoff. Latency of every attempt is recorded per endpoint.
+
+Configuration:
+    NODE_BACKEND_URL        base URL of irys_server (default http://localhost:3002)
+    MULTISWAP_BACKEND_URL   base URL of the multiSwap server (default http://localhost:3000)
+    NODE_TIMEOUT_<NAME>     timeout in seconds of an endpoint, e.g. NODE_TIMEOUT_QUOTE=10
+    NODE_MAX_RETRIES        retries of idempotent calls (default 2)
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import httpx
+
+from async_runtime import loop_local
+from logs import get_logger
+from metrics import LabeledHistogram
+from tracing import span
+
+log = get_logger(__name__)
+
+# endpoint: (base URL setting, timeout in seconds, idempotent)
+ENDPOINTS = {
+    '/quote': ('NODE_BACKEND_URL', 15, True),
+    '/multiQuote': ('NODE_BACKEND_URL', 30, True),
+    '/swap': ('NODE_BACKEND_URL', 120, False),
+    '/transferERC20': ('NODE_BACKEND_URL', 120, False),
+    '/multiSwap': ('MULTISWAP_BACKEND_URL', 180, False),
+}
+
+DEFAULT_BASE_URLS = {
+    'NODE_BACKEND_URL': 'http://localhost:3002',
+    'MULTISWAP_BACKEND_URL': 'http://localhost:3000',
+}
+
+# Statuses worth retrying for idempotent calls
+RETRY_STATUSES = (502, 503, 504)
+
+
+def endpoint_timeout(endpoint):
+    name = endpoint.strip('/').upper()
+    return float(os.environ.get(f"NODE_TIMEOUT_{name}", ENDPOINTS[endpoint][1]))
+
+
+class NodeBackendClient:
+
+    def __init__(self, max_retries=None, backoff=0.2, max_connections=100):
+        self.max_retries = int(os.environ.get("NODE_MAX_RETRIES", 2)) if max_retries is None else max_retries
+        self.backoff = backoff
+        self.base_urls = {setting: os.environ.get(setting, default) for setting, default in DEFAULT_BASE_URLS.items()}
+        self.latency = LabeledHistogram()
+
+        self._get_client = loop_local(lambda: httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections // 5),
+        ))
+        self._counters = {"requests": 0, "retries": 0, "errors": 0, "timeouts": 0}
+        self._lock = threading.Lock()
+
+    def url(self, endpoint):
+        return self.base_urls[ENDPOINTS[endpoint][0]] + endpoint
+
+    async def post(self, endpoint, **kwargs):
+        """
+        POST to an endpoint of the Node.js server. Transport errors and timeouts
+        are raised as httpx.HTTPError once the retries are exhausted.
+        """
+        idempotent = ENDPOINTS[endpoint][2]
+        timeout = endpoint_timeout(endpoint)
+        attempts = 1 + (self.max_retries if idempotent else 0)
+
+        for attempt in range(attempts):
+            last_attempt = attempt + 1 == attempts
+            start = time.perf_counter()
+            self._count("requests")
+            try:
+                with span("node", endpoint.strip('/')):
+                    response = await self._get_client().post(self.url(endpoint), timeout=timeout, **kwargs)
+            except httpx.TransportError as e:
+                self.latency.observe(endpoint, time.perf_counter() - start)
+                self._count("timeouts" if isinstance(e, httpx.TimeoutException) else "errors")
+                if last_attempt:
+                    raise
+                log.warning("%s failed (%s), retrying", endpoint, type(e).__name__)
+            else:
+                self.latency.observe(endpoint, time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUSES or last_attempt:
+                    return response
+                log.warning("%s returned %d, retrying", endpoint, response.status_code)
+
+            self._count("retries")
+            await asyncio.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats["latency"] = self.latency.snapshot()
+        return stats
+
+    def _count(self, key):
+        with self._lock:
+            self._counters[key] += 1
+
+
+node_client = NodeBackendClient()
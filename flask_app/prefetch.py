@@ -0,0 +1,170 @@
+"""
+Speculative prefetch of live account data for a send-message turn.
+
+Most turns end up needing the balance of the active account, and a turn
+following a swap quote often asks for the same quote again. Both are
+started concurrently with the first model call, which classifies the
+intent, and are consumed by handle_intent if the intent needs them.
+Unused results are dropped when the turn finishes.
+
+The last quote shown to the user is kept in the conversation's "lastQuote"
+field, {"request": swap request, "response": message showing it}, so the
+next turn finds it whichever worker or node handles it.
+"""
+import asyncio
+import decimal
+import re
+import threading
+
+from balance_cache import fetch_balance
+from logs import get_logger
+from utils import QuoteError, fetchQuote
+
+log = get_logger(__name__)
+
+_stats = {
+    "balance_started": 0,
+    "balance_used": 0,
+    "balance_wasted": 0,
+    "quote_started": 0,
+    "quote_used": 0,
+    "quote_wasted": 0,
+    "quote_mismatched": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def prefetch_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    for kind in ("balance", "quote"):
+        started = stats[f"{kind}_started"]
+        stats[f"{kind}_hit_rate"] = round(stats[f"{kind}_used"] / started, 3) if started else None
+    return stats
+
+
+NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def quote_key(request):
+    return (request.get('tokenIn'), request.get('tokenOut'), str(request.get('amount')))
+
+def proposes_swap(answer, request):
+    """Whether an answer of the model mentions the amount and both tokens of a swap request."""
+    if not isinstance(answer, dict) or answer.get('intent') != 'swap_intent' or not isinstance(answer.get('response'), str):
+        return False
+    text = answer['response']
+    try:
+        amount = decimal.Decimal(str(request.get('amount')))
+    except decimal.InvalidOperation:
+        return False
+    words = text.lower()
+    if not all(str(request.get(token, '')).lower() in words for token in ('tokenIn', 'tokenOut')):
+        return False
+    return any(decimal.Decimal(number) == amount for number in NUMBER.findall(text.replace(',', '')))
+
+async def quote_or_error(request, accountAddress):
+    """(quote, True), or (message of the failure, False)."""
+    try:
+        return await fetchQuote(request, accountAddress), True
+    except QuoteError as e:
+        return str(e), False
+
+
+class TurnPrefetch:
+    """Prefetched data of a single turn, must be finished once the intent is handled."""
+
+    def __init__(self, accountAddress, conversation, messages):
+        self.accountAddress = accountAddress
+        self.messages = messages
+        # Last quote shown in the conversation, and the one to store once the turn is saved
+        self.previous_quote = (conversation or {}).get('lastQuote')
+        self.last_quote = None
+        self.balance_task = None
+        self.quote_task = None
+        self.quote_request = None
+        # Whether the last quote of the turn succeeded
+        self.quoted = False
+
+    def start(self):
+        """Start the speculative fetches, must be called from the event loop."""
+        self.balance_task = asyncio.ensure_future(fetch_balance(self.accountAddress))
+        _count("balance_started")
+
+        self.quote_request = self._last_quote_request()
+        if self.quote_request is not None:
+            self.quote_task = asyncio.ensure_future(quote_or_error(self.quote_request, self.accountAddress))
+            _count("quote_started")
+
+    async def balance(self):
+        """Account balance, from the prefetch if it is available and succeeded."""
+        task, self.balance_task = self.balance_task, None
+        if task is not None:
+            try:
+                result = await task
+                _count("balance_used")
+                return result
+            except Exception as e:
+                log.warning("Balance prefetch failed, fetching again: %s", e)
+        return await fetch_balance(self.accountAddress)
+
+    async def quote(self, request):
+        """
+        Quote for a single swap, from the prefetch if it was for the same swap,
+        or the message of its failure. Sets quoted to whether it succeeded.
+        """
+        task, self.quote_task = self.quote_task, None
+        if task is not None:
+            if quote_key(request) == quote_key(self.quote_request):
+                try:
+                    result, self.quoted = await task
+                    _count("quote_used")
+                    return result
+                except Exception as e:
+                    log.warning("Quote prefetch failed, fetching again: %s", e)
+            else:
+                _count("quote_mismatched")
+                self._drop(task, "quote_wasted")
+        result, self.quoted = await quote_or_error(request, self.accountAddress)
+        return result
+
+    def remember_quote(self, request, answer):
+        """
+        Record the quote shown to the user, so the next turn can prefetch it and
+        a bare confirmation can run it. Only a quote that succeeded and that the
+        model's answer proposes as it is is remembered, the user never saw the
+        parameters of the others. It is stored with the turn, see last_quote.
+        """
+        if self.quoted and proposes_swap(answer, request):
+            self.last_quote = {"request": dict(request), "response": answer['response']}
+        else:
+            self.last_quote = None
+
+    def finish(self):
+        """Drop whatever the intent did not need."""
+        if self.balance_task is not None:
+            self._drop(self.balance_task, "balance_wasted")
+            self.balance_task = None
+        if self.quote_task is not None:
+            self._drop(self.quote_task, "quote_wasted")
+            self.quote_task = None
+
+    def _last_quote_request(self):
+        """The quote request of the previous turn, if the last AI message was that quote."""
+        last_quote = self.previous_quote
+        if not isinstance(last_quote, dict) or not isinstance(last_quote.get('request'), dict):
+            return None
+        last_ai_message = next((m for m in reversed(self.messages) if m['role'] == "assistant"), None)
+        if last_ai_message is None or last_ai_message['content'] != last_quote.get('response'):
+            return None
+        return last_quote['request']
+
+    def _drop(self, task, stat):
+        _count(stat)
+        task.cancel()
+        # Retrieve the outcome so a failed speculation is not reported as never retrieved
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
@@ -1,10 +1,8 @@
+import json
 
+from token_registry import get_registry
 
-
-
-
-
-firstPrompt =  \
+firstPromptTemplate =  \
 """
 You are Feelan smart and friendly. Your response should always be a python dictionary of this format: {"intent": "user-assistance", "response": a string-like answer}.
 Possible intents are: swap_intent, swap_function, multiswap_intent, multiswap_function, user-assistance, account_balance, transfer_token, transfer_function, create-process, query-process, about-process. Make sure to include the intent in the response.
@@ -27,12 +25,31 @@ create-process: {"intent": "create-process", "response": {"tags": [{ name: 'Name
 query-process: {"intent": "query-process", "response": {"query": string data}}. A query can be just a word such as: Inbox, user_id, ao.env ecc.
 run-process: {"intent": "run-process", "response": {"data": short description of the request}}.
 Possible tokens:
-[{"name": "Wrapped Matic", "symbol": "WMATIC"}, {"name": "USD Coin (PoS)", "symbol": "USDC.e"}, {"name": "USD Coin", "symbol": "USDC"}, {"name": "(PoS) Tether USD", "symbol": "USDT"}, {"name": "(PoS) Wrapped BTC", "symbol": "WBTC"}, {"name": "Wrapped Ether", "symbol": "WETH"}, {"name": "Uniswap (PoS)", "symbol": "UNI"}]
+<TOKENS>
  Your response should always be a python dictionary of this format: "{"intent": "user-assistance", "response": a string-like answer}"
  Make sure to include the intent in the response.
 """
 
 
+def prompt_token_list(registry):
+    """Every token of the registry, once per symbol like lookup()."""
+    tokens = {}
+    for token in registry.tokens():
+        tokens.setdefault(token['symbol'], {"name": token['name'], "symbol": token['symbol']})
+    return json.dumps(list(tokens.values()))
+
+_first_prompt_cache = {}
+
+def first_prompt():
+    """First prompt with the token list of the registry, rebuilt when valid_tokens.json changes."""
+    registry = get_registry()
+    version = registry.refresh()
+    if _first_prompt_cache.get('version') != version:
+        _first_prompt_cache['prompt'] = firstPromptTemplate.replace("<TOKENS>", prompt_token_list(registry))
+        _first_prompt_cache['version'] = version
+    return _first_prompt_cache['prompt']
+
+
 secondPrompt = \
 """
 You are Feelan smart and friendly. Make sure to include the intent in the response.
@@ -0,0 +1,184 @@
+"""
+Short-lived cache of Uniswap quotes returned by the Node.js server.
+
+Quotes are keyed on (chainId, walletAddress, tokenInAddress, tokenOutAddress,
+amountIn). The wallet is part of the key because the Node.js server embeds
+the wallet's token balances in every quote. With interpolation enabled, a
+quote for a liquid pair can also be estimated by scaling a recent quote for
+a nearby amount of the same pair.
+
+Only used for quotes shown to the user, never for swap execution.
+
+Configuration:
+    QUOTE_CACHE_TTL                 seconds a quote stays valid (default 15, 0 disables the cache)
+    QUOTE_CACHE_SIZE                maximum number of cached quotes (default 2048)
+    QUOTE_INTERPOLATION             1 to estimate quotes from nearby amounts (default 0)
+    QUOTE_INTERPOLATION_MAX_DELTA   maximum relative amount difference (default 0.1)
+    QUOTE_LIQUID_TOKENS             symbols of the tokens considered liquid
+"""
+import decimal
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from token_registry import get_registry, TokenNotFoundError
+
+DEFAULT_LIQUID_TOKENS = "WMATIC,MATIC,USDC,USDC.e,USDT,WETH,WBTC,DAI"
+
+# Fields scaled with the input amount, per kind of quote
+SCALED_FIELDS = {
+    'quote': ('estimatedOutput',),
+    'multiQuote': ('estimatedQuote',),
+}
+
+
+def to_decimal(value):
+    try:
+        return decimal.Decimal(str(value))
+    except decimal.InvalidOperation:
+        return None
+
+
+class QuoteCache:
+
+    def __init__(self, ttl=15, max_entries=2048, interpolation=False, max_delta=0.1, liquid_tokens=DEFAULT_LIQUID_TOKENS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.interpolation = interpolation
+        self.max_delta = decimal.Decimal(str(max_delta))
+        self.liquid_symbols = [symbol.strip() for symbol in liquid_tokens.split(",") if symbol.strip()]
+
+        self._entries = OrderedDict()
+        # (kind, chainId, wallet, tokenIn, tokenOut) -> {amount: key}, for interpolation
+        self._by_pair = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "interpolated_hits": 0,
+            "misses": 0,
+            "round_trips_avoided": 0,
+            "legs_avoided": 0,
+            "invalidations": 0,
+        }
+
+    @staticmethod
+    def pair_key(kind, chainId, walletAddress, tokenInAddress, tokenOutAddress):
+        return (kind, chainId, (walletAddress or '').lower(), tokenInAddress.lower(), tokenOutAddress.lower())
+
+    def get(self, kind, chainId, walletAddress, tokenInAddress, tokenOutAddress, amountIn):
+        """
+        Return (quote, interpolated) or None. The quote is a copy of the
+        payload returned by the Node.js server for that request.
+        """
+        if not self.ttl:
+            return None
+        pair = self.pair_key(kind, chainId, walletAddress, tokenInAddress, tokenOutAddress)
+        amount = to_decimal(amountIn)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(pair + (amount,))
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(pair + (amount,))
+                self._stats["hits"] += 1
+                return dict(entry[0]), False
+
+            nearby = self._nearby(pair, amount, now) if self.interpolation else None
+            if nearby is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["interpolated_hits"] += 1
+
+        cached_amount, quote = nearby
+        return self._scale(kind, quote, amount / cached_amount), True
+
+    def put(self, kind, chainId, walletAddress, tokenInAddress, tokenOutAddress, amountIn, quote):
+        if not self.ttl:
+            return
+        pair = self.pair_key(kind, chainId, walletAddress, tokenInAddress, tokenOutAddress)
+        amount = to_decimal(amountIn)
+        if amount is None:
+            return
+        with self._lock:
+            self._entries[pair + (amount,)] = (dict(quote), time.monotonic())
+            self._entries.move_to_end(pair + (amount,))
+            self._by_pair.setdefault(pair, {})[amount] = pair + (amount,)
+            while len(self._entries) > self.max_entries:
+                oldest, _ = self._entries.popitem(last=False)
+                self._forget(oldest)
+
+    def count_avoided(self, round_trips=0, legs=0):
+        with self._lock:
+            self._stats["round_trips_avoided"] += round_trips
+            self._stats["legs_avoided"] += legs
+
+    def invalidate_wallet(self, walletAddress):
+        """Drop every quote of a wallet, its balances changed."""
+        wallet = (walletAddress or '').lower()
+        with self._lock:
+            stale = [key for key in self._entries if key[2] == wallet]
+            for key in stale:
+                del self._entries[key]
+                self._forget(key)
+            if stale:
+                self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        return stats
+
+    def _forget(self, key):
+        """Remove a key from the pair index. Caller holds the lock."""
+        amounts = self._by_pair.get(key[:5])
+        if amounts is not None:
+            amounts.pop(key[5], None)
+            if not amounts:
+                del self._by_pair[key[:5]]
+
+    def _nearby(self, pair, amount, now):
+        """Fresh quote of the same pair for the closest amount within max_delta. Caller holds the lock."""
+        if amount is None or amount <= 0 or not self._is_liquid(pair):
+            return None
+        best = None
+        for cached_amount, key in self._by_pair.get(pair, {}).items():
+            entry = self._entries.get(key)
+            if entry is None or now - entry[1] >= self.ttl or not cached_amount:
+                continue
+            delta = abs(amount - cached_amount) / cached_amount
+            if delta <= self.max_delta and (best is None or delta < best[0]):
+                best = (delta, cached_amount, entry[0])
+        return None if best is None else best[1:]
+
+    def _is_liquid(self, pair):
+        registry = get_registry()
+        liquid = set()
+        for symbol in self.liquid_symbols:
+            try:
+                liquid.add(registry.address(symbol).lower())
+            except TokenNotFoundError:
+                continue
+        return pair[3] in liquid and pair[4] in liquid
+
+    def _scale(self, kind, quote, ratio):
+        """Linear price estimate for another amount, ignoring price impact."""
+        quote = dict(quote)
+        for field in SCALED_FIELDS[kind]:
+            value = to_decimal(quote.get(field))
+            if value is not None:
+                quote[field] = str(value * ratio)
+        if kind == 'quote':
+            output, gas = to_decimal(quote.get('estimatedOutput')), to_decimal(quote.get('gasUsedQuoteToken'))
+            if output is not None and gas is not None:
+                quote['gasAdjustedQuote'] = str(output - gas)
+        return quote
+
+
+quote_cache = QuoteCache(
+    ttl=float(os.environ.get("QUOTE_CACHE_TTL", 15)),
+    max_entries=int(os.environ.get("QUOTE_CACHE_SIZE", 2048)),
+    interpolation=os.environ.get("QUOTE_INTERPOLATION", "0") == "1",
+    max_delta=float(os.environ.get("QUOTE_INTERPOLATION_MAX_DELTA", 0.1)),
+    liquid_tokens=os.environ.get("QUOTE_LIQUID_TOKENS", DEFAULT_LIQUID_TOKENS),
+)
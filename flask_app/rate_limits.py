@@ -0,0 +1,54 @@
+"""
+Storage of the Flask-Limiter counters on the shared state, so the limits
+hold across the workers and nodes of the server instead of per process.
+
+The limits package finds storages by the scheme of their URI: importing
+this module registers "shared://", used with the moving-window strategy,
+which is answered with the sliding window counter of shared_state.
+"""
+import time
+
+from limits.storage import MovingWindowSupport, Storage
+
+from shared_state import SharedStateError, shared_state
+
+STORAGE_URI = "shared://"
+STRATEGY = "moving-window"
+
+
+class SharedStateStorage(Storage, MovingWindowSupport):
+
+    STORAGE_SCHEME = ["shared"]
+
+    def __init__(self, uri=None, **options):
+        super().__init__(uri, **options)
+        self.state = shared_state
+
+    @property
+    def base_exceptions(self):
+        return SharedStateError
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        """Fixed window counter, for the fixed-window strategy."""
+        return self.state.incr(f"limits:{key}", amount, ttl=expiry)
+
+    def get(self, key):
+        return int(self.state.get(f"limits:{key}") or 0)
+
+    def get_expiry(self, key):
+        return int(self.state.expires_at(f"limits:{key}") or time.time())
+
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        return self.state.sliding_window_hit(f"limits:{key}", limit, expiry, amount)
+
+    def get_moving_window(self, key, limit, expiry):
+        return self.state.sliding_window(f"limits:{key}", expiry)
+
+    def check(self):
+        return self.state.check()
+
+    def reset(self):
+        self.state.delete_prefix("limits:")
+
+    def clear(self, key):
+        self.state.delete(f"limits:{key}")
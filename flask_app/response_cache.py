@@ -0,0 +1,161 @@
+"""
+Cache of the model's user-assistance answers.
+
+General questions repeat across users and conversations, so the answer of
+the first model call is cached when its intent is user-assistance. The key
+is a hash of the model and of every message of the call: the last
+RESPONSE_CACHE_CONTEXT messages normalized for case and whitespace, and the
+earlier context (system prompt, rolling summary and older turns) as it is,
+so an answer is only shared between conversations that told the model the
+same things. Other intents are never stored: they depend on live account state, which the
+stage prompts fetch on every turn. Callers bypass the cache while a quote
+or a confirmation is pending.
+
+When the shared state is shared between workers (SHARED_STATE_URL), answers
+are also stored there, so an answer cached by one worker is a hit in all of
+them. Each worker keeps its own copies in front of it.
+
+Configuration:
+    RESPONSE_CACHE_TTL        seconds an answer stays valid (default 3600, 0 disables the cache)
+    RESPONSE_CACHE_SIZE       maximum number of cached answers (default 1024)
+    RESPONSE_CACHE_CONTEXT    messages of the conversation in the key (default 3)
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from logs import get_logger
+from shared_state import SharedStateError, shared_state
+
+log = get_logger(__name__)
+
+CACHED_INTENTS = ("user-assistance",)
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text):
+    return WHITESPACE.sub(" ", text).strip().lower().rstrip("?!. ")
+
+
+class ResponseCache:
+
+    def __init__(self, ttl=3600, max_entries=1024, context=3, shared=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.context = context
+        self.shared = shared
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "shared_hits": 0, "misses": 0, "stores": 0, "bypassed": 0, "seconds_saved": 0.0}
+
+    def key(self, model, messages):
+        """Cache key of a turn, messages are those of its model call, ending with the new user message."""
+        if not self.ttl:
+            return None
+        messages = list(messages)
+        split = max(len(messages) - self.context, 0)
+        digest = hashlib.sha256()
+        digest.update(model.encode("utf-8"))
+        earlier = [(message['role'], message['content']) for message in messages[:split]]
+        digest.update(hashlib.sha256(json.dumps(earlier).encode("utf-8")).digest())
+        recent = [(message['role'], normalize(message['content'])) for message in messages[split:]]
+        digest.update(json.dumps(recent).encode("utf-8"))
+        return digest.hexdigest()
+
+    def bypass(self):
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def get(self, key):
+        """Cached answer of a turn, None on a miss."""
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                self._stats["seconds_saved"] += entry[2]
+                return dict(entry[0])
+
+        entry = self._get_shared(key)
+        with self._lock:
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._store(key, entry)
+            self._stats["shared_hits"] += 1
+            self._stats["seconds_saved"] += entry[2]
+            return dict(entry[0])
+
+    def put(self, key, ai_response, elapsed):
+        """Store the answer of a turn if its intent can be cached, elapsed is the latency of the model call."""
+        if key is None or not isinstance(ai_response, dict) or ai_response.get("intent") not in CACHED_INTENTS:
+            return
+        with self._lock:
+            self._store(key, (dict(ai_response), time.monotonic(), elapsed))
+            self._stats["stores"] += 1
+        if self.shared is not None:
+            try:
+                self.shared.set(f"answers:{key}", json.dumps([ai_response, time.time(), elapsed]), ttl=self.ttl)
+            except SharedStateError as e:
+                log.warning("Could not share a cached answer: %s", e)
+
+    async def aget(self, key):
+        """get() from the event loop, the shared state is read in a thread."""
+        if self.shared is None:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key, ai_response, elapsed):
+        """put() from the event loop, the shared state is written in a thread."""
+        if self.shared is None:
+            return self.put(key, ai_response, elapsed)
+        await asyncio.to_thread(self.put, key, ai_response, elapsed)
+
+    def _get_shared(self, key):
+        """Entry of the shared state, None on a miss or when it fails."""
+        if self.shared is None:
+            return None
+        try:
+            value = self.shared.get(f"answers:{key}")
+        except SharedStateError as e:
+            log.warning("Could not read a shared answer: %s", e)
+            return None
+        if value is None:
+            return None
+        ai_response, stored_at, elapsed = json.loads(value)
+        # Expires locally when it expires in the shared state
+        return ai_response, time.monotonic() - (time.time() - stored_at), elapsed
+
+    def _store(self, key, entry):
+        """Insert an entry and evict the least recently used ones. Caller holds the lock."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["shared_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["shared_hits"]) / lookups, 3) if lookups else None
+        stats["seconds_saved"] = round(stats["seconds_saved"], 3)
+        return stats
+
+
+response_cache = ResponseCache(
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+    max_entries=int(os.environ.get("RESPONSE_CACHE_SIZE", 1024)),
+    context=int(os.environ.get("RESPONSE_CACHE_CONTEXT", 3)),
+    shared=shared_state if shared_state.is_shared else None,
+)
@@ -0,0 +1,312 @@
+"""
+State shared by the worker processes of the server: rate limit counters and
+hot cache entries.
+
+Under gunicorn every worker is its own process, so in-process counters and
+caches are per worker: a limit of 50 per hour really allows 50 per hour per
+worker, and an answer cached by one worker is a miss in the others. The
+backend is selected with SHARED_STATE_URL:
+
+    memory://                   in-process, for a single worker (default)
+    sqlite:///shared_state.db   SQLite database shared by the workers of one node, also used in tests
+    redis://host:6379/0         Redis, shared by every node
+
+Counters are atomic on every backend. Rate limits use a sliding window
+counter: the hits of the current fixed window plus those of the previous
+one, weighted by how much of it is still inside the sliding window. A hit
+over the limit is counted and given back, so concurrent hits never let more
+than the limit through.
+
+Backend failures are raised as SharedStateError, caches treat them as misses.
+
+Configuration:
+    SHARED_STATE_URL    backend of the shared state (default memory://)
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from sqlite_store import Transaction
+
+class SharedStateError(Exception):
+    """The shared state backend failed."""
+
+
+class MemoryBackend:
+    """Values with an expiry, in this process."""
+
+    name = "memory"
+    errors = ()
+
+    def __init__(self, sweep_every=1024):
+        self._values = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.sweep_every = sweep_every
+
+    def get(self, key):
+        with self._lock:
+            return self._live(key, time.time())
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+            self._written()
+
+    def incr(self, key, amount, ttl):
+        now = time.time()
+        with self._lock:
+            value = int(self._live(key, now) or 0) + amount
+            expires_at = self._values[key][1] if key in self._values else (now + ttl if ttl else None)
+            self._values[key] = (value, expires_at)
+            self._written()
+            return value
+
+    def expires_at(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            return entry[1] if entry is not None else None
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._values if key.startswith(prefix)]:
+                del self._values[key]
+
+    def _live(self, key, now):
+        """Value of a key, dropped if it expired. Caller holds the lock."""
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= now:
+            del self._values[key]
+            return None
+        return entry[0]
+
+    def _written(self):
+        """Drop the expired values every sweep_every writes. Caller holds the lock."""
+        self._writes += 1
+        if self._writes % self.sweep_every == 0:
+            now = time.time()
+            for key in [key for key, (_, expires_at) in self._values.items() if expires_at is not None and expires_at <= now]:
+                del self._values[key]
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS shared_state_expiry ON shared_state (expires_at);
+"""
+
+
+class SQLiteBackend:
+    """Values with an expiry in a SQLite database, shared by the processes of one node."""
+
+    name = "sqlite"
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        """One connection per thread and process, sqlite3 connections are not thread safe."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SQLITE_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key, value, ttl):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl else None),
+        )
+
+    def incr(self, key, amount, ttl):
+        now = time.time()
+        with Transaction(self.conn) as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, now)
+            ).fetchone()
+            value, expires_at = (int(row[0]) + amount, row[1]) if row is not None else (amount, now + ttl if ttl else None)
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)", (key, str(value), expires_at)
+            )
+            # Expired rows are dropped once in a while by the writers
+            if value == amount:
+                conn.execute("DELETE FROM shared_state WHERE expires_at <= ?", (now,))
+        return value
+
+    def expires_at(self, key):
+        row = self.conn.execute("SELECT expires_at FROM shared_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def delete(self, key):
+        self.conn.execute("DELETE FROM shared_state WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix):
+        self.conn.execute("DELETE FROM shared_state WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+
+# INCRBY and set the expiry of a new counter in one step
+REDIS_INCR = """
+local value = redis.call('INCRBY', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 and redis.call('PTTL', KEYS[1]) < 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return value
+"""
+
+
+class RedisBackend:
+
+    name = "redis"
+
+    def __init__(self, url):
+        import redis
+        self.errors = (redis.RedisError,)
+        self.client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=1)
+        self._incr = self.client.register_script(REDIS_INCR)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    def incr(self, key, amount, ttl):
+        return int(self._incr(keys=[key], args=[amount, int(ttl * 1000) if ttl else 0]))
+
+    def expires_at(self, key):
+        ttl = self.client.pttl(key)
+        return time.time() + ttl / 1000 if ttl >= 0 else None
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_prefix(self, prefix):
+        keys = list(self.client.scan_iter(match=prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class SharedState:
+    """
+    Keys and counters of a backend, under a common prefix. Values are strings,
+    ttl is in seconds, None or 0 meaning no expiry.
+    """
+
+    def __init__(self, backend, prefix="feelan:"):
+        self.backend = backend
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._stats = {"gets": 0, "hits": 0, "sets": 0, "incrs": 0, "rejected": 0, "errors": 0}
+
+    def get(self, key):
+        value = self._call("get", self.prefix + key)
+        self._count("gets")
+        if value is not None:
+            self._count("hits")
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._call("set", self.prefix + key, value, ttl)
+        self._count("sets")
+
+    def incr(self, key, amount=1, ttl=None):
+        """Add amount to a counter atomically and return its new value. ttl applies to a new counter."""
+        value = self._call("incr", self.prefix + key, amount, ttl)
+        self._count("incrs")
+        return value
+
+    def expires_at(self, key):
+        """Time the key expires, None if it has no expiry or does not exist."""
+        return self._call("expires_at", self.prefix + key)
+
+    def delete(self, key):
+        self._call("delete", self.prefix + key)
+
+    def delete_prefix(self, prefix):
+        self._call("delete_prefix", self.prefix + prefix)
+
+    def sliding_window_hit(self, key, limit, window, amount=1):
+        """Count amount hits of key if the hits of the last window seconds stay within limit. Returns whether they were counted."""
+        now = time.time()
+        bucket = int(now // window)
+        previous = int(self.get(f"{key}/{bucket - 1}") or 0)
+        current = self.incr(f"{key}/{bucket}", amount, ttl=2 * window)
+        if previous * (1 - now % window / window) + current > limit:
+            # Give the hits back, the ones of concurrent requests are still counted
+            self.incr(f"{key}/{bucket}", -amount, ttl=2 * window)
+            self._count("rejected")
+            return False
+        return True
+
+    def sliding_window(self, key, window):
+        """(start of the current fixed window, estimated hits in the last window seconds)."""
+        now = time.time()
+        bucket = int(now // window)
+        previous = int(self.get(f"{key}/{bucket - 1}") or 0)
+        current = int(self.get(f"{key}/{bucket}") or 0)
+        return bucket * window, int(previous * (1 - now % window / window) + current)
+
+    @property
+    def is_shared(self):
+        """Whether other processes see the state, caches in front of it are pointless otherwise."""
+        return self.backend.name != "memory"
+
+    def check(self):
+        """Whether the backend answers."""
+        try:
+            self.get("check")
+        except SharedStateError:
+            return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["backend"] = self.backend.name
+        return stats
+
+    def _call(self, operation, *args):
+        try:
+            return getattr(self.backend, operation)(*args)
+        except self.backend.errors as e:
+            self._count("errors")
+            raise SharedStateError(f"Shared state {operation} failed: {e}") from e
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+
+def create_backend(url):
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"Unknown SHARED_STATE_URL {url!r}, expected memory://, sqlite:///path or redis://")
+
+shared_state = SharedState(create_backend(os.environ.get("SHARED_STATE_URL", "memory://")))
@@ -0,0 +1,195 @@
+"""
+SQLite conversation backend for local deployments, benchmarks and tests.
+
+The database runs in WAL mode so readers never block the writer. Messages
+are rows keyed by (userId, conversationId, ordinal): appending a message is
+a single insert instead of rewriting the whole history, and conversations
+are looked up by their (userId, id) primary key.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+
+from conversation_store import ConversationBackend, INDEX_FIELDS, LEGACY_ROLES
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    userId TEXT NOT NULL,
+    id TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (userId, id)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    userId TEXT NOT NULL,
+    conversationId TEXT NOT NULL,
+    ordinal INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (userId, conversationId, ordinal)
+);
+"""
+
+
+class SQLiteConversationBackend(ConversationBackend):
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self.conn.executescript(SCHEMA)
+        self.migrate()
+
+    @property
+    def conn(self):
+        """One connection per thread, sqlite3 connections are not thread safe."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def migrate(self):
+        """Schema version 1: messages use the roles of the OpenAI API."""
+        with self.transaction() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+                return
+            for legacy, role in LEGACY_ROLES.items():
+                conn.execute("UPDATE messages SET role = ? WHERE role = ?", (role, legacy))
+            conn.execute("PRAGMA user_version = 1")
+
+    def transaction(self):
+        return Transaction(self.conn)
+
+    def load_index(self, userId):
+        rows = self.conn.execute(
+            "SELECT id, metadata FROM conversations WHERE userId = ? ORDER BY rowid", (userId,)
+        ).fetchall()
+        index = {}
+        for conversationId, metadata in rows:
+            metadata = json.loads(metadata)
+            index[conversationId] = {field: metadata[field] for field in INDEX_FIELDS if field in metadata}
+        return index
+
+    def load_conversation(self, userId, conversationId):
+        row = self.conn.execute(
+            "SELECT metadata FROM conversations WHERE userId = ? AND id = ?", (userId, conversationId)
+        ).fetchone()
+        if row is None:
+            return None
+        conversation = json.loads(row[0])
+        conversation['messages'] = [
+            {"role": role, "content": content}
+            for role, content in self.conn.execute(
+                "SELECT role, content FROM messages WHERE userId = ? AND conversationId = ? ORDER BY ordinal",
+                (userId, conversationId),
+            )
+        ]
+        return conversation
+
+    def index_version(self, userId):
+        digest = hashlib.sha1()
+        for conversationId, metadata in self.conn.execute(
+            "SELECT id, metadata FROM conversations WHERE userId = ? ORDER BY rowid", (userId,)
+        ):
+            digest.update(f"{conversationId}\0{metadata}\0".encode("utf-8"))
+        return digest.hexdigest()
+
+    def load_messages(self, userId, conversationId, start=0, stop=None):
+        # Only the requested range of rows is read
+        conn = self.conn
+        if conn.execute(
+            "SELECT 1 FROM conversations WHERE userId = ? AND id = ?", (userId, conversationId)
+        ).fetchone() is None:
+            return None
+        total = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE userId = ? AND conversationId = ?", (userId, conversationId)
+        ).fetchone()[0]
+        bounds = range(total)[start:stop]
+        rows = conn.execute(
+            "SELECT role, content FROM messages WHERE userId = ? AND conversationId = ? "
+            "AND ordinal >= ? AND ordinal < ? ORDER BY ordinal",
+            (userId, conversationId, bounds.start, bounds.stop),
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows], total
+
+    def save_conversation(self, userId, conversation, update_index=False):
+        # The index is the conversations table itself, always up to date
+        metadata = {key: value for key, value in conversation.items() if key != 'messages'}
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO conversations (userId, id, metadata) VALUES (?, ?, ?) "
+                "ON CONFLICT (userId, id) DO UPDATE SET metadata = excluded.metadata",
+                (userId, conversation['id'], json.dumps(metadata)),
+            )
+            conn.execute("DELETE FROM messages WHERE userId = ? AND conversationId = ?", (userId, conversation['id']))
+            self._insert_messages(conn, userId, conversation['id'], conversation.get('messages', []), 0)
+
+    def create_conversation(self, userId, conversation):
+        metadata = {key: value for key, value in conversation.items() if key != 'messages'}
+        with self.transaction() as conn:
+            created = conn.execute(
+                "INSERT INTO conversations (userId, id, metadata) VALUES (?, ?, ?) ON CONFLICT (userId, id) DO NOTHING",
+                (userId, conversation['id'], json.dumps(metadata)),
+            ).rowcount
+            if created:
+                self._insert_messages(conn, userId, conversation['id'], conversation.get('messages', []), 0)
+        return bool(created)
+
+    def append_messages(self, userId, conversationId, messages):
+        with self.transaction() as conn:
+            exists = conn.execute(
+                "SELECT 1 FROM conversations WHERE userId = ? AND id = ?", (userId, conversationId)
+            ).fetchone()
+            if exists is None:
+                return False
+            next_ordinal = conn.execute(
+                "SELECT COALESCE(MAX(ordinal) + 1, 0) FROM messages WHERE userId = ? AND conversationId = ?",
+                (userId, conversationId),
+            ).fetchone()[0]
+            self._insert_messages(conn, userId, conversationId, messages, next_ordinal)
+        return True
+
+    def update_metadata(self, userId, conversationId, fields):
+        # Only the metadata row changes, messages are left alone
+        with self.transaction() as conn:
+            row = conn.execute(
+                "SELECT metadata FROM conversations WHERE userId = ? AND id = ?", (userId, conversationId)
+            ).fetchone()
+            if row is None:
+                return None
+            metadata = json.loads(row[0])
+            metadata.update(fields)
+            conn.execute(
+                "UPDATE conversations SET metadata = ? WHERE userId = ? AND id = ?",
+                (json.dumps(metadata), userId, conversationId),
+            )
+        return self.load_conversation(userId, conversationId)
+
+    def _insert_messages(self, conn, userId, conversationId, messages, first_ordinal):
+        conn.executemany(
+            "INSERT INTO messages (userId, conversationId, ordinal, role, content) VALUES (?, ?, ?, ?, ?)",
+            [
+                (userId, conversationId, first_ordinal + i, message['role'], message['content'])
+                for i, message in enumerate(messages)
+            ],
+        )
+
+
+class Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
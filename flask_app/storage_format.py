@@ -0,0 +1,132 @@
+"""
+Serialized form of the conversation objects stored on the bucket.
+
+A stored object is a small header followed by the JSON document, compressed:
+
+    b"FLN"  magic, never the first bytes of a JSON text
+    1 byte  schema version, FORMAT_VERSION
+    1 byte  compression, see CODECS
+    ...     payload
+
+Objects written before this format are plain JSON text; decode() recognizes
+them by the missing magic and parses them as they are, so they are read
+transparently and rewritten in the new format by their next write. Objects
+that cannot be read raise StorageFormatError.
+
+JSON is handled by orjson when it is installed, several times faster than
+the standard library on conversations, and by json otherwise. Both produce
+and accept the same documents.
+
+Configuration:
+    STORAGE_COMPRESSION         zstd, gzip or none (default gzip); zstd needs the zstandard package
+    STORAGE_COMPRESSION_LEVEL   compression level (default 3 for zstd, 1 for gzip)
+    STORAGE_COMPRESSION_MIN_BYTES  documents smaller than this are stored uncompressed (default 256)
+"""
+import gzip
+import json
+import os
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"FLN"
+FORMAT_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 2
+
+# Compression id of the header, by name
+CODECS = {"none": 0, "gzip": 1, "zstd": 2}
+DEFAULT_LEVELS = {"none": 0, "gzip": 1, "zstd": 3}
+
+
+class StorageFormatError(ValueError):
+    """A stored object is corrupt or written by a newer version."""
+
+
+# Errors of a corrupt payload: bad gzip or zstd data, invalid JSON
+PAYLOAD_ERRORS = (OSError, EOFError, zlib.error, ValueError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def dumps_json(data):
+    """Serialize a document to UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def loads_json(payload):
+    """Parse UTF-8 JSON bytes or text."""
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload)
+
+
+class StorageFormat:
+
+    def __init__(self, compression="gzip", level=None, min_bytes=256):
+        if compression not in CODECS:
+            raise ValueError(f"Unknown storage compression {compression!r}, expected one of {', '.join(CODECS)}")
+        if compression == "zstd" and zstandard is None:
+            raise RuntimeError("STORAGE_COMPRESSION=zstd needs the zstandard package")
+        self.compression = compression
+        self.level = DEFAULT_LEVELS[compression] if level is None else level
+        self.min_bytes = min_bytes
+
+    def encode(self, data):
+        """Serialize a document to the stored bytes."""
+        payload = dumps_json(data)
+        compression = self.compression if len(payload) >= self.min_bytes else "none"
+        if compression == "gzip":
+            # mtime=0 so equal documents give equal bytes
+            payload = gzip.compress(payload, compresslevel=self.level, mtime=0)
+        elif compression == "zstd":
+            payload = zstandard.ZstdCompressor(level=self.level).compress(payload)
+        return MAGIC + bytes((FORMAT_VERSION, CODECS[compression])) + payload
+
+    def decode(self, stored):
+        """Parse stored bytes, in this format or legacy plain JSON."""
+        if isinstance(stored, str):
+            stored = stored.encode("utf-8")
+        if not stored.startswith(MAGIC):
+            try:
+                return loads_json(stored)
+            except ValueError as e:
+                raise StorageFormatError(f"Stored object is neither in this format nor JSON: {e}") from e
+
+        if len(stored) < HEADER_SIZE:
+            raise StorageFormatError("Truncated stored object")
+        version, codec = stored[len(MAGIC)], stored[len(MAGIC) + 1]
+        if version > FORMAT_VERSION:
+            raise StorageFormatError(f"Stored object has format version {version}, this version reads up to {FORMAT_VERSION}")
+
+        if codec == CODECS["zstd"] and zstandard is None:
+            raise StorageFormatError("Stored object is compressed with zstd, install the zstandard package")
+        if codec not in CODECS.values():
+            raise StorageFormatError(f"Unknown compression {codec} of stored object")
+
+        payload = stored[HEADER_SIZE:]
+        try:
+            if codec == CODECS["gzip"]:
+                payload = gzip.decompress(payload)
+            elif codec == CODECS["zstd"]:
+                payload = zstandard.ZstdDecompressor().decompress(payload)
+            return loads_json(payload)
+        except PAYLOAD_ERRORS as e:
+            raise StorageFormatError(f"Corrupt stored object: {e}") from e
+
+
+def from_environment():
+    level = os.environ.get("STORAGE_COMPRESSION_LEVEL")
+    return StorageFormat(
+        compression=os.environ.get("STORAGE_COMPRESSION", "gzip").lower(),
+        level=int(level) if level else None,
+        min_bytes=int(os.environ.get("STORAGE_COMPRESSION_MIN_BYTES", 256)),
+    )
+
+storage_format = from_environment()
@@ -0,0 +1,112 @@
+"""
+Incremental parser for the {"intent": ..., "response": ...} envelope the model
+answers with, fed with completion deltas while they stream in.
+
+It detects the intent as soon as its value is complete and decodes the
+"response" string on the fly, so the text can be forwarded to the client
+before the completion is done. Anything before the opening brace, such as a
+```json fence, is ignored. Responses that are not plain JSON (for instance a
+python dict with single quotes) are not detected and are left to
+process_response once the stream is over.
+"""
+
+# Intents whose response text is the final answer and can be streamed as is
+STREAMED_INTENTS = ("user-assistance",)
+
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', '/': '/', '"': '"', '\\': '\\'}
+
+
+class IntentStreamParser:
+
+    def __init__(self):
+        self.chunks = []
+        self.intent = None
+        # None until the response value starts, False if it is an object or a list
+        self.response_is_text = None
+
+        self._depth = 0
+        self._in_string = False
+        self._escape = None
+        self._high_surrogate = None
+        self._string = []
+        self._key = None
+        self._expect = 'key'
+        self._capture = None
+
+    @property
+    def text(self):
+        """The raw completion received so far."""
+        return ''.join(self.chunks)
+
+    def feed(self, chunk):
+        """Consume a completion delta, return the newly decoded response text."""
+        self.chunks.append(chunk)
+        out = []
+        for ch in chunk:
+            self._consume(ch, out)
+        return ''.join(out)
+
+    def _consume(self, ch, out):
+        if self._in_string:
+            if self._escape is not None:
+                self._escape += ch
+                if self._escape[0] == 'u':
+                    if len(self._escape) < 5:
+                        return
+                    self._emit_codepoint(int(self._escape[1:], 16), out)
+                else:
+                    self._emit(ESCAPES.get(ch, ch), out)
+                self._escape = None
+            elif ch == '\\':
+                self._escape = ''
+            elif ch == '"':
+                self._in_string = False
+                self._end_string()
+            else:
+                self._emit(ch, out)
+            return
+
+        if ch == '"':
+            self._in_string = True
+            self._string = []
+            if self._depth == 1 and self._expect == 'value' and self._key in ('intent', 'response'):
+                self._capture = self._key
+                if self._key == 'response':
+                    self.response_is_text = True
+        elif ch in '{[':
+            if self._depth == 1 and self._expect == 'value' and self._key == 'response':
+                self.response_is_text = False
+            self._depth += 1
+        elif ch in '}]':
+            self._depth -= 1
+        elif self._depth == 1:
+            if ch == ':':
+                self._expect = 'value'
+            elif ch == ',':
+                self._expect = 'key'
+
+    def _emit(self, text, out):
+        if self._capture == 'response':
+            out.append(text)
+        elif self._depth == 1:
+            # Keys and the intent value are short, everything else is skipped
+            self._string.append(text)
+
+    def _emit_codepoint(self, codepoint, out):
+        """Decode \\uXXXX escapes, joining UTF-16 surrogate pairs."""
+        if 0xD800 <= codepoint < 0xDC00:
+            self._high_surrogate = codepoint
+            return
+        if 0xDC00 <= codepoint < 0xE000 and self._high_surrogate is not None:
+            codepoint = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (codepoint - 0xDC00)
+        self._high_surrogate = None
+        self._emit(chr(codepoint), out)
+
+    def _end_string(self):
+        if self._depth != 1:
+            return
+        if self._expect == 'key':
+            self._key = ''.join(self._string)
+        elif self._capture == 'intent':
+            self.intent = ''.join(self._string)
+        self._capture = None
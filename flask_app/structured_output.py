@@ -0,0 +1,190 @@
+"""
+Structured output of the intent model calls.
+
+Every answer is an {"intent", "response"} object whose response has the
+shape of its intent, see INTENT_SCHEMAS. The shapes are enforced through
+the model's structured output: JSON mode by default, or strict JSON schemas
+for the models supporting them. Answers that still do not parse are first
+repaired locally (code fences, single quotes, text around the object)
+before process_response asks the model again. Once its retries are spent,
+process_response raises InvalidModelAnswer.
+
+Configuration:
+    STRUCTURED_OUTPUT   json_object (default), json_schema for strict schemas, or off
+"""
+import ast
+import json
+import os
+import re
+import threading
+
+TEXT = {"type": "string"}
+AMOUNT = {"type": ["string", "number"]}
+SWAP = {
+    "type": "object",
+    "properties": {"tokenIn": TEXT, "tokenOut": TEXT, "amount": AMOUNT},
+    "required": ["tokenIn", "tokenOut", "amount"],
+}
+SWAPS = {"type": "array", "items": SWAP}
+TRANSFER = {
+    "type": "object",
+    "properties": {"tokenIn": TEXT, "recipient": TEXT, "amount": AMOUNT},
+    "required": ["tokenIn", "recipient", "amount"],
+}
+TAG = {"type": "object", "properties": {"name": TEXT, "value": TEXT}, "required": ["name", "value"]}
+PROCESS_TAGS = {"type": "object", "properties": {"tags": {"type": "array", "items": TAG}}, "required": ["tags"]}
+PROCESS_QUERY = {"type": "object", "properties": {"query": TEXT}, "required": ["query"]}
+PROCESS_RUN = {"type": "object", "properties": {"data": TEXT}, "required": ["data"]}
+PROCESS_CODE = {"type": "object", "properties": {"code": TEXT}, "required": ["code"]}
+
+# Shape of the response of every intent. Stage prompts answer swap and
+# transfer intents with text once the quote or the balance is known.
+INTENT_SCHEMAS = {
+    "user-assistance": TEXT,
+    "swap_intent": {"anyOf": [SWAP, TEXT]},
+    "swap_function": SWAP,
+    "multiswap_intent": {"anyOf": [SWAPS, TEXT]},
+    "multiswap_function": {"anyOf": [SWAPS, SWAP]},
+    "account_balance": TEXT,
+    "transfer_token": TEXT,
+    "transfer_intent": TEXT,
+    "transfer_function": TRANSFER,
+    "create-process": PROCESS_TAGS,
+    "query-process": PROCESS_QUERY,
+    "run-process": {"anyOf": [PROCESS_RUN, PROCESS_CODE]},
+    "about-process": TEXT,
+}
+
+
+class InvalidModelAnswer(Exception):
+    """The model kept answering without a valid {"intent", "response"} object."""
+
+
+_stats = {"parsed": 0, "repaired": 0, "invalid": 0, "retries": 0, "failures": 0}
+_stats_lock = threading.Lock()
+
+
+def count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def response_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    answers = stats["parsed"] + stats["repaired"] + stats["invalid"]
+    stats["repair_rate"] = round(stats["repaired"] / answers, 3) if answers else None
+    stats["retry_rate"] = round(stats["retries"] / answers, 3) if answers else None
+    return stats
+
+
+def _strict(schema):
+    """Schema in the form required by strict structured outputs."""
+    if "anyOf" in schema:
+        return {"anyOf": [_strict(option) for option in schema["anyOf"]]}
+    if schema["type"] == "object":
+        return {
+            "type": "object",
+            "properties": {name: _strict(value) for name, value in schema["properties"].items()},
+            "required": list(schema["properties"]),
+            "additionalProperties": False,
+        }
+    if schema["type"] == "array":
+        return {"type": "array", "items": _strict(schema["items"])}
+    return dict(schema)
+
+def _options(schema):
+    return schema["anyOf"] if "anyOf" in schema else [schema]
+
+def response_schema():
+    """Strict JSON schema of an answer, the union of the shapes of every intent."""
+    shapes = []
+    for schema in INTENT_SCHEMAS.values():
+        for option in _options(schema):
+            if option not in shapes:
+                shapes.append(option)
+    return {
+        "type": "object",
+        "properties": {
+            "intent": {"type": "string", "enum": list(INTENT_SCHEMAS)},
+            "response": {"anyOf": [_strict(shape) for shape in shapes]},
+        },
+        "required": ["intent", "response"],
+        "additionalProperties": False,
+    }
+
+def response_format():
+    """response_format argument of the intent model calls, None when disabled."""
+    mode = os.environ.get("STRUCTURED_OUTPUT", "json_object")
+    if mode == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": "intent_response", "strict": True, "schema": response_schema()}}
+    if mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+def matches(value, schema):
+    """Whether value has the shape of schema, a small subset of JSON schema."""
+    if "anyOf" in schema:
+        return any(matches(value, option) for option in schema["anyOf"])
+    types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+    for kind in types:
+        if kind == "string" and isinstance(value, str):
+            return True
+        if kind == "number" and isinstance(value, (int, float)) and not isinstance(value, bool):
+            return True
+        if kind == "array" and isinstance(value, list):
+            return all(matches(item, schema["items"]) for item in value)
+        if kind == "object" and isinstance(value, dict):
+            return all(
+                name in value and matches(value[name], schema["properties"][name])
+                for name in schema.get("required", ())
+            )
+    return False
+
+def is_valid_response(json_data):
+    """Check that the answer has a known intent and a response of the shape of that intent."""
+    if not isinstance(json_data, dict) or 'intent' not in json_data or 'response' not in json_data:
+        return False
+    schema = INTENT_SCHEMAS.get(json_data['intent'])
+    return schema is not None and matches(json_data['response'], schema)
+
+
+CODE_FENCE = re.compile(r"```(?:json|python)?\s*(.*?)```", re.DOTALL)
+
+def parse_response(raw_response):
+    """
+    Parse an answer of the model into a dict, repairing it if needed.
+    Returns (data, repaired). Raises ValueError if it cannot be read.
+    """
+    if isinstance(raw_response, dict):
+        return raw_response, False
+    if not isinstance(raw_response, str):
+        raise ValueError("Unsupported type for raw_response")
+    try:
+        return json.loads(raw_response), False
+    except json.JSONDecodeError:
+        pass
+
+    text = raw_response
+    fenced = CODE_FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start == -1:
+        raise ValueError("No JSON object in the response")
+
+    # Object followed by trailing text
+    try:
+        data, _ = json.JSONDecoder().raw_decode(text, start)
+        return data, True
+    except json.JSONDecodeError:
+        pass
+    # Python dict literal, e.g. single quotes
+    end = text.rfind("}")
+    try:
+        data = ast.literal_eval(text[start:end + 1])
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        raise ValueError("The response could not be repaired")
+    if not isinstance(data, dict):
+        raise ValueError("The response is not an object")
+    return data, True
@@ -0,0 +1,12 @@
+"""
+Tests of the API server modules, run from the repository root or flask_app:
+
+    python -m pytest -q flask_app/tests
+
+The modules import each other by their flat names, like when main.py runs
+from flask_app.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
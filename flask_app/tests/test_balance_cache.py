@@ -0,0 +1,125 @@
+"""Balance cache: expiry, shared fetches, holds and fetches detached by an invalidation."""
+import asyncio
+
+import pytest
+
+import balance_cache as balance_cache_module
+from balance_cache import BalanceCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(balance_cache_module, "time", clock)
+    return clock
+
+
+class Balances:
+    """get_balance, counting its calls. Calls wait for release() when gated."""
+
+    def __init__(self, gated=False):
+        self.calls = 0
+        self.gate = asyncio.Event()
+        if not gated:
+            self.gate.set()
+
+    async def fetch(self):
+        self.calls += 1
+        call = self.calls
+        await self.gate.wait()
+        return f"balance {call}"
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_balances_expire_after_the_ttl(clock):
+    async def scenario():
+        cache, balances = BalanceCache(ttl=10), Balances()
+        first = await cache.get("0xABC", balances.fetch)
+        clock.now += 9
+        cached = await cache.get("0xabc", balances.fetch)
+        clock.now += 1
+        fresh = await cache.get("0xabc", balances.fetch)
+        return first, cached, fresh, balances.calls, cache.stats()
+
+    first, cached, fresh, calls, stats = run(scenario())
+    assert (first, cached, fresh, calls) == ("balance 1", "balance 1", "balance 2", 2)
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+def test_concurrent_requests_share_one_fetch(clock):
+    async def scenario():
+        cache, balances = BalanceCache(), Balances()
+        results = await asyncio.gather(*(cache.get("0xabc", balances.fetch) for _ in range(5)))
+        return results, balances.calls, cache.stats()
+
+    results, calls, stats = run(scenario())
+    assert results == ["balance 1"] * 5 and calls == 1
+    assert (stats["coalesced"], stats["rpc_calls_avoided"]) == (4, 4)
+
+def test_failed_fetches_are_not_cached(clock):
+    async def scenario():
+        cache = BalanceCache()
+
+        async def failing():
+            raise ConnectionError("RPC down")
+
+        with pytest.raises(ConnectionError):
+            await cache.get("0xabc", failing)
+        return await cache.get("0xabc", Balances().fetch)
+
+    assert run(scenario()) == "balance 1"
+
+def test_invalidation_drops_the_balance(clock):
+    async def scenario():
+        cache, balances = BalanceCache(), Balances()
+        await cache.get("0xabc", balances.fetch)
+        cache.invalidate("0xABC")
+        return await cache.get("0xabc", balances.fetch)
+
+    assert run(scenario()) == "balance 2"
+
+def test_held_account_is_not_cached_until_the_hold_expires(clock):
+    async def scenario():
+        cache, balances = BalanceCache(ttl=10, hold=120), Balances()
+        cache.invalidate("0xabc", hold=True)
+        results = [await cache.get("0xabc", balances.fetch), await cache.get("0xabc", balances.fetch)]
+        clock.now += 120
+        results += [await cache.get("0xabc", balances.fetch), await cache.get("0xabc", balances.fetch)]
+        return results
+
+    assert run(scenario()) == ["balance 1", "balance 2", "balance 3", "balance 3"]
+
+def test_expired_holds_are_pruned(clock):
+    cache = BalanceCache(hold=120)
+    for account in ("0x1", "0x2"):
+        cache.invalidate(account, hold=True)
+    clock.now += 120
+    cache.invalidate("0x3")
+    assert list(cache._held_until) == []
+
+
+def test_invalidation_detaches_the_fetch_in_flight(clock):
+    async def scenario():
+        cache, balances = BalanceCache(), Balances(gated=True)
+        # Started before the transfer, it may see the balance from before it
+        before = asyncio.ensure_future(cache.get("0xabc", balances.fetch))
+        await asyncio.sleep(0)
+        cache.invalidate("0xabc")
+        # Not shared with the requests made after the transfer
+        after = asyncio.ensure_future(cache.get("0xabc", balances.fetch))
+        await asyncio.sleep(0)
+        balances.gate.set()
+        results = await asyncio.gather(before, after)
+        # Nor cached, the next request gets the fetch made after the transfer
+        return results, await cache.get("0xabc", balances.fetch), balances.calls
+
+    (before, after), cached, calls = run(scenario())
+    assert (before, after, cached, calls) == ("balance 1", "balance 2", "balance 2", 2)
@@ -0,0 +1,60 @@
+"""ChatRequest views: derived requests never change the stored history."""
+import copy
+
+from chat_messages import ChatRequest
+from history import summary_message
+
+HISTORY = [
+    {"role": "user", "content": "hi"},
+    {"role": "assistant", "content": "hello"},
+    {"role": "user", "content": "how do swaps work?"},
+]
+SUMMARY = summary_message("The user holds WETH.")
+
+
+def test_messages_in_order():
+    request = ChatRequest("system", (SUMMARY,), HISTORY, start=1)
+    assert list(request) == [{"role": "system", "content": "system"}, SUMMARY] + HISTORY[1:]
+    assert len(request) == 4
+
+def test_with_system_leaves_the_history_unchanged():
+    history = copy.deepcopy(HISTORY)
+    request = ChatRequest("system", (SUMMARY,), history)
+    staged = request.with_system("stage prompt")
+    without = request.with_system(None)
+
+    assert list(staged)[0] == {"role": "system", "content": "stage prompt"}
+    assert list(without) == [SUMMARY] + HISTORY
+    assert list(request)[0] == {"role": "system", "content": "system"}
+    assert history == HISTORY
+    # The history is shared, not copied
+    assert staged.history is history
+
+def test_append_leaves_the_history_unchanged():
+    history = copy.deepcopy(HISTORY)
+    request = ChatRequest("system", (), history)
+    stage = {"role": "system", "content": "Quote: 12.5 WMATIC"}
+    appended = request.append(stage).append({"role": "user", "content": "more"})
+
+    assert list(appended)[-2:] == [stage, {"role": "user", "content": "more"}]
+    assert len(appended) == len(request) + 2
+    assert list(request) == [{"role": "system", "content": "system"}] + HISTORY
+    assert history == HISTORY
+
+def test_with_last_content_leaves_the_stored_message_unchanged():
+    history = copy.deepcopy(HISTORY)
+    request = ChatRequest("system", (), history)
+    reminded = request.with_last_content(request.last()["content"] + " Answer in JSON.")
+
+    assert list(reminded)[-1] == {"role": "user", "content": "how do swaps work? Answer in JSON."}
+    assert len(reminded) == len(request)
+    assert history == HISTORY
+    # And on a request ending with a stage message
+    staged = request.append({"role": "system", "content": "stage"}).with_last_content("other")
+    assert list(staged)[-2:] == [HISTORY[-1], {"role": "system", "content": "other"}]
+
+def test_history_appended_after_the_request_is_not_sent():
+    history = copy.deepcopy(HISTORY)
+    request = ChatRequest("system", (), history)
+    history.append({"role": "assistant", "content": "Through Uniswap."})
+    assert list(request)[-1] == HISTORY[-1]
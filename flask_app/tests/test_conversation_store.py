@@ -0,0 +1,80 @@
+"""Compare-and-swap writes of the GCS backend, on the in-memory bucket."""
+import threading
+
+import pytest
+
+from conversation_store import ConflictError
+from gcs_store import GCSConversationBackend, conversation_blob_path
+from memory_bucket import MemoryBlob, MemoryBucket
+
+
+class ContendedBucket(MemoryBucket):
+    """A bucket where another writer rewrites every object right before each upload."""
+
+    def blob(self, blob_name):
+        return ContendedBlob(self, blob_name)
+
+
+class ContendedBlob(MemoryBlob):
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        current = self.bucket.get_blob(self.name)
+        if current is not None:
+            MemoryBlob(self.bucket, self.name).upload_from_string(current.download_as_bytes())
+        super().upload_from_string(data, content_type, if_generation_match)
+
+
+def new_conversation(conversationId="c1"):
+    return {"id": conversationId, "name": "Test", "timestamp": "2024-01-01T00:00:00", "messages": []}
+
+
+def test_concurrent_appends_lose_no_message(monkeypatch):
+    monkeypatch.setenv("CONVERSATION_WRITE_ATTEMPTS", "50")
+    bucket = MemoryBucket()
+    # Two workers, each with its own cache in front of the same bucket
+    workers = [GCSConversationBackend(bucket=bucket), GCSConversationBackend(bucket=bucket)]
+    assert workers[0].create_conversation("u1", new_conversation())
+
+    def append(worker, writer):
+        for i in range(20):
+            assert worker.append_messages("u1", "c1", [{"role": "user", "content": f"{writer}-{i}"}])
+
+    threads = [threading.Thread(target=append, args=(workers[writer % 2], writer)) for writer in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for worker in workers:
+        contents = [message["content"] for message in worker.load_conversation("u1", "c1")["messages"]]
+        assert len(contents) == 80
+        for writer in range(4):
+            # Every message of a writer, in the order it appended them
+            assert [content for content in contents if content.startswith(f"{writer}-")] == [f"{writer}-{i}" for i in range(20)]
+    assert sum(worker.stats()["conflicts"] for worker in workers) > 0
+
+
+def test_conflict_retries_on_the_latest_content():
+    bucket = MemoryBucket()
+    first, second = GCSConversationBackend(bucket=bucket), GCSConversationBackend(bucket=bucket)
+    first.create_conversation("u1", new_conversation())
+    # The second worker caches the conversation, then the first one appends to it
+    second.load_conversation("u1", "c1")
+    first.append_messages("u1", "c1", [{"role": "user", "content": "first"}])
+
+    # The second worker's write starts from its stale cache, conflicts and is applied again
+    second.update_json_blob(conversation_blob_path("u1", "c1"), lambda conversation: dict(
+        conversation, messages=conversation["messages"] + [{"role": "user", "content": "second"}]))
+    contents = [message["content"] for message in first.load_conversation("u1", "c1")["messages"]]
+    assert contents == ["first", "second"]
+
+
+def test_conflict_error_once_the_attempts_are_spent(monkeypatch):
+    monkeypatch.setenv("CONVERSATION_WRITE_ATTEMPTS", "3")
+    backend = GCSConversationBackend(bucket=ContendedBucket())
+    assert backend.create_conversation("u1", new_conversation())
+
+    with pytest.raises(ConflictError):
+        backend.append_messages("u1", "c1", [{"role": "user", "content": "lost"}])
+    assert backend.stats()["conflicts"] == 3
+    assert backend.load_conversation("u1", "c1")["messages"] == []
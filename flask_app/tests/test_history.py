@@ -0,0 +1,93 @@
+"""Sliding-window compaction of the history and its rolling summary."""
+import asyncio
+
+import pytest
+
+import history
+import main
+from history import KEEP_TURNS, SUMMARY_BATCH, compact_history, summary_end, summary_message, track_confirmation, window_start
+
+
+def turns(count):
+    """count turns of a user message and an assistant answer."""
+    messages = []
+    for i in range(count):
+        messages += [{"role": "user", "content": f"question {i}"}, {"role": "assistant", "content": f"answer {i}"}]
+    return messages
+
+
+def test_short_conversations_are_sent_verbatim():
+    messages = turns(KEEP_TURNS)
+    assert window_start(messages) == 0
+    assert compact_history(messages, {"messages": messages}) == (None, 0)
+    assert summary_end(messages, None) is None
+
+def test_window_keeps_the_last_turns():
+    messages = turns(KEEP_TURNS + 3)
+    assert window_start(messages) == 6
+    assert window_start(messages, keep_turns=0) == 0
+
+def test_summary_is_asked_once_a_batch_left_the_window():
+    messages = turns(KEEP_TURNS) + turns(SUMMARY_BATCH // 2)
+    assert summary_end(messages, None) == window_start(messages)
+    # Until the next batch left the window, the summary is not extended
+    conversation = {"history": {"summary": "s", "summarized": window_start(messages)}}
+    assert summary_end(messages + turns(1), conversation) is None
+
+def test_messages_not_summarized_yet_are_sent_verbatim():
+    messages = turns(KEEP_TURNS + 4)
+    assert compact_history(messages, None) == (None, 0)
+    conversation = {"history": {"summary": "The user swapped USDC.", "summarized": 4}}
+    assert compact_history(messages, conversation) == (summary_message("The user swapped USDC."), 4)
+    conversation["history"]["summarized"] = 8
+    assert compact_history(messages, conversation) == (summary_message("The user swapped USDC."), window_start(messages))
+
+def test_pending_confirmation_stays_verbatim():
+    messages = turns(KEEP_TURNS + 4)
+    conversation = {"history": {"summary": "s", "summarized": 8}, "pendingConfirmation": 2}
+    assert compact_history(messages, conversation)[1] == 2
+
+@pytest.mark.parametrize("intent, pending", [
+    ("swap_intent", 10), ("multiswap_intent", 10), ("transfer_token", 10),
+    ("swap_function", None), ("user-assistance", None), (None, None),
+])
+def test_confirmation_is_pending_until_the_next_turn(intent, pending):
+    assert track_confirmation(intent, 10) == pending
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    """A conversation of the store, and the summary calls made for it."""
+    conversation = {"messages": turns(KEEP_TURNS + SUMMARY_BATCH), "history": {"summary": "The user holds WETH.", "summarized": 2}}
+    calls = []
+
+    async def summarize(messages, instruction, stage, summary_message=None, start=0, stop=None):
+        calls.append((summary_message, start, stop))
+        return "The user holds WETH and asked for quotes."
+
+    def update_metadata(userId, conversationId, fields):
+        conversation.update(fields)
+        return conversation
+
+    monkeypatch.setattr(main, "load_conversation", lambda userId, conversationId: conversation)
+    monkeypatch.setattr(main, "update_metadata", update_metadata)
+    monkeypatch.setattr(main, "summarize", summarize)
+    return conversation, calls
+
+def test_summary_is_carried_forward(stored):
+    conversation, calls = stored
+    end = window_start(conversation["messages"])
+    asyncio.run(main.refresh_history_summary("u1", "c1"))
+    # Only the messages left out since the last summary are sent, with the previous summary
+    assert calls == [(summary_message("The user holds WETH."), 2, end)]
+    assert conversation["history"] == {"summary": "The user holds WETH and asked for quotes.", "summarized": end}
+
+    # Nothing more left the window
+    asyncio.run(main.refresh_history_summary("u1", "c1"))
+    assert len(calls) == 1
+
+def test_summary_waits_for_a_batch(stored, monkeypatch):
+    conversation, calls = stored
+    monkeypatch.setattr(history, "SUMMARY_BATCH", window_start(conversation["messages"]))
+    asyncio.run(main.refresh_history_summary("u1", "c1"))
+    assert calls == []
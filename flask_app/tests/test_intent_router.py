@@ -0,0 +1,105 @@
+"""Rules, classifier fallback and evaluation of the local intent router."""
+import pytest
+
+from intent_router import IntentClassifier, IntentRouter
+
+QUOTE = {"tokenIn": "USDC", "tokenOut": "WMATIC", "amount": "10"}
+
+
+@pytest.fixture
+def router():
+    # Confident predictions are never sampled, so dispatch() is deterministic
+    return IntentRouter(sample_rate=0)
+
+
+@pytest.mark.parametrize("message", ["yes", "Yes please!", "ok", "go ahead.", "Let's do it", "confirm"])
+def test_confirmation_of_the_quote_swaps_it(router, message):
+    prediction = router.predict(message, QUOTE)
+    assert (prediction.intent, prediction.response, prediction.source) == ("swap_function", QUOTE, "rule")
+    assert router.dispatch(prediction)
+    # The remembered quote is not shared with the handler
+    assert prediction.response is not QUOTE
+
+@pytest.mark.parametrize("message", [
+    "yes but for 20 USDC",
+    "yes, swap 10 USDC for WETH instead",
+    "no",
+    "ok what is the price of WETH?",
+    "yes?!? why",
+])
+def test_anything_more_than_a_confirmation_goes_to_the_model(router, message):
+    prediction = router.predict(message, QUOTE)
+    assert prediction is None or prediction.intent != "swap_function"
+
+def test_confirmation_without_a_quote_is_not_a_swap(router):
+    prediction = router.predict("yes")
+    assert prediction is None or prediction.intent != "swap_function"
+    assert not router.dispatch(prediction)
+
+
+@pytest.mark.parametrize("message, query", [
+    ("query Balance", "Balance"),
+    ("Query #Info.owner?", "#Info.owner"),
+    ("query token_name", "token_name"),
+])
+def test_query_of_a_single_name(router, message, query):
+    prediction = router.predict(message)
+    assert (prediction.intent, prediction.response) == ("query-process", {"query": query})
+    assert router.dispatch(prediction)
+
+@pytest.mark.parametrize("message", ["query the balance of my process", "query 42", "query Balance and Info"])
+def test_free_form_queries_go_to_the_model(router, message):
+    assert not router.dispatch(router.predict(message))
+
+
+@pytest.mark.parametrize("message", ["balance", "What is my balance?", "show me my token balances", "how much WETH do I have"])
+def test_balance_questions(router, message):
+    prediction = router.predict(message)
+    assert (prediction.intent, prediction.source) == ("account_balance", "rule")
+    assert router.dispatch(prediction)
+
+def test_trades_mentioning_a_balance_go_to_the_model(router):
+    assert router.predict("swap my balance of USDC for WETH") is None
+
+
+def classifier():
+    return IntentClassifier.fit(
+        [("show my tokens", "account_balance")] * 20
+        + [("tell me about uniswap", "user-assistance")] * 20
+    )
+
+def test_confident_classifier_prediction_is_dispatched(router):
+    router._classifier = classifier()
+    prediction = router.predict("show my tokens")
+    assert (prediction.intent, prediction.source) == ("account_balance", "classifier")
+    assert prediction.confidence >= router.threshold
+    assert router.dispatch(prediction)
+
+def test_below_threshold_falls_back_to_the_model(router):
+    router._classifier = classifier()
+    prediction = router.predict("show me something")
+    assert prediction.confidence < router.threshold
+    assert not router.dispatch(prediction)
+
+def test_classifier_only_dispatches_intents_without_model_response(router):
+    router._classifier = classifier()
+    prediction = router.predict("tell me about uniswap")
+    assert prediction.intent == "user-assistance" and prediction.confidence >= router.threshold
+    assert not router.dispatch(prediction)
+
+def test_shadow_and_off_modes_never_dispatch():
+    assert not IntentRouter(mode="shadow", sample_rate=0).dispatch(IntentRouter().predict("balance"))
+    assert IntentRouter(mode="off").predict("balance") is None
+
+
+def test_precision_and_recall_against_the_model(router):
+    balance = router.predict("balance")
+    for model_intent in ("account_balance", "account_balance", "account_balance", "user-assistance"):
+        router.observe("balance", balance, model_intent)
+    # The model said account_balance for a message the router had no guess for
+    router.observe("what do I hold", None, "account_balance")
+
+    intents = router.stats()["intents"]
+    assert intents["account_balance"] == {"precision": 0.75, "recall": 0.75, "support": 4}
+    assert intents["user-assistance"] == {"precision": None, "recall": 0.0, "support": 1}
+    assert router.stats()["model_calls"] == 5
@@ -0,0 +1,145 @@
+"""The persistent job queue, driven without its worker threads, and the title jobs."""
+import json
+import time
+
+import pytest
+
+import main
+from jobs import DONE, FAILED, PENDING, RUNNING, Job, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    # No worker threads, the tests claim and run the batches themselves
+    return JobQueue(str(tmp_path / "jobs.db"), workers=0, lease=60, max_attempts=3)
+
+def run_batch(queue):
+    """Claim and run one batch, returns its jobs or None if no job is ready."""
+    claimed = queue._claim()
+    if claimed is None:
+        return None
+    queue._run(*claimed)
+    return claimed[1]
+
+def make_ready(queue):
+    """Let the jobs waiting for a retry run now."""
+    queue.conn.execute("UPDATE jobs SET run_at = ? WHERE status = ?", (time.time(), PENDING))
+
+
+def test_pending_jobs_are_deduplicated_per_key(queue):
+    queue.register("title", lambda jobs: {job.id: job.payload["n"] for job in jobs})
+    first = queue.enqueue("title", "u/c1", {"n": 1})
+    assert queue.enqueue("title", "u/c1", {"n": 2}) == first
+    other = queue.enqueue("title", "u/c2", {"n": 3})
+    assert other != first
+    assert queue.stats()["deduplicated"] == 1
+
+    run_batch(queue)
+    assert queue.get(first).result == 1
+    # Once the job ran, the key can be enqueued again
+    assert queue.enqueue("title", "u/c1", {"n": 4}) != first
+
+def test_jobs_are_batched(queue):
+    batches = []
+
+    def handler(jobs):
+        batches.append(len(jobs))
+        return {job.id: job.key for job in jobs}
+
+    queue.register("title", handler, batch_size=3)
+    ids = [queue.enqueue("title", f"u/c{i}", {}) for i in range(5)]
+    while run_batch(queue):
+        pass
+    assert batches == [3, 2]
+    assert [queue.get(job_id).result for job_id in ids] == [f"u/c{i}" for i in range(5)]
+
+def test_running_key_is_not_claimed_twice(queue):
+    queue.register("title", lambda jobs: {}, batch_size=2)
+    queue.enqueue("title", "u/c1", {})
+    assert queue._claim() is not None
+    # A new job of a running key waits for the running one
+    queue.enqueue("title", "u/c1", {})
+    assert queue._claim() is None
+
+def test_expired_leases_are_claimed_again(queue):
+    queue.register("title", lambda jobs: {job.id: "title" for job in jobs})
+    job_id = queue.enqueue("title", "u/c1", {})
+    _, jobs = queue._claim()
+    assert queue.get(job_id).status == RUNNING
+    assert queue._claim() is None
+
+    # Its worker died: the job is claimed again once its lease expired
+    queue.conn.execute("UPDATE jobs SET run_at = ? WHERE id = ?", (time.time() - 1, job_id))
+    _, jobs = queue._claim()
+    assert [job.id for job in jobs] == [job_id]
+    assert jobs[0].attempts == 1
+
+def test_jobs_without_result_are_retried_then_failed(queue):
+    queue.register("title", lambda jobs: {job.id: "done" for job in jobs if job.key == "u/ok"}, batch_size=2)
+    ok = queue.enqueue("title", "u/ok", {})
+    missing = queue.enqueue("title", "u/missing", {})
+
+    run_batch(queue)
+    assert queue.get(ok).status == DONE
+    assert queue.get(missing).status == PENDING
+    for _ in range(2):
+        make_ready(queue)
+        assert run_batch(queue) is not None
+
+    job = queue.get(missing)
+    assert (job.status, job.attempts, job.error) == (FAILED, 3, "No result")
+    assert queue.stats()["retried"] == 2
+    assert queue.stats()["failed"] == 1
+
+def test_failed_handler_retries_the_batch(queue):
+    def handler(jobs):
+        raise RuntimeError("model down")
+
+    queue.register("title", handler)
+    job_id = queue.enqueue("title", "u/c1", {})
+    run_batch(queue)
+    job = queue.get(job_id)
+    assert (job.status, job.error) == (PENDING, "model down")
+
+
+def title_job(conversationId):
+    payload = json.dumps({"userId": "u", "conversationId": conversationId})
+    return Job(conversationId, "title", f"u/{conversationId}", payload, RUNNING, None, None, 0)
+
+@pytest.fixture
+def conversations(monkeypatch):
+    stored = {"c1": {"messages": []}, "c2": {"messages": []}}
+    written = {}
+
+    def update_metadata(userId, conversationId, fields):
+        written[conversationId] = fields["summary"]
+        return stored[conversationId]
+
+    monkeypatch.setattr(main, "load_conversation", lambda userId, conversationId: stored.get(conversationId))
+    monkeypatch.setattr(main, "update_metadata", update_metadata)
+    # Counting tokens needs the tokenizer's encoding, not what these tests are about
+    monkeypatch.setattr(main, "check_input_length", lambda messages, stage: None)
+    return written
+
+def answer_with(monkeypatch, answer):
+    async def call_ml_model(messages, stage, response_format=None):
+        return answer
+    monkeypatch.setattr(main, "call_ml_model", call_ml_model)
+
+
+def test_titles_are_parsed():
+    assert main.parse_titles('{"1": " \\"Swapping USDC.\\" ", "3": "Minting"}', 3) == ["Swapping USDC", None, "Minting"]
+    assert main.parse_titles('{"1": {"title": "Nested"}}', 1) == [None]
+    assert main.parse_titles('["Swapping USDC"]', 1) == [None]
+    assert main.parse_titles("Swapping USDC", 1) == [None]
+
+def test_only_untitled_jobs_are_left_out(monkeypatch, conversations):
+    answer_with(monkeypatch, '{"2": "Checking balances"}')
+    results = main.run_title_jobs([title_job("c1"), title_job("c2"), title_job("deleted")])
+    assert results == {"c2": "Checking balances", "deleted": None}
+    assert conversations == {"c2": "Checking balances"}
+
+def test_answer_of_the_wrong_shape_titles_nothing(monkeypatch, conversations):
+    answer_with(monkeypatch, '["Swapping USDC", "Checking balances"]')
+    assert main.run_title_jobs([title_job("c1"), title_job("c2")]) == {}
+    assert conversations == {}
@@ -0,0 +1,174 @@
+"""Deadlines, hedging and the circuit breaker against the fake OpenAI server."""
+import asyncio
+import time
+
+import pytest
+from openai import AsyncOpenAI
+
+from fake_openai import start_server
+from model_resilience import CircuitBreaker, ModelUnavailable, ResilientCaller
+from model_tiers import ModelTier
+
+TIER = ModelTier("small", "gpt-4o-mini", timeout=2, max_tokens=0)
+
+
+@pytest.fixture
+def upstream():
+    servers = []
+
+    def start(**options):
+        server = start_server(**dict({"latency": 0.01, "token_delay": 0}, **options))
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def counters(server):
+    return server.RequestHandlerClass.counters
+
+def complete(server, caller, tier=TIER, stage="classify", stream=False):
+    """Answer of a call through the caller, the joined text deltas when streamed."""
+
+    async def run():
+        client = AsyncOpenAI(base_url=f"http://127.0.0.1:{server.server_port}/v1", api_key="test", max_retries=0)
+
+        def request():
+            return client.chat.completions.create(
+                messages=[{"role": "user", "content": "hello"}], stream=stream, **tier.request_options()
+            )
+
+        try:
+            if not stream:
+                completion = await caller.call(tier, stage, request)
+                return completion.choices[0].message.content
+            return "".join([chunk.choices[0].delta.content or "" async for chunk in caller.stream(tier, stage, request)
+                            if chunk.choices])
+        finally:
+            await client.close()
+
+    return asyncio.run(run())
+
+def warmed_caller(latency, stage="classify", **options):
+    """A caller with enough samples of the tier at the stage to hedge after latency seconds."""
+    caller = ResilientCaller(CircuitBreaker(), **dict({"min_samples": 5, "min_delay": 0}, **options))
+    for _ in range(5):
+        caller.latency.observe((TIER.name, stage), latency)
+    return caller
+
+
+def test_call_returns_the_completion(upstream):
+    server = upstream()
+    caller = ResilientCaller(CircuitBreaker())
+    assert "canned answer" in complete(server, caller)
+    assert caller.stats()["calls"] == 1
+    assert caller.latency.labels((TIER.name, "classify")).count == 1
+
+
+def test_slow_call_is_hedged(upstream):
+    server = upstream(slow_first=1, slow_latency=5)
+    caller = warmed_caller(0.1)
+    start = time.monotonic()
+    assert "canned answer" in complete(server, caller)
+    assert time.monotonic() - start < 2
+    stats = caller.stats()
+    assert stats["hedged"] == 1
+    assert stats["hedge_wins"] == 1
+    assert counters(server)["requests"] == 2
+
+
+def test_hedge_delay_is_per_stage(upstream):
+    caller = warmed_caller(0.1, stage="classify")
+    assert caller.hedge_delay(TIER, "classify") == 0.1
+    assert caller.hedge_delay(TIER, "explain") is None
+
+    server = upstream(slow_first=1, slow_latency=0.5)
+    complete(server, caller, stage="explain")
+    assert caller.stats()["hedged"] == 0
+    assert counters(server)["requests"] == 1
+
+
+def test_streamed_call_is_hedged_until_its_first_chunk(upstream):
+    server = upstream(slow_first=1, slow_latency=5)
+    caller = warmed_caller(0.1)
+    start = time.monotonic()
+    assert "canned answer" in complete(server, caller, stream=True)
+    assert time.monotonic() - start < 2
+    assert caller.stats()["hedge_wins"] == 1
+
+
+def test_call_past_the_deadline_fails(upstream):
+    server = upstream(latency=5)
+    caller = ResilientCaller(CircuitBreaker(), hedging=False)
+    tier = ModelTier("small", "gpt-4o-mini", timeout=0.3, max_tokens=0)
+    start = time.monotonic()
+    with pytest.raises(ModelUnavailable):
+        complete(server, caller, tier)
+    assert time.monotonic() - start < 2
+    assert caller.stats()["deadline_exceeded"] == 1
+
+
+def test_stream_past_the_deadline_fails(upstream):
+    server = upstream(token_delay=0.2)
+    caller = ResilientCaller(CircuitBreaker(), hedging=False)
+    tier = ModelTier("small", "gpt-4o-mini", timeout=0.5, max_tokens=0)
+    with pytest.raises(ModelUnavailable):
+        complete(server, caller, tier, stream=True)
+    assert caller.stats()["deadline_exceeded"] == 1
+
+
+def test_bad_request_is_raised_and_does_not_open_the_breaker(upstream):
+    server = upstream(error_rate=1, error_status=400)
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=1), hedging=False)
+    with pytest.raises(Exception) as raised:
+        complete(server, caller)
+    assert not isinstance(raised.value, ModelUnavailable)
+    assert caller.breaker.stats()["state"] == "closed"
+
+
+def test_breaker_opens_then_half_opens_and_closes(upstream):
+    server = upstream(error_rate=1)
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=2, reset_timeout=0.2), hedging=False)
+    for _ in range(2):
+        with pytest.raises(ModelUnavailable):
+            complete(server, caller)
+    assert caller.breaker.stats()["state"] == "open"
+
+    # Open: fails fast without calling the provider
+    with pytest.raises(ModelUnavailable) as raised:
+        complete(server, caller)
+    assert raised.value.retry_after >= 0.1
+    assert counters(server)["requests"] == 2
+
+    # Half-open once the reset timeout expired, a successful trial closes it
+    time.sleep(0.25)
+    assert caller.breaker.stats()["state"] == "half-open"
+    server.RequestHandlerClass.options.error_rate = 0
+    assert "canned answer" in complete(server, caller)
+    stats = caller.breaker.stats()
+    assert stats["state"] == "closed"
+    assert stats["trials"] == 1
+
+
+def test_failed_trial_opens_the_breaker_again(upstream):
+    server = upstream(error_rate=1)
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=1, reset_timeout=0.2), hedging=False)
+    with pytest.raises(ModelUnavailable):
+        complete(server, caller)
+    time.sleep(0.25)
+    with pytest.raises(ModelUnavailable):
+        complete(server, caller)
+    assert counters(server)["requests"] == 2
+    assert caller.breaker.stats()["state"] == "open"
+
+
+def test_rate_limit_opens_the_breaker_for_its_retry_after(upstream):
+    server = upstream(rate_limit_rate=1, retry_after=7)
+    caller = ResilientCaller(CircuitBreaker(failure_threshold=5), hedging=False)
+    with pytest.raises(ModelUnavailable) as raised:
+        complete(server, caller)
+    assert raised.value.retry_after == 7
+    assert caller.breaker.stats()["state"] == "open"
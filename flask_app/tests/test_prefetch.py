@@ -0,0 +1,40 @@
+"""The last quote of a conversation, remembered in its metadata for the next turn."""
+from prefetch import TurnPrefetch, proposes_swap
+
+REQUEST = {"tokenIn": "USDC", "tokenOut": "WMATIC", "amount": "10"}
+ANSWER = {"intent": "swap_intent", "response": "Swap 10 USDC for 12.5 WMATIC?"}
+
+
+def quoted_turn(answer=ANSWER, quoted=True):
+    prefetch = TurnPrefetch("0xabc", None, [{"role": "user", "content": "swap 10 USDC for WMATIC"}])
+    prefetch.quoted = quoted
+    prefetch.remember_quote(REQUEST, answer)
+    return prefetch
+
+def next_turn(last_quote, last_ai_message=ANSWER["response"]):
+    """The prefetch of the next turn, on any worker, from the saved conversation."""
+    messages = [{"role": "assistant", "content": last_ai_message}, {"role": "user", "content": "yes"}]
+    return TurnPrefetch("0xabc", {"lastQuote": last_quote}, messages)
+
+
+def test_quote_shown_is_found_by_the_next_turn():
+    last_quote = quoted_turn().last_quote
+    assert last_quote == {"request": REQUEST, "response": ANSWER["response"]}
+    assert next_turn(last_quote)._last_quote_request() == REQUEST
+
+def test_quote_is_forgotten_once_another_message_follows():
+    assert next_turn(quoted_turn().last_quote, "Your balance is 3 WETH.")._last_quote_request() is None
+
+def test_failed_or_changed_quotes_are_not_remembered():
+    assert quoted_turn(quoted=False).last_quote is None
+    assert quoted_turn({"intent": "swap_intent", "response": "Swap 20 USDC for WMATIC?"}).last_quote is None
+    assert quoted_turn({"intent": "user-assistance", "response": ANSWER["response"]}).last_quote is None
+
+def test_malformed_stored_quotes_are_ignored():
+    assert next_turn(None)._last_quote_request() is None
+    assert next_turn({"request": "USDC", "response": ANSWER["response"]})._last_quote_request() is None
+
+def test_proposal_must_show_the_amount_and_both_tokens():
+    assert proposes_swap({"intent": "swap_intent", "response": "Swap 10.0 usdc for wmatic?"}, REQUEST)
+    assert not proposes_swap({"intent": "swap_intent", "response": "Swap 100 USDC for WMATIC?"}, REQUEST)
+    assert not proposes_swap({"intent": "swap_intent", "response": "Swap 10 USDC for WETH?"}, REQUEST)
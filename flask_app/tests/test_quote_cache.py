@@ -0,0 +1,146 @@
+"""Quote cache: expiry, interpolation from nearby amounts and invalidation after a transfer or a swap."""
+import asyncio
+
+import httpx
+import pytest
+
+import quote_cache as quote_cache_module
+import utils
+from quote_cache import QuoteCache, quote_cache
+from token_registry import get_registry
+
+WALLET = "0xAbC"
+QUOTE = {"estimatedOutput": "12.5", "gasUsedQuoteToken": "0.5", "gasAdjustedQuote": "12"}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(quote_cache_module, "time", clock)
+    return clock
+
+@pytest.fixture
+def pair():
+    registry = get_registry()
+    return registry.address("USDC"), registry.address("WMATIC")
+
+def put(cache, pair, amount, quote=QUOTE, wallet=WALLET, kind="quote"):
+    cache.put(kind, 137, wallet, *pair, amount, quote)
+
+def get(cache, pair, amount, wallet=WALLET, kind="quote"):
+    return cache.get(kind, 137, wallet, *pair, amount)
+
+
+def test_quotes_expire_after_the_ttl(clock, pair):
+    cache = QuoteCache(ttl=15)
+    put(cache, pair, "10")
+    clock.now += 14
+    assert get(cache, pair, "10.0") == (QUOTE, False)
+    clock.now += 1
+    assert get(cache, pair, "10") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+def test_quotes_are_per_wallet(clock, pair):
+    cache = QuoteCache()
+    put(cache, pair, "10")
+    assert get(cache, pair, "10", wallet="0xabc") is not None
+    assert get(cache, pair, "10", wallet="0xdef") is None
+
+def test_least_recently_used_quotes_are_evicted(clock, pair):
+    cache = QuoteCache(max_entries=2)
+    for amount in ("1", "2", "3"):
+        put(cache, pair, amount)
+    assert get(cache, pair, "1") is None
+    assert get(cache, pair, "3") is not None
+
+def test_disabled_cache_stores_nothing(clock, pair):
+    cache = QuoteCache(ttl=0)
+    put(cache, pair, "10")
+    assert get(cache, pair, "10") is None
+
+
+def test_nearby_amount_is_scaled(clock, pair):
+    cache = QuoteCache(interpolation=True, max_delta=0.1)
+    put(cache, pair, "10")
+    quote, interpolated = get(cache, pair, "11")
+    assert interpolated
+    assert float(quote["estimatedOutput"]) == pytest.approx(13.75)
+    assert float(quote["gasAdjustedQuote"]) == pytest.approx(13.25)
+    # The cached quote is left as it was
+    assert get(cache, pair, "10") == (QUOTE, False)
+
+def test_closest_amount_is_used(clock, pair):
+    cache = QuoteCache(interpolation=True, max_delta=0.1)
+    put(cache, pair, "10", {"estimatedOutput": "10"})
+    put(cache, pair, "10.5", {"estimatedOutput": "11"})
+    quote, _ = get(cache, pair, "10.4")
+    assert float(quote["estimatedOutput"]) == pytest.approx(11 * 10.4 / 10.5)
+
+@pytest.mark.parametrize("amount", ["11.1", "8.9", "0", "-10", "ten"])
+def test_amounts_out_of_bounds_are_not_interpolated(clock, pair, amount):
+    cache = QuoteCache(interpolation=True, max_delta=0.1)
+    put(cache, pair, "10")
+    assert get(cache, pair, amount) is None
+
+def test_illiquid_pairs_are_not_interpolated(clock, pair):
+    cache = QuoteCache(interpolation=True, liquid_tokens="USDC")
+    put(cache, pair, "10")
+    assert get(cache, pair, "10.5") is None
+
+def test_expired_quotes_are_not_interpolated(clock, pair):
+    cache = QuoteCache(ttl=15, interpolation=True)
+    put(cache, pair, "10")
+    clock.now += 15
+    assert get(cache, pair, "10.5") is None
+
+def test_interpolation_is_off_by_default(clock, pair):
+    cache = QuoteCache()
+    put(cache, pair, "10")
+    assert get(cache, pair, "10.5") is None
+
+
+def test_invalidation_drops_only_the_wallet(clock, pair):
+    cache = QuoteCache(interpolation=True)
+    put(cache, pair, "10")
+    put(cache, pair, "10", wallet="0xdef")
+    cache.invalidate_wallet("0xABC")
+    assert get(cache, pair, "10") is None
+    assert get(cache, pair, "10.5") is None
+    assert get(cache, pair, "10", wallet="0xdef") is not None
+    assert cache.stats()["invalidations"] == 1
+
+
+class NodeServer:
+    """The Node.js server, answering every call with the same response."""
+
+    def __init__(self, status, payload):
+        self.status, self.payload = status, payload
+
+    async def post(self, path, **options):
+        return httpx.Response(self.status, json=self.payload, request=httpx.Request("POST", path))
+
+@pytest.mark.parametrize("status, payload, invalidated", [
+    (200, {"success": True}, True),
+    (200, {"success": False, "error": "Insufficient balance"}, False),
+])
+def test_transfer_invalidates_the_wallet_quotes(monkeypatch, pair, status, payload, invalidated):
+    monkeypatch.setattr(utils, "node_client", NodeServer(status, payload))
+    put(quote_cache, pair, "10")
+    asyncio.run(utils.transferERC20({"tokenIn": "USDC", "amount": "1", "recipient": "0xdef"}, WALLET))
+    assert (get(quote_cache, pair, "10") is None) == invalidated
+    quote_cache.invalidate_wallet(WALLET)
+
+@pytest.mark.parametrize("status, invalidated", [(200, True), (500, False)])
+def test_swap_invalidates_the_wallet_quotes(monkeypatch, pair, status, invalidated):
+    monkeypatch.setattr(utils, "node_client", NodeServer(status, {"receipt": "0x1", "error": "Reverted"}))
+    put(quote_cache, pair, "10")
+    asyncio.run(utils.multiSwap({"swaps": [{"walletAddress": WALLET}]}))
+    assert (get(quote_cache, pair, "10") is None) == invalidated
+    quote_cache.invalidate_wallet(WALLET)
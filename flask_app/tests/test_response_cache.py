@@ -0,0 +1,40 @@
+"""Keys of the user-assistance answer cache."""
+from chat_messages import ChatRequest
+from history import summary_message
+from response_cache import ResponseCache
+
+SYSTEM = "You are Feelan."
+
+
+def conversation(*contents):
+    return [{"role": "user" if index % 2 == 0 else "assistant", "content": content} for index, content in enumerate(contents)]
+
+def request(history, summary=None, start=0):
+    return ChatRequest(SYSTEM, (summary_message(summary),) if summary else (), history, start)
+
+
+def test_recent_messages_are_normalized():
+    cache = ResponseCache()
+    assert cache.key("model", request(conversation("How do swaps work?"))) == \
+        cache.key("model", request(conversation("  how do SWAPS work")))
+
+def test_model_and_system_prompt_are_in_the_key():
+    cache = ResponseCache()
+    question = conversation("How do swaps work?")
+    assert cache.key("model", request(question)) != cache.key("other", request(question))
+    assert cache.key("model", request(question)) != cache.key("model", ChatRequest("Another prompt", (), question))
+
+def test_earlier_context_is_in_the_key():
+    cache = ResponseCache(context=1)
+    first = conversation("I hold 3 WETH.", "Noted.", "How do swaps work?")
+    second = conversation("I hold 9 USDC.", "Noted.", "How do swaps work?")
+    assert cache.key("model", request(first)) != cache.key("model", request(second))
+
+def test_rolling_summary_is_in_the_key():
+    cache = ResponseCache()
+    history = conversation("Hi", "Hello", "Hi again", "Hello", "How do swaps work?")
+    assert cache.key("model", request(history, "The user holds 3 WETH.", start=4)) != \
+        cache.key("model", request(history, "The user holds 9 USDC.", start=4))
+
+def test_disabled_cache_has_no_keys():
+    assert ResponseCache(ttl=0).key("model", request(conversation("How do swaps work?"))) is None
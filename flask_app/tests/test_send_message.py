@@ -0,0 +1,36 @@
+"""Messages of the UI answered by the non-streamed pipeline without calling the model."""
+import asyncio
+
+import pytest
+
+import main
+from chat_messages import ChatRequest
+
+DATA = {'userId': 'u1', 'accountAddress': '0xabc', 'accountName': 'main', 'conversationId': 'c1', 'timestamp': '1',
+        'name': 'n', 'isNFT': True, 'shelved': False, 'tokenURI': 'ar://nft', 'type': 'chat'}
+
+
+@pytest.fixture
+def saved(monkeypatch):
+    def prepare_turn(data):
+        messages = [{"role": "user", "content": data['user_message']}]
+        return None, messages, 0, ChatRequest("system", (), messages)
+
+    async def call_ml_model(messages, stage, response_format=None):
+        raise AssertionError("The model is not called")
+
+    saved = []
+    monkeypatch.setattr(main, "prepare_turn", prepare_turn)
+    monkeypatch.setattr(main, "call_ml_model", call_ml_model)
+    monkeypatch.setattr(main, "save_turn", lambda *args: saved.append(args))
+    return saved
+
+
+def test_minted_nft_is_answered_and_saved(saved):
+    response = asyncio.run(main.send_message_turn(dict(DATA, user_message="Minting NFT ar://nft")))
+    assert response == "NFT minted!"
+    (_, _, messages, stored_messages), = saved
+    assert messages[stored_messages:] == [
+        {"role": "user", "content": "Minting NFT ar://nft"},
+        {"role": "assistant", "content": "NFT minted!"},
+    ]
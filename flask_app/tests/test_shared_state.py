@@ -0,0 +1,107 @@
+"""The shared state on its sqlite:/// backend, and how the limiter and caches degrade when it fails."""
+import threading
+
+import pytest
+from limits import parse
+from limits.errors import StorageError
+from limits.strategies import MovingWindowRateLimiter
+
+from rate_limits import SharedStateStorage
+from response_cache import ResponseCache
+from shared_state import SharedState, SharedStateError, create_backend
+
+QUESTION = [{"role": "system", "content": "system"}, {"role": "user", "content": "How do swaps work?"}]
+ANSWER = {"intent": "user-assistance", "response": "Swaps go through Uniswap."}
+
+
+@pytest.fixture
+def state(tmp_path):
+    return SharedState(create_backend(f"sqlite:///{tmp_path / 'shared_state.db'}"))
+
+@pytest.fixture
+def broken_state(tmp_path):
+    # The database cannot be opened, every operation fails
+    return SharedState(create_backend(f"sqlite:///{tmp_path / 'missing' / 'shared_state.db'}"))
+
+def limiter(state, **options):
+    storage = SharedStateStorage(**options)
+    storage.state = state
+    return MovingWindowRateLimiter(storage)
+
+
+def test_values_expire(state):
+    state.set("a", "1", ttl=60)
+    state.set("b", "2", ttl=-1)
+    assert state.get("a") == "1"
+    assert state.get("b") is None
+    assert state.expires_at("a") is not None
+
+
+def test_concurrent_increments_are_atomic(state):
+    def increment():
+        for _ in range(50):
+            state.incr("counter", ttl=60)
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert state.get("counter") == "200"
+
+
+def test_sliding_window_stops_at_the_limit(state):
+    hits = [state.sliding_window_hit("user", limit=3, window=60) for _ in range(5)]
+    assert hits == [True, True, True, False, False]
+    assert state.sliding_window("user", 60)[1] == 3
+    assert state.stats()["rejected"] == 2
+
+
+def test_limiter_counts_across_storages(state):
+    limit = parse("2/minute")
+    # Two workers, each with its own storage on the same database
+    first, second = limiter(state), limiter(state)
+    assert first.hit(limit, "user")
+    assert second.hit(limit, "user")
+    assert not first.hit(limit, "user")
+    first.storage.reset()
+    assert second.hit(limit, "user")
+
+
+def test_backend_errors_are_shared_state_errors(broken_state):
+    with pytest.raises(SharedStateError):
+        broken_state.get("a")
+    with pytest.raises(SharedStateError):
+        broken_state.incr("a")
+    assert not broken_state.check()
+    assert broken_state.stats()["errors"] == 3
+
+
+def test_limiter_sees_storage_errors(broken_state):
+    storage = SharedStateStorage()
+    storage.state = broken_state
+    assert storage.base_exceptions is SharedStateError
+    assert not storage.check()
+    with pytest.raises(StorageError):
+        limiter(broken_state, wrap_exceptions=True).hit(parse("2/minute"), "user")
+
+
+def test_cached_answers_are_shared(state):
+    first, second = ResponseCache(shared=state), ResponseCache(shared=state)
+    key = first.key("model", QUESTION)
+    first.put(key, ANSWER, 1.5)
+    assert second.get(key) == ANSWER
+    assert second.stats()["shared_hits"] == 1
+
+
+def test_cache_failures_are_misses(broken_state):
+    cache = ResponseCache(shared=broken_state)
+    key = cache.key("model", QUESTION)
+    cache.put(key, ANSWER, 1.5)
+    # Still cached by this worker
+    assert cache.get(key) == ANSWER
+
+    other = ResponseCache(shared=broken_state)
+    assert other.get(key) is None
+    assert other.stats()["misses"] == 1
+    assert broken_state.stats()["errors"] == 2
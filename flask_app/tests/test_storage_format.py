@@ -0,0 +1,73 @@
+"""Stored form of the conversations: codecs, legacy plain JSON and corrupt objects."""
+import gzip
+import json
+
+import pytest
+
+import storage_format
+from storage_format import CODECS, FORMAT_VERSION, MAGIC, StorageFormat, StorageFormatError
+
+CONVERSATION = {
+    "id": "c1",
+    "name": "Swaps",
+    "messages": [{"role": "user", "content": f"Swap {i} USDC for WMATIC, frais réduits 🚀"} for i in range(50)],
+}
+
+codecs = pytest.mark.parametrize("compression", [
+    "none",
+    "gzip",
+    pytest.param("zstd", marks=pytest.mark.skipif(storage_format.zstandard is None, reason="zstandard is not installed")),
+])
+
+
+@codecs
+def test_round_trip(compression):
+    stored = StorageFormat(compression).encode(CONVERSATION)
+    assert stored[:len(MAGIC)] == MAGIC
+    assert stored[len(MAGIC)] == FORMAT_VERSION
+    assert stored[len(MAGIC) + 1] == CODECS[compression]
+    # Any configuration reads every codec
+    assert StorageFormat("none").decode(stored) == CONVERSATION
+
+@codecs
+def test_small_documents_are_not_compressed(compression):
+    stored = StorageFormat(compression).encode({"id": "c1"})
+    assert stored[len(MAGIC) + 1] == CODECS["none"]
+    assert StorageFormat(compression).decode(stored) == {"id": "c1"}
+
+def test_compression_shrinks_conversations():
+    plain = StorageFormat("none").encode(CONVERSATION)
+    assert len(StorageFormat("gzip").encode(CONVERSATION)) < len(plain) / 4
+
+def test_equal_documents_give_equal_bytes():
+    assert StorageFormat("gzip").encode(CONVERSATION) == StorageFormat("gzip").encode(dict(CONVERSATION))
+
+@pytest.mark.parametrize("legacy", [
+    json.dumps(CONVERSATION).encode("utf-8"),
+    json.dumps(CONVERSATION, ensure_ascii=False, indent=2).encode("utf-8"),
+    json.dumps(CONVERSATION),
+])
+def test_legacy_plain_json_is_read(legacy):
+    assert StorageFormat("gzip").decode(legacy) == CONVERSATION
+
+
+def header(version=FORMAT_VERSION, codec=CODECS["none"]):
+    return MAGIC + bytes((version, codec))
+
+@pytest.mark.parametrize("stored", [
+    header(version=FORMAT_VERSION + 1) + b"{}",
+    header(codec=9) + b"{}",
+    MAGIC + bytes((FORMAT_VERSION,)),
+    header(codec=CODECS["gzip"]) + b"not gzip",
+    header(codec=CODECS["gzip"]) + gzip.compress(b'{"id": "c1"}')[:-6],
+    header() + b'{"id": ',
+    b"FLX" + header()[3:] + b"{}",
+    b"\x1f\x8b not json",
+])
+def test_unreadable_objects_are_rejected(stored):
+    with pytest.raises(StorageFormatError):
+        StorageFormat("gzip").decode(stored)
+
+def test_unknown_compression_is_refused():
+    with pytest.raises(ValueError):
+        StorageFormat("brotli")
@@ -0,0 +1,138 @@
+"""The incremental envelope parser, fed at every chunk boundary, and the events of a failed stream."""
+import json
+import random
+
+import pytest
+
+import main
+import prefetch
+from chat_messages import ChatRequest
+from model_resilience import ModelUnavailable
+from stream_parser import IntentStreamParser
+
+RESPONSES = [
+    "Swaps go through Uniswap.",
+    'Quotes "live" prices,\nwith a \\ backslash\tand a tab.',
+    "Frais réduits, 手数料 and 🚀 rockets",
+]
+
+
+def envelopes():
+    for response in RESPONSES:
+        for ensure_ascii in (True, False):
+            yield response, json.dumps({"intent": "user-assistance", "response": response}, ensure_ascii=ensure_ascii)
+
+def feed(chunks):
+    parser = IntentStreamParser()
+    text = ''.join(parser.feed(chunk) for chunk in chunks)
+    return parser, text
+
+
+@pytest.mark.parametrize("response, envelope", list(envelopes()))
+def test_every_split_in_two_decodes_the_response(response, envelope):
+    # Splits inside every escape, \uXXXX sequence and surrogate pair
+    for split in range(len(envelope) + 1):
+        parser, text = feed([envelope[:split], envelope[split:]])
+        assert (parser.intent, parser.response_is_text, text) == ("user-assistance", True, response)
+
+@pytest.mark.parametrize("response, envelope", list(envelopes()))
+def test_random_chunks_decode_the_response(response, envelope):
+    rng = random.Random(envelope)
+    for _ in range(50):
+        cuts = sorted(rng.sample(range(len(envelope) + 1), rng.randint(1, 8)))
+        chunks = [envelope[start:end] for start, end in zip([0] + cuts, cuts + [len(envelope)])]
+        parser, text = feed(chunks)
+        assert (parser.intent, text, parser.text) == ("user-assistance", response, envelope)
+
+def test_one_character_at_a_time():
+    envelope = '```json\n{"response": "caf\\u00e9 \\ud83d\\ude80", "intent": "user-assistance"}\n```'
+    parser, text = feed(list(envelope))
+    assert (parser.intent, text) == ("user-assistance", "café 🚀")
+
+def test_intent_is_known_before_the_response_ends():
+    parser = IntentStreamParser()
+    assert parser.feed('{"intent": "user-assistance", "response": "Swaps go') == "Swaps go"
+    assert parser.intent == "user-assistance"
+    assert parser.feed(' through Uniswap."}') == " through Uniswap."
+
+def test_nested_values_are_not_response_text():
+    parser, text = feed(['{"intent": "swap_intent", "response": {"tokenIn": "USDC", "amount": "1"}, ', '"note": "x"}'])
+    assert (parser.intent, parser.response_is_text, text) == ("swap_intent", False, "")
+
+def test_keys_of_nested_objects_are_ignored():
+    parser, text = feed(['{"meta": {"intent": "transfer", "response": "no"}, "intent": "user-assistance", "response": "yes"}'])
+    assert (parser.intent, text) == ("user-assistance", "yes")
+
+
+DATA = {'user_message': 'How do swaps work?', 'userId': 'u1', 'accountAddress': '0xabc', 'accountName': 'main',
+        'conversationId': 'c1', 'timestamp': '1', 'name': 'n', 'isNFT': False, 'shelved': False, 'tokenURI': '', 'type': 'chat'}
+
+@pytest.fixture
+def turn(monkeypatch):
+    """A streamed turn of a new conversation whose model stream is given by the test."""
+    def prepare_turn(data):
+        messages = [{"role": "user", "content": data['user_message']}]
+        return None, messages, 0, ChatRequest("system", (), messages)
+
+    async def fetch_balance(accountAddress):
+        return {}
+
+    monkeypatch.setattr(main, "prepare_turn", prepare_turn)
+    monkeypatch.setattr(prefetch, "fetch_balance", fetch_balance)
+    monkeypatch.setattr(main.intent_router, "mode", "off")
+    # Every turn asks the model, answers cached by another test are not served
+    monkeypatch.setattr(main.response_cache, "ttl", 0)
+    saved = []
+    monkeypatch.setattr(main, "save_turn", lambda *args: saved.append(args))
+
+    def stream_with(*deltas, error=None):
+        def stream_ml_model(message, stage, response_format=None):
+            yield from deltas
+            if error is not None:
+                raise error
+        monkeypatch.setattr(main, "stream_ml_model", stream_ml_model)
+        events = []
+        for event in main.stream_turn(dict(DATA)):
+            name, data = event.strip().split("\n")
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+        return events, saved
+
+    return stream_with
+
+
+def test_failed_model_stream_ends_with_error_and_done(turn):
+    events, saved = turn('{"intent": "user-assistance", "resp', 'onse": "Swaps go',
+                         error=ModelUnavailable("The model provider is unavailable, please try again later."))
+    assert events == [
+        ("intent", {"intent": "user-assistance"}),
+        ("delta", {"text": "Swaps go"}),
+        ("error", {"success": False, "status": 503, "message": "The model provider is unavailable, please try again later."}),
+        ("done", {"success": False, "response": None}),
+    ]
+    assert saved == []
+
+def test_unexpected_error_ends_with_error_and_done(turn):
+    events, saved = turn('{"intent": ', error=RuntimeError("boom"))
+    assert events == [
+        ("error", {"success": False, "status": 500, "message": "An error occurred while answering the message."}),
+        ("done", {"success": False, "response": None}),
+    ]
+    assert saved == []
+
+def test_streamed_answer_ends_with_done(turn):
+    events, saved = turn('{"intent": "user-assistance", ', '"response": "Swaps go through Uniswap."}')
+    assert [name for name, _ in events] == ["intent", "delta", "done"]
+    assert events[-1][1]["response"] == "Swaps go through Uniswap."
+    assert len(saved) == 1
+
+def test_invalid_answer_ends_with_error_and_done(turn, monkeypatch):
+    async def call_ml_model(messages, stage, response_format=None):
+        return "Swaps go through Uniswap."
+
+    monkeypatch.setattr(main, "call_ml_model", call_ml_model)
+    events, saved = turn("Swaps go through Uniswap.")
+    assert events == [
+        ("error", {"success": False, "status": 502, "message": "The model could not answer this message, please rephrase it and try again."}),
+        ("done", {"success": False, "response": None}),
+    ]
+    assert saved == []
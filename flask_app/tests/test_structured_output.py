@@ -0,0 +1,101 @@
+"""Local repair and validation of the model answers, and process_response running out of retries."""
+import asyncio
+import json
+
+import pytest
+
+import main
+from chat_messages import ChatRequest
+from structured_output import INTENT_SCHEMAS, InvalidModelAnswer, is_valid_response, parse_response
+
+ANSWER = {"intent": "user-assistance", "response": "Swaps go through Uniswap."}
+
+
+@pytest.mark.parametrize("raw, repaired", [
+    (json.dumps(ANSWER), False),
+    ("```json\n" + json.dumps(ANSWER) + "\n```", True),
+    ("```\n" + json.dumps(ANSWER) + "\n```", True),
+    ("Here is the answer: " + json.dumps(ANSWER) + " Hope it helps!", True),
+    (str(ANSWER), True),
+])
+def test_answers_are_parsed_or_repaired(raw, repaired):
+    assert parse_response(raw) == (ANSWER, repaired)
+
+def test_parsed_dicts_are_kept():
+    assert parse_response(ANSWER) == (ANSWER, False)
+
+@pytest.mark.parametrize("raw", [
+    '{"intent": "user-assistance", "response": "Swaps go',
+    '```json\n{"intent": "swap_intent", "response": {"tokenIn": "USDC",\n```',
+    "Swaps go through Uniswap.",
+    "{'intent': 'user-assistance', 'response': open('x')}",
+])
+def test_unreadable_answers_raise(raw):
+    with pytest.raises(ValueError):
+        parse_response(raw)
+
+
+SWAP = {"tokenIn": "USDC", "tokenOut": "WMATIC", "amount": "10"}
+VALID = {
+    "user-assistance": "Swaps go through Uniswap.",
+    "swap_intent": SWAP,
+    "swap_function": dict(SWAP, amount=10),
+    "multiswap_intent": [SWAP, SWAP],
+    "multiswap_function": SWAP,
+    "account_balance": "You hold 3 WETH.",
+    "transfer_token": "Send 1 WETH to 0xdef?",
+    "transfer_intent": "Send 1 WETH to 0xdef?",
+    "transfer_function": {"tokenIn": "WETH", "recipient": "0xdef", "amount": "1"},
+    "create-process": {"tags": [{"name": "App-Name", "value": "feelan"}]},
+    "query-process": {"query": "Balance"},
+    "run-process": {"code": "return 1"},
+    "about-process": "A process is an AO program.",
+}
+
+def test_every_intent_has_a_valid_example():
+    assert set(VALID) == set(INTENT_SCHEMAS)
+
+@pytest.mark.parametrize("intent", sorted(VALID))
+def test_valid_responses(intent):
+    assert is_valid_response({"intent": intent, "response": VALID[intent]})
+
+@pytest.mark.parametrize("intent", sorted(intent for intent, response in VALID.items() if isinstance(response, dict)))
+def test_missing_required_field_is_invalid(intent):
+    for field in VALID[intent]:
+        response = {name: value for name, value in VALID[intent].items() if name != field}
+        assert not is_valid_response({"intent": intent, "response": response}), field
+
+@pytest.mark.parametrize("answer", [
+    {"response": "Swaps go through Uniswap."},
+    {"intent": "user-assistance"},
+    {"intent": "unknown", "response": "x"},
+    {"intent": "user-assistance", "response": {"text": "x"}},
+    {"intent": "swap_function", "response": dict(SWAP, amount=True)},
+    {"intent": "multiswap_intent", "response": [SWAP, {"tokenIn": "USDC"}]},
+    {"intent": "create-process", "response": {"tags": [{"name": "App-Name"}]}},
+    ["user-assistance", "x"],
+])
+def test_invalid_responses(answer):
+    assert not is_valid_response(answer)
+
+
+def test_retries_are_spent_then_the_answer_is_invalid(monkeypatch):
+    calls = []
+
+    async def call_ml_model(messages, stage, response_format=None):
+        calls.append(stage)
+        return '{"intent": "swap_function", "response": {"tokenIn": "USDC"}}'
+
+    monkeypatch.setattr(main, "call_ml_model", call_ml_model)
+    request = ChatRequest("system", (), [{"role": "user", "content": "swap 10 USDC"}])
+    with pytest.raises(InvalidModelAnswer):
+        asyncio.run(main.process_response("not json", request, n_trials=2))
+    assert calls == ["repair", "repair"]
+
+def test_repaired_retry_is_returned(monkeypatch):
+    async def call_ml_model(messages, stage, response_format=None):
+        return "```json\n" + json.dumps(ANSWER) + "\n```"
+
+    monkeypatch.setattr(main, "call_ml_model", call_ml_model)
+    request = ChatRequest("system", (), [{"role": "user", "content": "how do swaps work"}])
+    assert asyncio.run(main.process_response("not json", request)) == ANSWER
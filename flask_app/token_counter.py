@@ -0,0 +1,110 @@
+"""
+Token counting of chat messages against the context window of the model.
+
+The tokenizer is tiktoken's encoding of the target model, loaded on first
+use. Counts are memoized per message content, so a turn only encodes the
+messages it has not seen yet, typically the new user message.
+
+Configuration:
+    CONTEXT_BUDGET_TOKENS       prompt budget in tokens, overrides the model's context window
+    COMPLETION_RESERVE_TOKENS   tokens kept free for the completion (default 4096)
+    TOKEN_COUNT_CACHE_SIZE      number of memoized message counts (default 8192)
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+# Context window of the chat models, in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Fixed overhead of the chat format: per message, and priming of the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+
+class ContextBudgetExceeded(ValueError):
+    """The messages do not fit in the prompt budget of the model."""
+
+    def __init__(self, model, tokens, budget):
+        super().__init__(f"The conversation is too long for {model}: {tokens} tokens, the limit is {budget}.")
+        self.model = model
+        self.tokens = tokens
+        self.budget = budget
+
+
+class TokenCounter:
+
+    def __init__(self, max_entries=8192):
+        self.max_entries = max_entries
+        self._encodings = {}
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def encoding(self, model):
+        encoding = self._encodings.get(model)
+        if encoding is None:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            self._encodings[model] = encoding
+        return encoding
+
+    def count_text(self, text, model):
+        """Tokens of a single text, memoized on its content."""
+        key = (model, hashlib.sha1(text.encode("utf-8")).digest())
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                self._stats["hits"] += 1
+                return count
+            self._stats["misses"] += 1
+
+        count = len(self.encoding(model).encode(text, disallowed_special=()))
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_messages(self, messages, model):
+        """Prompt tokens of a list of chat messages."""
+        return TOKENS_PER_REPLY + sum(TOKENS_PER_MESSAGE + self.count_text(m["content"], model) for m in messages)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._counts)
+        return stats
+
+
+def context_budget(model):
+    """Prompt tokens allowed for a model, what is left of its context window once the completion is reserved."""
+    budget = os.environ.get("CONTEXT_BUDGET_TOKENS")
+    if budget:
+        return int(budget)
+    window = next((size for name, size in sorted(MODEL_CONTEXT_WINDOWS.items(), key=lambda item: -len(item[0]))
+                   if model.startswith(name)), DEFAULT_CONTEXT_WINDOW)
+    return window - int(os.environ.get("COMPLETION_RESERVE_TOKENS", 4096))
+
+
+token_counter = TokenCounter(max_entries=int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", 8192)))
+
+def enforce_context_budget(messages, model):
+    """Count the prompt tokens of messages, raise ContextBudgetExceeded if they do not fit."""
+    tokens = token_counter.count_messages(messages, model)
+    budget = context_budget(model)
+    if tokens > budget:
+        raise ContextBudgetExceeded(model, tokens, budget)
+    return tokens
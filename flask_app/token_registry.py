@@ -0,0 +1,127 @@
+"""
+In-memory registry of the tokens listed in valid_tokens.json.
+
+The file is parsed once into dict indexes by symbol, case-insensitive
+symbol, name and address, and reloaded when its modification time changes.
+Lookups raise TokenNotFoundError instead of returning sentinel strings.
+"""
+import json
+import os
+import threading
+import time
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+DEFAULT_TOKENS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "valid_tokens.json")
+
+
+class TokenRegistryError(Exception):
+    """The token list could not be loaded."""
+
+
+class TokenNotFoundError(TokenRegistryError, LookupError):
+    """No token matches the requested symbol, name or address."""
+
+    def __init__(self, query):
+        super().__init__(f"Token {query} not found.")
+        self.query = query
+
+
+class TokenRegistry:
+
+    def __init__(self, path=DEFAULT_TOKENS_PATH, check_interval=1.0):
+        self.path = path
+        # Minimum seconds between two mtime checks
+        self.check_interval = check_interval
+        self.version = 0
+
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0
+        self._tokens = []
+        self._by_symbol = {}
+        self._by_symbol_ci = {}
+        self._by_name_ci = {}
+        self._by_address = {}
+
+    def tokens(self):
+        """All tokens, in file order."""
+        self.refresh()
+        return list(self._tokens)
+
+    def lookup(self, query):
+        """
+        Find a token by exact symbol, then case-insensitive symbol, name or address.
+        When several tokens share a symbol, the first one in the file wins.
+        """
+        self.refresh()
+        if not isinstance(query, str):
+            raise TokenNotFoundError(query)
+        key = query.strip()
+        token = (
+            self._by_symbol.get(key)
+            or self._by_symbol_ci.get(key.lower())
+            or self._by_name_ci.get(key.lower())
+            or self._by_address.get(key.lower())
+        )
+        if token is None:
+            raise TokenNotFoundError(query)
+        return token
+
+    def address(self, query):
+        return self.lookup(query)['address']
+
+    def refresh(self):
+        """Reload the file if it changed since the last check, returns the list version."""
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < self.check_interval:
+            return self.version
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                if self._mtime is None:
+                    raise TokenRegistryError(f"Token list {self.path} not found.") from e
+                # Keep serving the last good list
+                return self.version
+            if mtime == self._mtime:
+                return self.version
+            try:
+                self._load(mtime)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                if self._mtime is None:
+                    raise TokenRegistryError(f"Error loading token list {self.path}: {e}") from e
+                log.warning("Error reloading token list %s, keeping the previous one: %s", self.path, e)
+            return self.version
+
+    def _load(self, mtime):
+        with open(self.path, 'r') as file:
+            tokens = json.load(file)
+
+        by_symbol, by_symbol_ci, by_name_ci, by_address = {}, {}, {}, {}
+        for token in tokens:
+            by_symbol.setdefault(token['symbol'], token)
+            by_symbol_ci.setdefault(token['symbol'].lower(), token)
+            by_name_ci.setdefault(token['name'].lower(), token)
+            by_address.setdefault(token['address'].lower(), token)
+
+        # Indexes are fully built before being swapped in, readers never see a partial one
+        self._tokens = tokens
+        self._by_symbol, self._by_symbol_ci, self._by_name_ci, self._by_address = by_symbol, by_symbol_ci, by_name_ci, by_address
+        self._mtime = mtime
+        self.version += 1
+        log.info("Loaded %d tokens from %s", len(tokens), self.path)
+
+
+_registries = {}
+
+def get_registry(path=None):
+    """Shared registry of a token list, valid_tokens.json next to this module by default."""
+    path = path or DEFAULT_TOKENS_PATH
+    registry = _registries.get(path)
+    if registry is None:
+        registry = _registries.setdefault(path, TokenRegistry(path))
+    return registry
@@ -0,0 +1,142 @@
+"""
+Per-request tracing, exported as Prometheus histograms on /metrics.
+
+A trace is started for every request and spans time its steps: storage
+reads and writes, model calls, Node.js backend calls, balance fetches and
+JSON (de)serialization. The trace lives in a context variable, so spans
+opened on the event loop (run_async, asyncio.to_thread) belong to the
+request that scheduled them.
+
+Spans are recorded when their trace finishes, labelled with the intent the
+turn ended up with, so every step is broken down per intent. Spans without
+an intent, e.g. those of the background jobs, are labelled intent="none".
+The spans of a sample of the requests, and of every slow one, are logged.
+
+Configuration:
+    TRACE_SAMPLE_RATE   fraction of the requests whose spans are logged (default 0.01)
+    TRACE_SLOW_SECONDS  requests slower than this always have their spans logged (default 10)
+"""
+import contextvars
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from logs import get_logger
+from metrics import LabeledCounter, LabeledHistogram, prometheus_counter, prometheus_histogram
+
+log = get_logger(__name__)
+
+SPAN_LABELS = ("kind", "operation", "stage", "intent")
+REQUEST_LABELS = ("endpoint", "status", "intent")
+
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.01))
+SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", 10))
+
+span_latency = LabeledHistogram()
+span_errors = LabeledCounter()
+request_latency = LabeledHistogram()
+
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class Trace:
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.intent = None
+        self.status = None
+        self.spans = []
+        self.finished = False
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, kind, operation, stage, elapsed, error):
+        with self._lock:
+            self.spans.append((kind, operation, stage, elapsed, error))
+            finished = self.finished
+        if finished:
+            # Background work of a finished request, e.g. the history summary
+            _observe(kind, operation, stage, self.intent, elapsed, error)
+
+    def finish(self):
+        """Mark the trace finished, returns its spans so far."""
+        with self._lock:
+            self.finished = True
+            return list(self.spans)
+
+
+def _observe(kind, operation, stage, intent, elapsed, error):
+    labels = (kind, operation, stage or "", intent or "none")
+    span_latency.observe(labels, elapsed)
+    if error:
+        span_errors.inc(labels)
+
+
+def start_trace(endpoint):
+    """Start the trace of a request in the current context."""
+    trace = Trace(endpoint)
+    _current.set(trace)
+    return trace
+
+def current_trace():
+    return _current.get()
+
+def set_intent(intent):
+    """Label the spans of the current request with the intent of the turn."""
+    trace = _current.get()
+    if trace is not None and intent:
+        trace.intent = intent
+
+def set_status(status):
+    trace = _current.get()
+    if trace is not None:
+        trace.status = status
+
+def finish_trace():
+    """Record the spans of the current request and detach it from the context."""
+    trace = _current.get()
+    if trace is None or trace.finished:
+        return
+    _current.set(None)
+    elapsed = time.perf_counter() - trace.start
+    spans = trace.finish()
+    for kind, operation, stage, span_elapsed, error in spans:
+        _observe(kind, operation, stage, trace.intent, span_elapsed, error)
+    request_latency.observe((trace.endpoint or "unknown", str(trace.status or ""), trace.intent or "none"), elapsed)
+
+    if elapsed >= SLOW_SECONDS or random.random() < SAMPLE_RATE:
+        log.info("%s %s in %.3fs, intent %s: %s", trace.endpoint, trace.status, elapsed, trace.intent, ", ".join(
+            f"{kind}:{operation}{'/' + stage if stage else ''} {span_elapsed:.3f}s{' failed' if error else ''}"
+            for kind, operation, stage, span_elapsed, error in spans
+        ))
+
+
+@contextmanager
+def span(kind, operation, stage=None):
+    """Time the block as a step of the current request, e.g. span("model", "small", "classify")."""
+    trace = _current.get()
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if trace is None:
+            _observe(kind, operation, stage, None, elapsed, error)
+        else:
+            trace.record(kind, operation, stage, elapsed, error)
+
+
+def prometheus_metrics():
+    """Every span and request histogram in the Prometheus text format."""
+    lines = []
+    lines += prometheus_histogram("feelan_span_seconds", "Duration of the steps of the requests.", span_latency, SPAN_LABELS)
+    lines += prometheus_counter("feelan_span_errors_total", "Steps of the requests that raised.", span_errors, SPAN_LABELS)
+    lines += prometheus_histogram("feelan_request_seconds", "Duration of the requests.", request_latency, REQUEST_LABELS)
+    return "\n".join(lines) + "\n"
+
@@ -1,10 +1,21 @@
-import requests
+import httpx
 import decimal
 import json
 
+from balance_cache import invalidate_account
+from logs import SAMPLED, get_logger
+from node_client import node_client
+from quote_cache import quote_cache
+from token_registry import get_registry, TokenNotFoundError
+
+log = get_logger(__name__)
+
 chainId = 137
 
 
+class QuoteError(Exception):
+    """A swap could not be quoted, the message is shown to the model instead of the quote."""
+
 
 
 
@@ -25,10 +36,12 @@ def smart_round(value, sig_digits=3):
         rounded_value = round(d, precision - 1)
     return rounded_value
 
-def transferERC20(data, accountAddress):
-    url = 'http://localhost:3002/transferERC20'
+async def transferERC20(data, accountAddress):
 
-    tokenInAddress = get_token_address(data['tokenIn'])
+    try:
+        tokenInAddress = get_token_address(data['tokenIn'])
+    except TokenNotFoundError as e:
+        return {'success': False, 'error': str(e)}
     amount = str(data['amount'])
     recipient = data['recipient']
 
@@ -40,32 +53,40 @@ def transferERC20(data, accountAddress):
     }
 
     try:
-        response = requests.post(url, json=data)
+        response = await node_client.post('/transferERC20', json=data)
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        result = response.json()
+        if result.get('success'):
+            invalidate_account(accountAddress)
+        return result
+    except httpx.HTTPStatusError as e:
         return {'success': False, 'error': response.json()['error'].split('Details')[-1]}
+    except httpx.HTTPError as e:
+        return {'success': False, 'error': str(e)}
 
 
-def multiSwap(data):
-
-    url = 'http://localhost:3000/multiSwap'
+async def multiSwap(data):
 
     swaps = data['swaps']
 
-    response = requests.post(url, json={"swaps": swaps})
+    response = await node_client.post('/multiSwap', json={"swaps": swaps})
 
     if response.status_code == 200:
-        print("Transaction receipt:", response.json()["receipt"])
+        for swap in swaps:
+            invalidate_account(swap.get('walletAddress'))
+        log.info("Transaction receipt: %s", response.json()["receipt"])
     else:
-        print("Error:", response.json()["error"])
+        log.warning("Multiswap error: %s", response.json()["error"])
 
 
-def multiQuote(quotes, accountAddress):
-    url = 'http://localhost:3002/multiQuote'
-
+async def multiQuote(quotes, accountAddress):
+    """
+    Quote several swaps at once. Raises TokenNotFoundError for unknown tokens.
+    Legs found in the quote cache are not sent to the Node.js server.
+    """
     # Example list of swap data
     quote_request = []
+    results = []
     for quote in quotes:
         quote["walletAddress"] = accountAddress
         quote["chainId"] = 137
@@ -74,7 +95,16 @@ def multiQuote(quotes, accountAddress):
         tokenOutAddress = get_token_address(quote['tokenOut'])
         quote['tokenInAddress'] = tokenInAddress
         quote['tokenOutAddress'] = tokenOutAddress
-        quote_request.append(quote)
+
+        cached = quote_cache.get('multiQuote', chainId, accountAddress, tokenInAddress, tokenOutAddress, quote['amountIn'])
+        results.append(cached[0] if cached is not None else None)
+        if cached is None:
+            quote_request.append(quote)
+
+    if not quote_request:
+        quote_cache.count_avoided(round_trips=1, legs=len(results))
+        return httpx.Response(200, json={'results': results})
+    quote_cache.count_avoided(legs=len(results) - len(quote_request))
 
     headers = {
     'Content-Type': 'application/json',
@@ -82,27 +112,41 @@ def multiQuote(quotes, accountAddress):
     data = {
         'swaps': quote_request
     }
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = await node_client.post('/multiQuote', headers=headers, content=json.dumps(data))
 
     if response.status_code == 200:
-        return response
+        # Fill the legs that were not cached, in order
+        fetched = iter(zip(quote_request, response.json()['results']))
+        for i, result in enumerate(results):
+            if result is None:
+                quote, results[i] = next(fetched)
+                quote_cache.put('multiQuote', chainId, accountAddress, quote['tokenInAddress'], quote['tokenOutAddress'], quote['amountIn'], results[i])
+        return httpx.Response(200, json={'results': results})
     else:
-        print(f"Error: {response.status_code}, {response.text}")
+        log.warning("Multiquote error: %d, %s", response.status_code, response.text)
         return  response
 
 
 
-def fetchQuote(response, accountAddress):
-    url = 'http://localhost:3002/quote'  # The URL of your Node.js server endpoint
-
-
+async def fetchQuote(response, accountAddress):
+    """Quote of a single swap as shown to the model. Raises QuoteError when there is none."""
     data = response
 
 
-    tokenInAddress = get_token_address(data['tokenIn'])
-    tokenOutAddress = get_token_address(data['tokenOut'])
+    try:
+        tokenInAddress = get_token_address(data['tokenIn'])
+        tokenOutAddress = get_token_address(data['tokenOut'])
+    except TokenNotFoundError as e:
+        raise QuoteError(str(e)) from e
     amount = data['amount']
 
+    # Recent quote of the same swap, or estimated from a nearby amount
+    cached = quote_cache.get('quote', chainId, accountAddress, tokenInAddress, tokenOutAddress, amount)
+    if cached is not None:
+        quote_cache.count_avoided(round_trips=1)
+        response_data, interpolated = cached
+        return format_quote(amount, response_data, interpolated)
+
     # Prepare the data payload
     data = {
         'chainId': chainId,
@@ -114,54 +158,60 @@ def fetchQuote(response, accountAddress):
 
     try:
         # Make the POST request
-        print("calling url", {url})
-        response = requests.post(url, json=data)
+        response = await node_client.post('/quote', json=data)
 
         # Check if the request was successful
         if response.status_code == 200:
             response_data = response.json()
-
-            # Extract and round the relevant fields
-            estimated_output = smart_round(response_data.get('estimatedOutput', 'N/A'))
-            gas_adjusted_quote = smart_round(response_data.get('gasAdjustedQuote', 'N/A'))
-            gas_used_quote_token = smart_round(response_data.get('gasUsedQuoteToken', 'N/A'), 3)
-            gas_used_usd = smart_round(response_data.get('gasUsedUSD', 'N/A'), 3)
-            balance_token_in = response_data.get('balanceTokenIn', 'N/A')
-            balance_token_out = response_data.get('balanceTokenOut', 'N/A')
-            token_in = response_data.get('tokenIn', 'N/A')
-            token_out = response_data.get('tokenOut', 'N/A')
-            # gas_used = response_data.get('gasUsed', 'N/A')
-            # gas_price_wei = response_data.get('gasPriceWei', 'N/A')
-
-
-            # Merge all variables into one string
-            result = (
-                f"{amount} {token_in} for {estimated_output} {token_out}\n"
-                f"Gas Adjusted Quote: {gas_adjusted_quote}\n"
-                f"Gas Used (USD): {gas_used_usd}\n"
-                f"This account has a balance of {balance_token_in} {token_in} \n"
-                f"And a balance of {balance_token_out} {token_out} \n"
-
-            )
-            print(result)
-            return result
+            quote_cache.put('quote', chainId, accountAddress, tokenInAddress, tokenOutAddress, amount, response_data)
+            return format_quote(amount, response_data)
         else:
-            return f"{response.text}"
+            raise QuoteError(f"{response.text}")
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         # Handle any errors that occur during the request
-        return f"An error occurred: {str(e)}"
-
-
-
-def performSwap(response, accountAddress):
-    url = 'http://localhost:3002/swap'  # Adjust the URL based on your actual server URL and port
-
+        raise QuoteError(f"An error occurred: {str(e)}") from e
+
+
+def format_quote(amount, response_data, interpolated=False):
+    """Quote as shown to the model."""
+    # Extract and round the relevant fields
+    estimated_output = smart_round(response_data.get('estimatedOutput', 'N/A'))
+    gas_adjusted_quote = smart_round(response_data.get('gasAdjustedQuote', 'N/A'))
+    gas_used_usd = smart_round(response_data.get('gasUsedUSD', 'N/A'), 3)
+    balance_token_in = response_data.get('balanceTokenIn', 'N/A')
+    balance_token_out = response_data.get('balanceTokenOut', 'N/A')
+    token_in = response_data.get('tokenIn', 'N/A')
+    token_out = response_data.get('tokenOut', 'N/A')
+    # gas_used = response_data.get('gasUsed', 'N/A')
+    # gas_price_wei = response_data.get('gasPriceWei', 'N/A')
+
+
+    # Merge all variables into one string
+    result = (
+        f"{amount} {token_in} for {estimated_output} {token_out}\n"
+        f"Gas Adjusted Quote: {gas_adjusted_quote}\n"
+        f"Gas Used (USD): {gas_used_usd}\n"
+        f"This account has a balance of {balance_token_in} {token_in} \n"
+        f"And a balance of {balance_token_out} {token_out} \n"
+
+    )
+    if interpolated:
+        result += "This quote is estimated from a recent quote for a nearby amount.\n"
+    log.debug("Quote: %s", result, extra=SAMPLED)
+    return result
+
+
+async def performSwap(response, accountAddress):
+    # Executes the swap, quotes are never served from the quote cache here
     data = response
 
 
-    tokenInAddress = get_token_address(data['tokenIn'])
-    tokenOutAddress = get_token_address(data['tokenOut'])
+    try:
+        tokenInAddress = get_token_address(data['tokenIn'])
+        tokenOutAddress = get_token_address(data['tokenOut'])
+    except TokenNotFoundError as e:
+        return str(e)
     amount = str(data['amount'])
 
     # Prepare the data payload
@@ -178,38 +228,23 @@ def performSwap(response, accountAddress):
 
     try:
         # Make the POST request
-        response = requests.post(url, data=json.dumps(data), headers=headers)
+        response = await node_client.post('/swap', content=json.dumps(data), headers=headers)
 
         # Check if the request was successful
         if response.status_code == 200:
             # Process the response if needed or return it
-            print("Swap performed successfully:", response.json())
+            invalidate_account(accountAddress)
+            log.info("Swap performed successfully: %s", response.json())
             return response.json()
         else:
-            print("Failed to perform swap with status code", response.status_code)
+            log.warning("Failed to perform swap with status code %d", response.status_code)
             return response.text
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         # Handle any connection errors
-        print("An error occurred:", str(e))
+        log.warning("Swap failed: %s", e)
         return None
 
 
-def get_token_address(symbol, filename="valid_tokens.json"):
-    # Load the JSON data from the file
-    try:
-        with open(filename, 'r') as file:
-            tokens = json.load(file)
-
-        # Search for the token by symbol and return its address
-        for token in tokens:
-            if token['symbol'] == symbol:
-                return token['address']
-
-        # If the symbol was not found, return an informative message
-        return "Token symbol not found."
-    except FileNotFoundError:
-        return "The file was not found."
-    except json.JSONDecodeError:
-        return "Error decoding JSON."
-    except Exception as e:
-        return f"An error occurred: {str(e)}"
+def get_token_address(symbol, filename=None):
+    """Address of a token by symbol, name or address. Raises TokenNotFoundError."""
+    return get_registry(filename).address(symbol)